@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Benchmark for the assignment engine used when an event is started.
+
+Builds synthetic events offline and runs the same steps as StatusChangeHandler does
+when starting an event (fetch the participants, find an assignment, save the targets)
+against an in-memory participant store, so no app engine SDK is needed.
+
+Usage:
+    python benchmarks/assignment_benchmark.py
+    python benchmarks/assignment_benchmark.py --sizes 10 100 1000 --repeat 50 --scenario skewed
+"""
+
+#Natively provided by python libraries
+from __future__ import print_function
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+#App specific includes
+import assignment
+
+
+_DEFAULT_SIZES = [10, 100, 1000, 10000]
+_DEFAULT_REPEAT = 20
+_PERCENTILES = [50, 90, 99]
+
+class BenchmarkParticipant(object):
+    """Stand-in for datamodel.GiftExchangeParticipant with just the properties the assignment uses"""
+    def __init__(self, display_name, family=None, previous_target=None):
+        self.display_name = display_name
+        self.family = family
+        self.previous_target = previous_target
+        self.target = None
+
+class InMemoryParticipantStore(object):
+    """Stand-in for the datastore, holding the participants of each event in memory"""
+    def __init__(self):
+        self._events = {}
+        self.put_count = 0
+
+    def add_event(self, event_key, participant_list):
+        """Stores the participants for an event"""
+        self._events[event_key] = participant_list
+
+    def fetch(self, event_key):
+        """Equivalent of get_participants_in_event_query(...).fetch()"""
+        return list(self._events.get(event_key, []))
+
+    def put_multi(self, participant_list):
+        """Equivalent of ndb.put_multi"""
+        self.put_count = self.put_count + len(participant_list)
+
+def _names(size):
+    """Returns unique display names for an event of a given size"""
+    return ['Participant %d' % index for index in range(size)]
+
+def generate_uniform(size, rng):
+    """Small families of one to four people, with about a third of the participants in no family"""
+    participant_list = []
+    family_number = 0
+    names = _names(size)
+    index = 0
+    while index < size:
+        if rng.random() < 0.3:
+            participant_list.append(BenchmarkParticipant(names[index]))
+            index = index + 1
+            continue
+        family_size = rng.randint(1, 4)
+        for name in names[index:index + family_size]:
+            participant_list.append(BenchmarkParticipant(name, 'Family %d' % family_number))
+        family_number = family_number + 1
+        index = index + family_size
+    return participant_list
+
+def generate_skewed(size, rng):
+    """One family with almost half the participants, and a long tail of small families"""
+    names = _names(size)
+    big_family_size = max(1, size // 2 - 1)
+    participant_list = [BenchmarkParticipant(name, 'Big Family') for name in names[:big_family_size]]
+    for index, name in enumerate(names[big_family_size:]):
+        participant_list.append(BenchmarkParticipant(name, 'Family %d' % rng.randint(0, max(1, size // 20))))
+    return participant_list
+
+def generate_chains(size, rng):
+    """Uniform families, where everybody gave to somebody last year along one long random cycle"""
+    participant_list = generate_uniform(size, rng)
+    order = list(participant_list)
+    rng.shuffle(order)
+    for index, participant in enumerate(order):
+        participant.previous_target = order[(index + 1) % len(order)].display_name
+    return participant_list
+
+def generate_near_infeasible(size, rng):
+    """Exactly half the participants in one family, so everybody else has to give into it,
+        and last year's targets rule out one of the few remaining options for everybody"""
+    names = _names(size)
+    half = size // 2
+    big_family = [BenchmarkParticipant(name, 'Big Family') for name in names[:half]]
+    others = [BenchmarkParticipant(name) for name in names[half:]]
+    for participant in others:
+        participant.previous_target = rng.choice(big_family).display_name
+    for participant in big_family:
+        participant.previous_target = rng.choice(others).display_name
+    return big_family + others
+
+def generate_infeasible(size, rng):
+    """One family with more than half the participants, so no assignment exists"""
+    names = _names(size)
+    half = size // 2 + 1
+    return [BenchmarkParticipant(name, 'Big Family' if index < half else None) for index, name in enumerate(names)]
+
+SCENARIOS = [
+    ('uniform', generate_uniform),
+    ('skewed', generate_skewed),
+    ('chains', generate_chains),
+    ('near_infeasible', generate_near_infeasible),
+    ('infeasible', generate_infeasible),
+]
+
+def assign_participants(store, event_key, rng):
+    """Mirrors StatusChangeHandler's _assign_participants against the in-memory store"""
+    participant_list = store.fetch(event_key)
+    if len(participant_list) == 0:
+        return True
+    target_index = assignment.find_assignment(participant_list, rng)
+    if target_index is None:
+        return False
+    for participant in participant_list:
+        participant.target = target_index[participant.display_name]
+    store.put_multi(participant_list)
+    return True
+
+def percentile(sorted_values, percent):
+    """Returns the nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+def run_scenario(generator, size, repeat, seed):
+    """Times repeated runs of one scenario, then measures peak memory with one more untimed run
+        since tracing allocations slows everything down. Returns a dictionary of results"""
+    rng = random.Random(seed)
+    timings = []
+    assigned = 0
+    for run in range(repeat):
+        store = InMemoryParticipantStore()
+        store.add_event('event', generator(size, rng))
+        gc.collect()
+        start = time.time()
+        if assign_participants(store, 'event', rng):
+            assigned = assigned + 1
+        timings.append((time.time() - start) * 1000.0)
+    timings.sort()
+    peak_bytes = 0
+    if tracemalloc:
+        store = InMemoryParticipantStore()
+        store.add_event('event', generator(size, rng))
+        gc.collect()
+        tracemalloc.start()
+        assign_participants(store, 'event', rng)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    result = {'assigned': assigned, 'peak_kb': peak_bytes / 1024.0, 'max': timings[-1]}
+    for percent in _PERCENTILES:
+        result['p%d' % percent] = percentile(timings, percent)
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the event assignment engine')
+    parser.add_argument('--sizes', type=int, nargs='+', default=_DEFAULT_SIZES, help='number of participants per event')
+    parser.add_argument('--repeat', type=int, default=_DEFAULT_REPEAT, help='runs per scenario and size')
+    parser.add_argument('--scenario', choices=[name for name, _ in SCENARIOS], action='append', help='only run these scenarios')
+    parser.add_argument('--seed', type=int, default=2016, help='seed for generating events')
+    args = parser.parse_args(argv)
+
+    header = '%-16s %7s %9s %9s %9s %9s %10s %9s' % ('scenario', 'size', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'peak KB', 'assigned')
+    print(header)
+    print('-' * len(header))
+    for name, generator in SCENARIOS:
+        if args.scenario and name not in args.scenario:
+            continue
+        for size in args.sizes:
+            result = run_scenario(generator, size, args.repeat, args.seed)
+            peak = '%10.1f' % result['peak_kb'] if tracemalloc else '%10s' % 'n/a'
+            print('%-16s %7d %9.2f %9.2f %9.2f %9.2f %s %5d/%-3d' % (name, size, result['p50'], result['p90'],
+                                                                     result['p99'], result['max'], peak,
+                                                                     result['assigned'], args.repeat))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Import time profile of the app's entry points.
+
+Each entry point is imported in a new python process, the way a new instance loads it,
+with __import__ wrapped to time every module loaded along the way. It reports the total
+time, the modules that took longest including what they imported, and the ones that took
+longest on their own. Pass --warm-up to also time datamodel.warm_up, which is what the
+warmup request does before an instance gets traffic.
+
+The handler modules need the app engine SDK, the vendored libraries in src/lib and the
+constants module on the path. --sdk sets the SDK up the way dev_appserver does.
+
+Usage:
+    python benchmarks/import_profile.py --sdk ~/google-cloud-sdk/platform/google_appengine
+    python benchmarks/import_profile.py --sdk ~/google_appengine --warm-up main admin
+    python benchmarks/import_profile.py templating linkify
+"""
+
+#Natively provided by python libraries
+from __future__ import print_function
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+_SRC_PATH = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+_DEFAULT_ENTRY_POINTS = ['main', 'admin']
+_DEFAULT_TOP = 15
+
+class ImportProfiler(object):
+    """Times every module imported while it is installed"""
+    def __init__(self):
+        self.records = []
+        self._child_times = []
+        self._original_import = None
+
+    def install(self):
+        self._original_import = builtins.__import__
+        builtins.__import__ = self._import
+
+    def uninstall(self):
+        builtins.__import__ = self._original_import
+
+    def _import(self, name, *args, **kwargs):
+        """Imports a module, recording how long it took if it hadn't been loaded yet"""
+        if name in sys.modules:
+            return self._original_import(name, *args, **kwargs)
+        self._child_times.append(0.0)
+        start = time.time()
+        try:
+            return self._original_import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            child_time = self._child_times.pop()
+            if self._child_times:
+                self._child_times[-1] = self._child_times[-1] + elapsed
+            self.records.append({'name': name, 'depth': len(self._child_times),
+                                 'total_ms': elapsed * 1000.0, 'self_ms': (elapsed - child_time) * 1000.0})
+
+def _set_up_sdk(sdk_path):
+    """Puts the SDK and the app's vendored libraries on the path, as dev_appserver would"""
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    import appengine_config
+
+def _run_child(entry_point, sdk_path, warm_up):
+    """Profiles importing one entry point in this process, which must be fresh, and prints the result as JSON"""
+    sys.path.insert(0, _SRC_PATH)
+    if sdk_path:
+        _set_up_sdk(sdk_path)
+    profiler = ImportProfiler()
+    profiler.install()
+    start = time.time()
+    try:
+        module = __import__(entry_point)
+    finally:
+        profiler.uninstall()
+    result = {'total_ms': (time.time() - start) * 1000.0, 'records': profiler.records, 'warm_up_ms': None}
+    if warm_up:
+        import datamodel
+        start = time.time()
+        datamodel.warm_up(module.app)
+        result['warm_up_ms'] = (time.time() - start) * 1000.0
+    print(json.dumps(result))
+
+def _print_report(entry_point, result, top):
+    """Prints the profile of one entry point"""
+    print('%s: %.1f ms to import' % (entry_point, result['total_ms']))
+    if result['warm_up_ms'] is not None:
+        print('%s: %.1f ms to warm up after importing' % (entry_point, result['warm_up_ms']))
+    for title, column in [('including the modules they import', 'total_ms'), ('on their own', 'self_ms')]:
+        print('  slowest modules, %s:' % title)
+        records = sorted(result['records'], key=lambda record: record[column], reverse=True)
+        for record in records[:top]:
+            print('    %10.2f ms  %s%s' % (record[column], '  ' * record['depth'] if column == 'total_ms' else '', record['name']))
+    print()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Profile the import time of the app entry points')
+    parser.add_argument('entry_points', nargs='*', default=_DEFAULT_ENTRY_POINTS, help='modules to import')
+    parser.add_argument('--sdk', help='path to the app engine SDK')
+    parser.add_argument('--top', type=int, default=_DEFAULT_TOP, help='modules to list in each table')
+    parser.add_argument('--warm-up', action='store_true', help='also time datamodel.warm_up after importing')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        _run_child(args.child, args.sdk, args.warm_up)
+        return 0
+
+    for entry_point in args.entry_points:
+        command = [sys.executable, os.path.abspath(__file__), '--child', entry_point]
+        if args.sdk:
+            command = command + ['--sdk', args.sdk]
+        if args.warm_up:
+            command = command + ['--warm-up']
+        output = subprocess.check_output(command)
+        _print_report(entry_point, json.loads(output.decode('utf-8').strip().splitlines()[-1]), args.top)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
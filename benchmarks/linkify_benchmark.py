@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Micro-benchmark for the linkifier used when rendering messages and ideas.
+
+Compares linkify.linkify against the regular expression it replaced, on normal text and
+on adversarial text that made the regular expression take quadratic time. Every input
+the old expression finishes is also checked to produce identical output. The old
+expression stops being timed once a single run goes over --budget seconds.
+
+Usage:
+    python benchmarks/linkify_benchmark.py
+    python benchmarks/linkify_benchmark.py --sizes 1000 10000 100000 --budget 2
+"""
+
+#Natively provided by python libraries
+from __future__ import print_function
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+#App specific includes
+import linkify
+
+
+_DEFAULT_SIZES = [1000, 4000, 16000, 64000]
+_DEFAULT_BUDGET = 5.0
+_MAX_LINK_LENGTH = 100
+_OLD_REGEX = re.compile(r'http([^\.\s]+\.[^\.\s]*)+[^\.\s]{2,}')
+_PROSE = ('Here is the list https://www.example.com/wishlist?id=123. Also check out http://shop.example.org/item/42 '
+          'or www.nothing.com, and the sale at https://a.b.c.d/deal.html! Thanks.\n')
+
+def old_linkify(text, max_link_length):
+    """The regular expression based version, as free_text_to_safe_html_markup used to do it"""
+    return _OLD_REGEX.sub(lambda matchobj: linkify.get_link_markup(matchobj.group(0), max_link_length), text)
+
+def generate_prose(size):
+    """Ordinary messages with a few links in them"""
+    return (_PROSE * (size // len(_PROSE) + 1))[:size]
+
+def generate_http_repeat(size):
+    """One long token of 'http' over and over with no dots. Every 'http' is a failed match that scans to the end"""
+    return 'http' * (size // 4)
+
+def generate_http_then_dots(size):
+    """Lots of 'http' followed by lots of one character segments, so every start walks every dot before failing"""
+    return 'http' * (size // 12) + 'a.' * (size // 4)
+
+def generate_dots(size):
+    """A url followed by a long run of empty segments"""
+    return 'http://example' + '.' * size
+
+SCENARIOS = [
+    ('prose', generate_prose),
+    ('http_repeat', generate_http_repeat),
+    ('http_then_dots', generate_http_then_dots),
+    ('dots', generate_dots),
+]
+
+def time_call(function, text):
+    """Returns how long one call took in milliseconds, and its result"""
+    start = time.time()
+    result = function(text, _MAX_LINK_LENGTH)
+    return (time.time() - start) * 1000.0, result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the linkifier against the regular expression it replaced')
+    parser.add_argument('--sizes', type=int, nargs='+', default=_DEFAULT_SIZES, help='characters of input')
+    parser.add_argument('--budget', type=float, default=_DEFAULT_BUDGET, help='seconds before the old version stops being timed')
+    args = parser.parse_args(argv)
+
+    header = '%-16s %8s %12s %12s %12s %9s' % ('scenario', 'size', 'new ms', 'new ns/char', 'old ms', 'same')
+    print(header)
+    print('-' * len(header))
+    for name, generator in SCENARIOS:
+        old_is_too_slow = False
+        for size in args.sizes:
+            text = generator(size)
+            new_ms, new_result = time_call(linkify.linkify, text)
+            old_column = '%12s' % 'skipped'
+            same_column = '%9s' % 'n/a'
+            if not old_is_too_slow:
+                old_ms, old_result = time_call(old_linkify, text)
+                old_column = '%12.2f' % old_ms
+                same_column = '%9s' % ('yes' if old_result == new_result else 'NO')
+                old_is_too_slow = old_ms > args.budget * 1000.0
+            print('%-16s %8d %12.2f %12.1f %s %s' % (name, len(text), new_ms, new_ms * 1000000.0 / max(1, len(text)),
+                                                     old_column, same_column))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Startup benchmark for template rendering on a fresh instance.
+
+Every run is a new python process, standing in for a cold instance, that creates the
+environment the way datamodel does and renders the templates in turn. It reports the
+time to create the environment, the time of the first render, and the time to render
+every template once, for three setups:
+
+    source    - templates compiled at runtime, the way it worked before
+    bytecode  - templates compiled at runtime, with a bytecode cache another instance
+                already filled (a directory here, standing in for memcache)
+    compiled  - templates loaded from the modules tools/compile_templates.py writes
+
+Templates are rendered with no values, using an undefined that accepts any attribute or
+call, so only the loading and rendering of the templates is timed. Needs jinja2 installed,
+ideally the version the app.yaml gives the app.
+
+Usage:
+    python benchmarks/template_startup_benchmark.py
+    python benchmarks/template_startup_benchmark.py --runs 10 --first main.html
+"""
+
+#Natively provided by python libraries
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+_SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, _SRC_PATH)
+
+_DEFAULT_RUNS = 5
+_DEFAULT_FIRST_TEMPLATE = 'main.html'
+MODES = ['source', 'bytecode', 'compiled']
+
+def _run_child(mode, cache_path, first_template):
+    """Times loading and rendering the templates in this process, which must be fresh, and prints the times as JSON"""
+    start = time.time()
+    import jinja2
+    import templating
+
+    class AnyValue(jinja2.Undefined):
+        """An undefined that can stand in for any value a template uses"""
+        def __getattr__(self, name):
+            if name.startswith('__'):
+                raise AttributeError(name)
+            return self
+
+        def __getitem__(self, key):
+            return self
+
+        def __call__(self, *args, **kwargs):
+            return self
+
+    if mode == 'source':
+        environment = templating.create_environment(compiled_path=None, undefined=AnyValue)
+    elif mode == 'bytecode':
+        environment = templating.create_environment(compiled_path=None, undefined=AnyValue,
+                                                    bytecode_cache=jinja2.FileSystemBytecodeCache(cache_path))
+    else:
+        if not templating.is_compiled_current(cache_path):
+            raise Exception('The compiled templates in ' + cache_path + ' are out of date')
+        environment = templating.create_environment(compiled_path=cache_path, undefined=AnyValue)
+    environment_ms = (time.time() - start) * 1000.0
+
+    names = [first_template] + [name for name in templating.get_template_names() if name != first_template]
+    render_times = []
+    for name in names:
+        render_start = time.time()
+        environment.get_template(name).render({})
+        render_times.append((time.time() - render_start) * 1000.0)
+    print(json.dumps({'environment_ms': environment_ms, 'first_ms': render_times[0], 'all_ms': sum(render_times)}))
+
+def _time_fresh_process(mode, cache_path, first_template):
+    """Runs the child in a new interpreter and returns its times"""
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', mode,
+                                      '--cache-path', cache_path, '--first', first_template])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark first render time on a fresh instance')
+    parser.add_argument('--runs', type=int, default=_DEFAULT_RUNS, help='fresh processes per setup')
+    parser.add_argument('--first', default=_DEFAULT_FIRST_TEMPLATE, help='the template the first request renders')
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument('--cache-path', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        _run_child(args.child, args.cache_path, args.first)
+        return 0
+
+    import jinja2
+    import templating
+    print('jinja2 ' + jinja2.__version__ + ', python ' + sys.version.split()[0] + ', median of %d fresh processes' % args.runs)
+    bytecode_path = tempfile.mkdtemp()
+    compiled_path = tempfile.mkdtemp()
+    try:
+        templating.compile_templates(compiled_path)
+        #fill the bytecode cache the way the first instance to render each template would
+        _time_fresh_process('bytecode', bytecode_path, args.first)
+        cache_paths = {'source': bytecode_path, 'bytecode': bytecode_path, 'compiled': compiled_path}
+
+        header = '%-10s %16s %16s %16s' % ('setup', 'environment ms', 'first render ms', 'all templates ms')
+        print(header)
+        print('-' * len(header))
+        for mode in MODES:
+            results = [_time_fresh_process(mode, cache_paths[mode], args.first) for run in range(args.runs)]
+            print('%-10s %16.2f %16.2f %16.2f' % (mode, _median([result['environment_ms'] for result in results]),
+                                                 _median([result['first_ms'] for result in results]),
+                                                 _median([result['all_ms'] for result in results])))
+    finally:
+        shutil.rmtree(bytecode_path)
+        shutil.rmtree(compiled_path)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
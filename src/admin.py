@@ -16,8 +16,8 @@
 #
 
 #Natively provided by python libraries
+import csv
 import json
-import random
 
 #Natively provided by app engine
 import google.appengine.ext.ndb as ndb
@@ -29,11 +29,24 @@ import webapp2
 #App specific includes
 import datamodel
 import constants
+import assignment
+import tasks
+import migrations
+import outbox
+import digests
 
 
 _DEFAULT_GIFT_EXCHANGE_NAME = datamodel.DEFAULT_GIFT_EXCHANGE_NAME
 _DEFAULT_DISPLAY_NAME = '<ENTER A NAME>'
-_DEFAULT_MAX_RESULTS = 200
+_EXPORT_BATCH_SIZE = 100
+_DELETE_BATCH_SIZE = 100
+_DELETE_TASK_URL = '/admin/tasks/delete'
+_MIGRATION_BATCH_SIZE = 50
+_MIGRATION_TASK_URL = '/admin/tasks/migrate'
+_OUTBOX_BATCH_SIZE = 50
+_DIGEST_BATCH_SIZE = 50
+_EXPORT_FORMATS = ['csv', 'json']
+_EXPORT_COLUMNS = ['key', 'display_name', 'family', 'email', 'target', 'is_target_known', 'previous_target', 'ideas', 'subscribed_to_updates']
 
 member_required = datamodel.member_required
 
@@ -51,34 +64,72 @@ def event_required(handler):
             return handler(self, *args, **kwargs)      
     return check_event
 
+@ndb.transactional
+def start_deletion(event):
+    """Starts a new run of the delete job for an event and queues its first task. The task is added in the same
+        transaction, so it only exists if the run does"""
+    job = datamodel.GiftExchangeDeleteJob.start_run(event)
+    tasks.enqueue(_DELETE_TASK_URL, {'job': job.key.urlsafe(), 'generation': str(job.generation)}, transactional=True)
+
+def get_history_exclusions(participant_list, exclusion_events):
+    """Builds the extra exclusions for the assignment engine from who members have given to in past events.
+        The whole history is loaded with a single batch get.
+        :returns:
+            A dictionary of display name to the display names that participant cannot give to
+    """
+    names_by_member = {}
+    for participant in participant_list:
+        if participant.member_key:
+            names_by_member.setdefault(participant.member_key, []).append(participant.display_name)
+    recent_recipients = datamodel.GiftExchangeMemberHistory.get_recent_recipients(names_by_member.keys(), exclusion_events)
+    exclusions = {}
+    for participant in participant_list:
+        excluded_names = []
+        for recipient_key in recent_recipients.get(participant.member_key, []):
+            excluded_names.extend(names_by_member.get(recipient_key, []))
+        exclusions[participant.display_name] = excluded_names
+    return exclusions
+
+def get_delete_jobs(gift_exchange_key):
+    """Returns the deletions that haven't finished, and the set of the keys of the events they are deleting.
+        Jobs are removed once their event is gone, so there are only ever a few"""
+    delete_job_list = datamodel.fetch_all(datamodel.GiftExchangeDeleteJob.get_all_jobs_query(gift_exchange_key))
+    return delete_job_list, set([job.event_key for job in delete_job_list])
+
 class AdminWebAppHandler(datamodel.BaseHandler):
     """A wrapper around webapp2.RequestHandler with a few convenience methods"""
     def get_event(self, *args, **kwargs):
-        """Gets an event from the get string event"""
-        event = None
-        try:
-            event_string = kwargs['event']
-            event_key = ndb.Key(urlsafe=event_string)
-            event = event_key.get()
-        except:
-            pass
-        return event
+        """Gets an event from the get string event. Only looked up once per request"""
+        event_string = kwargs.get('event')
+        def _load_event():
+            event = None
+            try:
+                event_key = datamodel.get_current_key(ndb.Key(urlsafe=event_string))
+                event = event_key.get()
+            except:
+                pass
+            return event
+        return self.get_request_cached(('event', event_string), _load_event)
 
 class HomeHandler(AdminWebAppHandler):
     """Handles the requests to the admin home page"""
     @member_required
     def get(self):
-        """Handles get requests to the admin home page - listing all available events"""
+        """Handles get requests to the admin home page - listing the first page of events.
+            admin.js loads any more pages from EventListHandler with the cursor"""
         google_user = google_authentication.get_current_user()
         gift_exchange_key = datamodel.get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME)
         datamodel.GiftExchangeMember.update_and_retrieve_member_by_google_user(gift_exchange_key, google_user)
         query = datamodel.GiftExchangeEvent.get_all_events_query(gift_exchange_key)
-        event_list = query.fetch(_DEFAULT_MAX_RESULTS) #maybe filter out the  events that have ended
+        event_list, event_cursor = datamodel.fetch_page(query) #maybe filter out the  events that have ended
+        delete_job_list, deleting_event_keys = get_delete_jobs(gift_exchange_key)
         not_started_events = []
         in_progress_events = []
         ended_events = []
         for event in event_list:
-            if event.has_ended:
+            if event.key in deleting_event_keys:
+                continue
+            elif event.has_ended:
                 ended_events.append(event)
             elif event.has_started:
                 in_progress_events.append(event)
@@ -88,6 +139,8 @@ class HomeHandler(AdminWebAppHandler):
                 'not_started_events': not_started_events,
                 'in_progress_events': in_progress_events,
                 'ended_events': ended_events,
+                'event_cursor': event_cursor or '',
+                'delete_jobs': delete_job_list,
                 'page_title': 'Administrative Dashboard',
             }
         self.add_template_values(template_values)
@@ -97,34 +150,48 @@ class EventHandler(AdminWebAppHandler):
     """Handles requests for updating a particular event, including the participants"""
     @member_required
     def get(self, *args, **kwargs):
-        """Handles get requests to the page that shows an administrative view of an event"""
+        """Handles get requests to the page that shows an administrative view of an event. The page has the first page
+            of members and participants, and event.js loads the rest from MemberListHandler and ParticipantListHandler"""
         #TODO: add javascript validation
         event_string =''
         event = self.get_event(*args, **kwargs)
         event_display_name = _DEFAULT_DISPLAY_NAME
         money_limit = ''
+        exclusion_events = 1
         participant_list = []
+        participant_cursor = None
         gift_exchange_key = datamodel.get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME)
         query = datamodel.GiftExchangeMember.get_all_members_query(gift_exchange_key)
-        member_list = query.fetch(_DEFAULT_MAX_RESULTS)
+        member_list, member_cursor = datamodel.fetch_page(query)
         has_started = False
         has_ended = False
         if event is not None:
             event_string = event.key.urlsafe()
             event_display_name = event.display_name
             money_limit = event.money_limit
+            exclusion_events = event.exclusion_events
             has_started = event.has_started
             has_ended = event.has_ended
             query = datamodel.GiftExchangeParticipant.get_participants_in_event_query(gift_exchange_key, event.key)
-            participant_list = query.fetch(_DEFAULT_MAX_RESULTS)
+            participant_list, participant_cursor = datamodel.fetch_page(query)
+            #the template shows each participant's member, so make sure they are all in the context cache
+            datamodel.prefetch(participant_list, 'member_key')
+        stamps = [event and event.key, event and event.time_updated, member_cursor, participant_cursor]
+        for entity in participant_list + member_list:
+            stamps.extend([entity.key, entity.time_updated])
+        if self.respond_if_not_modified(stamps):
+            return
         template_values = {
                 'event_string': event_string,
                 'event_display_name': event_display_name,
                 'has_started': has_started,
                 'has_ended': has_ended,
                 'money_limit': money_limit,
+                'exclusion_events': exclusion_events,
                 'participant_list': participant_list, #TODO: put in better selector, and probably default names
+                'participant_cursor': participant_cursor or '',
                 'member_list': member_list,
+                'member_cursor': member_cursor or '',
                 'page_title': 'Edit an event',
             }
         self.add_template_values(template_values)
@@ -133,37 +200,34 @@ class EventHandler(AdminWebAppHandler):
     @member_required
     def post(self, *args, **kwargs):
         """Handles updating a particular event, including the participants. Expects a JSON object."""
-        def _prune_participants(gift_exchange_key, event_key, name_index):
-            """Deletes any participants from a given event that aren't in the name_index"""
-            query = datamodel.GiftExchangeParticipant.get_participants_in_event_query(gift_exchange_key, event_key)
-            participant_list = query.fetch(_DEFAULT_MAX_RESULTS)
-            for participant in participant_list:
-                if participant.display_name in name_index:
-                    if ((participant.get_member().email_address != name_index[participant.display_name][0]) 
-                            or (participant.family != name_index[participant.display_name][1])):
-                        participant.key.delete()
-                else:
-                    participant.key.delete()
-            return
-        
         def _save_participants(gift_exchange_key, event_key, participant_list):
-            """Helper method for saving the participants in a particular event, including pruning participants"""
-            message = None
+            """Helper method for saving the participants in a particular event, including pruning participants.
+                Diffs the submitted list against the saved participants in memory, so the whole save is one query
+                for the participants, one batched member lookup, and one batch each of puts and deletes"""
             #There's likely a better way to check for duplicates, but this shouldn't happen
-            name_index = {}
+            name_index = set()
             for participant_object in participant_list:
                 temp_name = participant_object['display_name']
                 if temp_name in name_index:
                     return 'Duplicate name found: ' + temp_name
-                name_index[participant_object['display_name']] = (participant_object['email'], participant_object['family'])
+                name_index.add(temp_name)
+            member_index = datamodel.GiftExchangeMember.get_members_by_email(gift_exchange_key, [participant_object['email'] for participant_object in participant_list])
+            for participant_object in participant_list:
+                if participant_object['email'] not in member_index:
+                    return 'No member found with email: ' + participant_object['email']
+            query = datamodel.GiftExchangeParticipant.get_participants_in_event_query(gift_exchange_key, event_key)
+            existing_participants = {}
+            for participant in datamodel.fetch_all(query):
+                existing_participants[participant.display_name] = participant
+            changed_participants = []
             for participant_object in participant_list:
-                needs_saving = False
                 display_name = participant_object['display_name']
-                participant = datamodel.GiftExchangeParticipant.get_participant_by_name(gift_exchange_key, display_name, event_key)
+                participant = existing_participants.pop(display_name, None)
+                needs_saving = False
                 if participant is None:
-                    participant = datamodel.GiftExchangeParticipant.create_participant_by_name(gift_exchange_key, display_name, event_key)
+                    participant = datamodel.GiftExchangeParticipant(parent=event_key, display_name=display_name, event_key=event_key)
                     needs_saving = True
-                member = datamodel.GiftExchangeMember.get_member_by_email(gift_exchange_key, participant_object['email'])
+                member = member_index[participant_object['email']]
                 if participant.member_key != member.key:
                     participant.member_key = member.key
                     needs_saving = True
@@ -172,9 +236,14 @@ class EventHandler(AdminWebAppHandler):
                     participant.family = family
                     needs_saving = True
                 if needs_saving:
-                    participant.put()
-            _prune_participants(gift_exchange_key, event_key, name_index)
-            return message
+                    changed_participants.append(participant)
+            #anybody left over is no longer in the event
+            removed_keys = [participant.key for participant in existing_participants.values()]
+            futures = ndb.put_multi_async(changed_participants) + ndb.delete_multi_async(removed_keys)
+            ndb.Future.wait_all(futures)
+            for future in futures:
+                future.check_success()
+            return None
               
         data = json.loads(self.request.body)
         gift_exchange_key = datamodel.get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME)
@@ -183,11 +252,16 @@ class EventHandler(AdminWebAppHandler):
         needs_saving = False
         event_display_name = data['event_display_name']
         money_limit = data['money_limit']
+        exclusion_events = None
+        try:
+            exclusion_events = max(1, int(data.get('exclusion_events')))
+        except (TypeError, ValueError):
+            pass
         if ((event_display_name is None) or (event_display_name == '') or (event_display_name == _DEFAULT_DISPLAY_NAME)):
             message = 'You must select a valid display name'
         else:
             if event is None:
-                event = datamodel.GiftExchangeEvent(parent=gift_exchange_key)
+                event = datamodel.GiftExchangeEvent(gift_exchange_key=gift_exchange_key)
                 needs_saving = True
             if event.display_name != event_display_name:
                 event.display_name = event_display_name
@@ -196,6 +270,10 @@ class EventHandler(AdminWebAppHandler):
                 if event.money_limit != money_limit:
                     event.money_limit = money_limit
                     needs_saving = True
+            if exclusion_events:
+                if event.exclusion_events != exclusion_events:
+                    event.exclusion_events = exclusion_events
+                    needs_saving = True
             if needs_saving:
                 event.put()
             if not event.has_started: #maybe should return a message, but UI handles it
@@ -209,38 +287,184 @@ class DeleteHandler(AdminWebAppHandler):
     @event_required
     @member_required
     def post(self, *args, **kwargs):
-        """Takes a JSON request and deletes the event and all participants associated with it."""
-        gift_exchange_key = datamodel.get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME)
+        """Takes a JSON request and starts deleting the event and all participants associated with it in the background.
+            Posting again for an event that is already being deleted resumes the deletion."""
         event = self.get_event(*args, **kwargs)
-        participant_query = datamodel.GiftExchangeParticipant.get_participants_in_event_query(gift_exchange_key, event.key)
-        participant_list = participant_query.fetch(_DEFAULT_MAX_RESULTS)
-        for participant in participant_list:
-            message_query = datamodel.GiftExchangeMessage.get_messages_from_participant_query(gift_exchange_key, participant)
-            message_list = message_query.fetch(_DEFAULT_MAX_RESULTS*10)
-            for message in message_list:
-                message.key.delete()
-            participant.key.delete()
-        event.key.delete()
-        self.response.out.write(json.dumps(({'message': 'Successfully deleted.'})))
+        start_deletion(event)
+        self.response.out.write(json.dumps(({'message': 'Deletion started.'})))
+
+class DeleteTaskHandler(AdminWebAppHandler):
+    """Task that deletes an event one batch of participants at a time"""
+    @tasks.task_required
+    def post(self):
+        """Deletes the next batch for a delete job, then queues the task again if there is more to do.
+            A failure is saved on the job and the task is retried by the queue from the last saved cursor."""
+        gift_exchange_key = datamodel.get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME)
+        job = ndb.Key(urlsafe=self.request.get('job')).get()
+        #a task queued before jobs had generations reads as 0, which matches the job it was queued for
+        if job is None or job.generation != self.request.get_range('generation'):
+            #finished by an earlier run of this task, or the deletion was resumed and a newer run has taken over
+            return
+        try:
+            has_more = job.run_batch(gift_exchange_key, _DELETE_BATCH_SIZE)
+        except Exception as e:
+            job.record_error(str(e))
+            raise
+        if has_more:
+            tasks.enqueue(_DELETE_TASK_URL, {'job': job.key.urlsafe(), 'generation': str(job.generation)})
+
+class MigrationHandler(AdminWebAppHandler):
+    """Handles starting data migrations and checking on their progress"""
+    @member_required
+    def get(self, *args, **kwargs):
+        """Returns the progress of a migration as JSON"""
+        name = kwargs.get('name')
+        if name not in migrations.MIGRATIONS:
+            self.abort(404)
+        self.response.content_type = 'application/json'
+        self.response.out.write(json.dumps((migrations.get_migration(name).to_dictionary())))
+    
+    @member_required
+    def post(self, *args, **kwargs):
+        """Starts a migration in the background. Posting again resumes a migration that stopped after a failure"""
+        name = kwargs.get('name')
+        if name not in migrations.MIGRATIONS:
+            self.abort(404)
+        migration = migrations.get_migration(name)
+        if not migration.is_done:
+            tasks.enqueue(_MIGRATION_TASK_URL, {'name': name})
+        self.response.out.write(json.dumps((migration.to_dictionary())))
+
+class MigrationTaskHandler(AdminWebAppHandler):
+    """Task that runs a migration one batch at a time"""
+    @tasks.task_required
+    def post(self):
+        """Runs the next batch of a migration, then queues the task again if there is more to do"""
+        name = self.request.get('name')
+        if migrations.run_batch(name, _MIGRATION_BATCH_SIZE):
+            tasks.enqueue(_MIGRATION_TASK_URL, {'name': name})
+
+class OutboxTaskHandler(AdminWebAppHandler):
+    """Task that sends the emails waiting in the outbox"""
+    @tasks.task_required
+    def get(self):
+        """Handles the cron sweep, which picks up emails that are due to be retried"""
+        self._drain()
+    
+    @tasks.task_required
+    def post(self):
+        """Handles the drain tasks queued when emails are added to the outbox"""
+        self._drain()
+    
+    def _drain(self):
+        """Sends a batch of emails, then queues another task if there may be more"""
+        if outbox.drain_batch(_OUTBOX_BATCH_SIZE):
+            tasks.enqueue(outbox.DRAIN_TASK_URL)
+
+class DigestTaskHandler(AdminWebAppHandler):
+    """Task that sends the idea update digests whose window has closed"""
+    @tasks.task_required
+    def get(self):
+        """Handles the cron job that checks for digests every minute"""
+        self._send()
+    
+    @tasks.task_required
+    def post(self):
+        """Handles the follow up tasks when there are more digests than fit in one batch"""
+        self._send()
+    
+    def _send(self):
+        """Moves a batch of digests to the outbox, then queues another task if there may be more"""
+        if digests.send_due_digests(_DIGEST_BATCH_SIZE):
+            tasks.enqueue(digests.DIGEST_TASK_URL)
        
 class ReportHandler(AdminWebAppHandler):
     """Handles showing a report for all the data about a particular event."""
     @event_required
     @member_required
     def get(self, *args, **kwargs):
-        """Displays a report about a particular event."""
+        """Displays a report about a particular event, a page of participants at a time. Takes the cursor of the page
+            to show, which the page links to for the next one. The export has every participant in one file"""
         event = self.get_event(*args, **kwargs)
         gift_exchange_key = datamodel.get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME)
         query = datamodel.GiftExchangeParticipant.get_participants_in_event_query(gift_exchange_key, event.key)
-        participant_list = query.fetch(_DEFAULT_MAX_RESULTS)
+        participant_list, next_cursor = self.fetch_requested_page(query)
+        #the template shows each participant's member, so load them all in one batch into the context cache
+        member_index = datamodel.prefetch(participant_list, 'member_key')
+        stamps = [event.key, event.time_updated, self.request.get('cursor'), next_cursor]
+        for entity in participant_list + list(member_index.values()):
+            if entity is not None:
+                stamps.extend([entity.key, entity.time_updated])
+        if self.respond_if_not_modified(stamps):
+            return
         template_values = {
             'event': event,
+            'event_string': event.key.urlsafe(),
             'participant_list': participant_list,
+            'next_cursor': next_cursor,
             'page_title': 'Event Report',
         }
         self.add_template_values(template_values)
         self.render_template('report.html')
         
+class ExportHandler(AdminWebAppHandler):
+    """Handles exporting all the data about a particular event as CSV or JSON."""
+    @event_required
+    @member_required
+    def get(self, *args, **kwargs):
+        """Writes the report for every participant in an event as CSV or JSON, set by the format parameter.
+            The participants are walked in batches with a cursor, resolving the members for a batch at a time, so the
+            export has everyone however large the event is. webapp2 buffers the whole response before sending it,
+            so the finished file is held in memory, but only one batch of entities is loaded at a time."""
+        def _get_row(participant, member):
+            """Returns the exported values for a participant, in the order of _EXPORT_COLUMNS"""
+            email = None
+            subscribed_to_updates = None
+            if member is not None:
+                email = member.get_email_address()
+                subscribed_to_updates = member.subscribed_to_updates
+            return [participant.key.urlsafe(), participant.display_name, participant.family, email, participant.target,
+                    bool(participant.is_target_known), participant.previous_target, participant.idea_list, subscribed_to_updates]
+        
+        def _encode_csv_value(value):
+            """The csv module can't write unicode, so encode everything as utf-8"""
+            if value is None:
+                return ''
+            if isinstance(value, list):
+                value = '\n'.join(value)
+            return unicode(value).encode('utf-8')
+        
+        event = self.get_event(*args, **kwargs)
+        export_format = self.request.get('format', 'csv')
+        if export_format not in _EXPORT_FORMATS:
+            self.abort(400)
+        gift_exchange_key = datamodel.get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME)
+        query = datamodel.GiftExchangeParticipant.get_participants_in_event_query(gift_exchange_key, event.key)
+        file_name = 'report.' + export_format
+        if export_format == 'json':
+            self.response.content_type = 'application/json'
+        else:
+            self.response.content_type = 'text/csv'
+            csv_writer = csv.writer(self.response.out)
+            csv_writer.writerow(_EXPORT_COLUMNS)
+        self.response.headers['Content-Disposition'] = 'attachment; filename=' + file_name
+        if export_format == 'json':
+            self.response.out.write('[')
+        is_first_row = True
+        for participant_list in datamodel.iterate_pages(query, _EXPORT_BATCH_SIZE):
+            member_index = datamodel.prefetch(participant_list, 'member_key')
+            for participant in participant_list:
+                row = _get_row(participant, member_index.get(participant.member_key))
+                if export_format == 'json':
+                    if not is_first_row:
+                        self.response.out.write(',')
+                    self.response.out.write(json.dumps(dict(zip(_EXPORT_COLUMNS, row))))
+                else:
+                    csv_writer.writerow([_encode_csv_value(value) for value in row])
+                is_first_row = False
+        if export_format == 'json':
+            self.response.out.write(']')
+
 class InheritHandler(AdminWebAppHandler):
     """Handler for a particular event spawning a child event with the same defaults and previous targets filled in"""
     @event_required
@@ -249,20 +473,24 @@ class InheritHandler(AdminWebAppHandler):
         """Handles the get requests for inheriting an event"""
         parent_event = self.get_event(*args, **kwargs)
         gift_exchange_key = datamodel.get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME)
-        child_event = datamodel.GiftExchangeEvent(parent=gift_exchange_key)
+        child_event = datamodel.GiftExchangeEvent(gift_exchange_key=gift_exchange_key)
         child_event.display_name = 'Sequel to ' + parent_event.display_name
         child_event.money_limit = parent_event.money_limit
+        child_event.exclusion_events = parent_event.exclusion_events
         child_event.put()
         child_event_key = child_event.key
         query = datamodel.GiftExchangeParticipant.get_participants_in_event_query(gift_exchange_key, parent_event.key)
-        participant_list = query.fetch(_DEFAULT_MAX_RESULTS)
+        participant_list = datamodel.fetch_all(query)
+        #the new event's participants are all in its entity group, so save them with one batch write
+        new_participant_list = []
         for participant in participant_list:
-            display_name = participant.display_name
-            new_participant = datamodel.GiftExchangeParticipant.create_participant_by_name(gift_exchange_key, display_name, child_event_key)
-            new_participant.member_key = participant.member_key
-            new_participant.family = participant.family
-            new_participant.previous_target = participant.target
-            new_participant.put()
+            new_participant_list.append(datamodel.GiftExchangeParticipant(parent=child_event_key,
+                                                                          display_name=participant.display_name,
+                                                                          event_key=child_event_key,
+                                                                          member_key=participant.member_key,
+                                                                          family=participant.family,
+                                                                          previous_target=participant.target))
+        ndb.put_multi(new_participant_list)
         self.redirect(self.uri_for('event', event=child_event.key.urlsafe()))
 
 class StatusChangeHandler(AdminWebAppHandler):
@@ -272,86 +500,150 @@ class StatusChangeHandler(AdminWebAppHandler):
     def post(self, *args, **kwargs):
         """Post handler for starting or stopping an event. Expects a JSON object"""
         
-        def _is_valid_assignment(source_participant, target_participant):
-            """Returns whether source_participant can give to target_participant"""
-            #Cannot give to yourself
-            if source_participant.display_name == target_participant.display_name:
-                return False
-            #Cannot give to the person you gave to last year
-            if source_participant.previous_target == target_participant.display_name:
-                return False
-            #If you are in a family, cannot give to someone in your own family
-            if source_participant.family:
-                if source_participant.family == target_participant.family:
-                    return False
-            return True
-        
-        def _can_assign(source_participant, target_participant, need_to_give, need_a_giver):
-            """Returns where the source_participant can give to target_participant by checking if there is still a valid assignment scheme for other participants"""        
-            source_participant.target = target_participant.display_name
-            source_index = need_to_give.index(source_participant)
-            need_to_give.remove(source_participant)
-            target_index = need_a_giver.index(target_participant)
-            need_a_giver.remove(target_participant)
-    
-            if len(need_to_give) == 0:
-                return True
-            for giver in need_to_give:
-                found_possible_participant = False
-                for givee in need_a_giver:
-                    if _is_valid_assignment(giver, givee):
-                        found_possible_participant = True
-                        break
-                if not found_possible_participant:
-                    source_participant.target = None
-                    need_to_give.insert(source_index, source_participant)
-                    need_a_giver.insert(target_index, target_participant)
-                    return False
-                for givee in need_a_giver:
-                    if _is_valid_assignment(giver, givee):
-                        if _can_assign(giver, givee, need_to_give, need_a_giver):
-                            return True
-                        else:
-                            source_participant.target = None
-                            need_to_give.insert(source_index, source_participant)
-                            need_a_giver.insert(target_index, target_participant)
-            source_participant.target = None
-            need_to_give.insert(source_index, source_participant)
-            need_a_giver.insert(target_index, target_participant)
-            return False
-        
-        def _assign_participants(gift_exchange_key, event_key):
-            """Helper method for assigning targets to all participants in a given event."""
-            query = datamodel.GiftExchangeParticipant.get_participants_in_event_query(gift_exchange_key, event_key)
-            participant_list = query.fetch(_DEFAULT_MAX_RESULTS)
+        def _assign_participants(gift_exchange_key, event):
+            """Helper method for assigning targets to all participants in a given event.
+                Returns False if there is no valid way to assign the participants"""
+            query = datamodel.GiftExchangeParticipant.get_participants_in_event_query(gift_exchange_key, event.key)
+            participant_list = datamodel.fetch_all(query)
             if len(participant_list) == 0:
-                return
-            need_to_give = list(participant_list)
-            need_a_giver = list(participant_list)
-            #randomize list and then brute force for acceptable assignment
-            random.shuffle(need_to_give)
-            random.shuffle(need_a_giver)
-            source_participant = need_to_give[0]
-            for target_participant in need_a_giver:
-                if _is_valid_assignment(source_participant, target_participant):
-                    if _can_assign(source_participant, target_participant, need_to_give, need_a_giver):
-                        break
-            #Save all participants
+                return True
+            exclusions = get_history_exclusions(participant_list, event.exclusion_events)
+            target_index = assignment.find_assignment(participant_list, exclusions=exclusions)
+            if target_index is None:
+                return False
+            #the pointers go both ways, so finding a target or a giver is a key lookup rather than a query by name
+            participant_index = dict([(participant.display_name, participant) for participant in participant_list])
             for participant in participant_list:
-                participant.put()
-            return
+                target_participant = participant_index[target_index[participant.display_name]]
+                participant.target = target_participant.display_name
+                participant.target_key = target_participant.key
+                target_participant.giver_key = participant.key
+                participant.is_event_active = True
+            ndb.put_multi(participant_list)
+            return True
     
         data = json.loads(self.request.body)
         status_change_type = data['status_change_type']
         event = self.get_event(*args, **kwargs)
+        gift_exchange_key = datamodel.get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME)
+        message = 'Event successfully updated'
+        success = True
         if status_change_type == 'start':
-            _assign_participants(datamodel.get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME), event.key)
-            event.has_started = True
-            event.put()
+            if _assign_participants(gift_exchange_key, event):
+                event.has_started = True
+                event.put()
+            else:
+                message = 'There is no valid assignment for these participants. Check the families and previous targets.'
+                success = False
         if status_change_type == 'stop':
             event.has_ended = True
             event.put()
-        self.response.out.write(json.dumps(({'message': 'Event successfully updated', 'event_string': event.key.urlsafe()})))
+            query = datamodel.GiftExchangeParticipant.get_participants_in_event_query(gift_exchange_key, event.key)
+            participant_list = datamodel.fetch_all(query)
+            event.update_participant_status(participant_list)
+            datamodel.GiftExchangeMemberHistory.record_event(event.key, participant_list)
+        self.response.out.write(json.dumps(({'message': message, 'success': success, 'event_string': event.key.urlsafe()})))
+
+class EventListHandler(AdminWebAppHandler):
+    """Handles paged JSON requests for the list of events"""
+    @member_required
+    def get(self):
+        """Returns one page of events. Takes optional cursor and page_size parameters"""
+        gift_exchange_key = datamodel.get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME)
+        query = datamodel.GiftExchangeEvent.get_all_events_query(gift_exchange_key)
+        deleting_event_keys = get_delete_jobs(gift_exchange_key)[1]
+        self.write_page(query, lambda event: {
+                'event_string': event.key.urlsafe(),
+                'display_name': event.display_name,
+                'has_started': event.has_started,
+                'has_ended': event.has_ended,
+                'is_being_deleted': event.key in deleting_event_keys,
+            })
+
+class MemberListHandler(AdminWebAppHandler):
+    """Handles paged JSON requests for the list of members"""
+    @member_required
+    def get(self):
+        """Returns one page of members. Takes optional cursor and page_size parameters"""
+        gift_exchange_key = datamodel.get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME)
+        query = datamodel.GiftExchangeMember.get_all_members_query(gift_exchange_key)
+        self.write_page(query, lambda member: {
+                'member_string': member.key.urlsafe(),
+                'first_name': member.first_name,
+                'last_name': member.last_name,
+                'email': member.get_email_address(),
+            })
+
+class ParticipantListHandler(AdminWebAppHandler):
+    """Handles paged JSON requests for the participants in an event"""
+    @event_required
+    @member_required
+    def get(self, *args, **kwargs):
+        """Returns one page of participants, with their members' email addresses. Takes optional cursor and page_size parameters"""
+        def _get_email(participant):
+            """Returns the email address of a participant's member, which the page has already loaded"""
+            member = participant.member_key and participant.get_member()
+            return member and member.get_email_address()
+        
+        event = self.get_event(*args, **kwargs)
+        gift_exchange_key = datamodel.get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME)
+        query = datamodel.GiftExchangeParticipant.get_participants_in_event_query(gift_exchange_key, event.key)
+        self.write_page(query, lambda participant: {
+                'participant_string': participant.key.urlsafe(),
+                'display_name': participant.display_name,
+                'family': participant.family,
+                'member_string': participant.member_key.urlsafe() if participant.member_key else None,
+                'email': _get_email(participant),
+                'target': participant.target,
+                'is_target_known': bool(participant.is_target_known),
+                'previous_target': participant.previous_target,
+            }, 'member_key')
+
+class FeasibilityHandler(AdminWebAppHandler):
+    """Handler for checking whether the participants being edited can be assigned, before an event is started"""
+    @member_required
+    def post(self, *args, **kwargs):
+        """Takes a JSON list of participants and reports whether a valid assignment exists, and what blocks it if not"""
+        data = json.loads(self.request.body)
+        gift_exchange_key = datamodel.get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME)
+        event = self.get_event(*args, **kwargs)
+        saved_participants = {}
+        exclusion_events = 1
+        if event is not None:
+            #previous targets aren't editable, so they come from the saved participants
+            query = datamodel.GiftExchangeParticipant.get_participants_in_event_query(gift_exchange_key, event.key)
+            for participant in datamodel.fetch_all(query):
+                saved_participants[participant.display_name] = participant
+            exclusion_events = event.exclusion_events
+        #members come from the emails in the rows, as they will when the list is saved, so new and edited rows get their history too
+        member_index = datamodel.GiftExchangeMember.get_members_by_email(gift_exchange_key,
+                                                                         [participant_object.get('email') for participant_object in data['participant_list']
+                                                                          if participant_object.get('email')])
+        participant_list = []
+        for participant_object in data['participant_list']:
+            display_name = participant_object['display_name']
+            participant = datamodel.GiftExchangeParticipant(display_name=display_name, family=participant_object['family'])
+            if display_name in saved_participants:
+                participant.previous_target = saved_participants[display_name].previous_target
+            member = member_index.get(participant_object.get('email'))
+            if member is not None:
+                participant.member_key = member.key
+            participant_list.append(participant)
+        exclusions = get_history_exclusions(participant_list, exclusion_events)
+        blocking_list = assignment.find_blocking_participants(participant_list, exclusions)
+        blocking_groups = []
+        for participant in blocking_list:
+            group = participant.family or participant.display_name
+            if group not in blocking_groups:
+                blocking_groups.append(group)
+        message = ''
+        if blocking_list:
+            message = 'No valid assignment exists. These participants have too few people they can give to: '
+            message = message + ', '.join(participant.display_name for participant in blocking_list)
+        self.response.out.write(json.dumps(({'feasible': len(blocking_list) == 0,
+                                             'message': message,
+                                             'blocking_groups': blocking_groups,
+                                             'blocking_participants': [participant.display_name for participant in blocking_list]})))
 
 config = {
   'webapp2_extras.auth': {
@@ -369,6 +661,17 @@ app = webapp2.WSGIApplication([
     webapp2.Route('/admin/event/<event:.+>', handler=EventHandler, name='event'),
     webapp2.Route('/admin/inherit/<event:.+>', handler=InheritHandler),
     webapp2.Route('/admin/statuschange/<event:.+>', handler=StatusChangeHandler),
+    webapp2.Route('/admin/api/events', handler=EventListHandler),
+    webapp2.Route('/admin/api/members', handler=MemberListHandler),
+    webapp2.Route('/admin/api/participants/<event:.+>', handler=ParticipantListHandler),
+    webapp2.Route('/admin/feasibility/', handler=FeasibilityHandler),
+    webapp2.Route('/admin/feasibility/<event:.+>', handler=FeasibilityHandler),
     webapp2.Route('/admin/delete/<event:.+>', handler=DeleteHandler),
-    webapp2.Route('/admin/report/<event:.+>', handler=ReportHandler)
+    webapp2.Route(_DELETE_TASK_URL, handler=DeleteTaskHandler),
+    webapp2.Route('/admin/migrate/<name:.+>', handler=MigrationHandler),
+    webapp2.Route(_MIGRATION_TASK_URL, handler=MigrationTaskHandler),
+    webapp2.Route(outbox.DRAIN_TASK_URL, handler=OutboxTaskHandler),
+    webapp2.Route(digests.DIGEST_TASK_URL, handler=DigestTaskHandler),
+    webapp2.Route('/admin/report/<event:.+>', handler=ReportHandler),
+    webapp2.Route('/admin/export/<event:.+>', handler=ExportHandler)
 ], debug=False, config=config)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Assignment engine for deciding who gives to whom in an event.
+
+Finding targets is a perfect matching problem on the bipartite graph of givers and
+receivers, where an edge exists whenever is_valid_assignment allows it. Since the
+only exclusions are yourself, your family and last year's target, the graph is
+nearly complete and a valid matching can be built directly:
+    1. Lay the family groups out end to end in a random order and have everybody
+       give to the person max_family_size positions further along. No group is
+       larger than the shift, so nobody lands in their own family.
+    2. Randomize the result by repeatedly swapping the targets of two random givers
+       whenever both new pairings are still valid.
+    3. Repair anybody left pointing at an excluded target with augmenting paths,
+       which also proves when no valid assignment exists at all.
+This runs in roughly linear time, instead of the exponential search it replaces.
+
+When no assignment exists, the search also produces the reason. Either one family is
+larger than everybody outside it, or the last failed augmenting path reached a set of
+givers that between them can only give to fewer people than there are givers. By
+Hall's theorem those givers are exactly what blocks the assignment.
+"""
+
+#Natively provided by python libraries
+import random
+
+
+_SHUFFLE_ROUNDS = 8
+_REPAIR_ATTEMPTS = 32
+
+def is_valid_assignment(source_participant, target_participant):
+    """Returns whether source_participant can give to target_participant"""
+    #Cannot give to yourself
+    if source_participant.display_name == target_participant.display_name:
+        return False
+    #Cannot give to the person you gave to last year
+    if source_participant.previous_target == target_participant.display_name:
+        return False
+    #If you are in a family, cannot give to someone in your own family
+    if source_participant.family:
+        if source_participant.family == target_participant.family:
+            return False
+    return True
+
+class _AssignmentGraph(object):
+    """Index based view of the participants, so validity checks don't need to touch the entities"""
+    def __init__(self, participant_list, exclusions=None):
+        self.participant_list = list(participant_list)
+        self.size = len(self.participant_list)
+        name_index = {}
+        for index, participant in enumerate(self.participant_list):
+            name_index[participant.display_name] = index
+        self.excluded = []
+        self.group = []
+        group_index = {}
+        for index, participant in enumerate(self.participant_list):
+            excluded_names = [participant.previous_target]
+            if exclusions:
+                excluded_names.extend(exclusions.get(participant.display_name, []))
+            self.excluded.append(set(name_index[name] for name in excluded_names if name in name_index))
+            #Participants without a family are only excluded from themselves, so they get a group of their own
+            if participant.family:
+                key = ('family', participant.family)
+            else:
+                key = ('single', index)
+            if key not in group_index:
+                group_index[key] = len(group_index)
+            self.group.append(group_index[key])
+        self.group_members = [[] for _ in range(len(group_index))]
+        for index, group in enumerate(self.group):
+            self.group_members[group].append(index)
+
+    def is_valid(self, giver, target):
+        """Returns whether giver can give to target, using participant indexes"""
+        if self.group[giver] == self.group[target]:
+            return False
+        if target in self.excluded[giver]:
+            return False
+        return True
+
+    def get_largest_group(self):
+        """Returns the indexes of the participants in the largest family"""
+        return max(self.group_members, key=len)
+
+    def build_initial_assignment(self, rng):
+        """Returns a list of targets indexed by giver that respects families, or None if no such list exists"""
+        largest_group = len(self.get_largest_group())
+        if largest_group > self.size - largest_group:
+            return None
+        order = []
+        groups = list(self.group_members)
+        rng.shuffle(groups)
+        for members in groups:
+            members = list(members)
+            rng.shuffle(members)
+            order.extend(members)
+        targets = [None] * self.size
+        for position, giver in enumerate(order):
+            targets[giver] = order[(position + largest_group) % self.size]
+        return targets
+
+    def shuffle_assignment(self, targets, rng):
+        """Randomizes a valid assignment in place by swapping targets between random givers"""
+        for _ in range(self.size * _SHUFFLE_ROUNDS):
+            first = rng.randrange(self.size)
+            second = rng.randrange(self.size)
+            if first == second:
+                continue
+            if self.is_valid(first, targets[second]) and self.is_valid(second, targets[first]):
+                targets[first], targets[second] = targets[second], targets[first]
+        return
+
+    def repair_assignment(self, targets, rng):
+        """Fixes any invalid pairings left in an assignment.
+            Returns an empty list on success, otherwise the indexes of the givers that cannot all be assigned"""
+        unassigned = []
+        for giver in range(self.size):
+            if self.is_valid(giver, targets[giver]):
+                continue
+            #Most conflicts can be resolved with a single swap
+            for _ in range(_REPAIR_ATTEMPTS):
+                other = rng.randrange(self.size)
+                if self.is_valid(giver, targets[other]) and self.is_valid(other, targets[giver]):
+                    targets[giver], targets[other] = targets[other], targets[giver]
+                    break
+            else:
+                unassigned.append(giver)
+        if not unassigned:
+            return []
+        for giver in unassigned:
+            targets[giver] = None
+        giver_of = [None] * self.size
+        for giver in range(self.size):
+            if targets[giver] is not None:
+                giver_of[targets[giver]] = giver
+        for giver in unassigned:
+            blocking = self._augment(giver, targets, giver_of)
+            if blocking:
+                return blocking
+        return []
+
+    def _augment(self, start, targets, giver_of):
+        """Searches for an augmenting path from an unassigned giver and applies it if found.
+            Returns an empty list on success, otherwise the givers reached by the search"""
+        parent = {start: None}
+        unvisited = set(range(self.size))
+        queue = [start]
+        while queue:
+            next_queue = []
+            for giver in queue:
+                for target in list(unvisited):
+                    if not self.is_valid(giver, target):
+                        continue
+                    unvisited.discard(target)
+                    holder = giver_of[target]
+                    if holder is None:
+                        #Flip every pairing along the path back to the start
+                        while giver is not None:
+                            previous = targets[giver]
+                            targets[giver] = target
+                            giver_of[target] = giver
+                            target = previous
+                            giver = parent[giver]
+                        return []
+                    if holder not in parent:
+                        parent[holder] = giver
+                        next_queue.append(holder)
+            queue = next_queue
+        return sorted(parent)
+
+def _solve(participant_list, rng, exclusions):
+    """Runs the assignment for a list of participants
+        :returns:
+            A tuple of a dictionary of display name to target display name (or None if no valid
+            assignment exists) and the list of participants blocking the assignment
+    """
+    graph = _AssignmentGraph(participant_list, exclusions)
+    if graph.size == 0:
+        return {}, []
+    if graph.size == 1:
+        return None, list(graph.participant_list)
+    targets = graph.build_initial_assignment(rng)
+    if targets is None:
+        blocking = graph.get_largest_group()
+    else:
+        graph.shuffle_assignment(targets, rng)
+        blocking = graph.repair_assignment(targets, rng)
+    if blocking:
+        return None, [graph.participant_list[index] for index in blocking]
+    assignment = {}
+    for giver, target in enumerate(targets):
+        assignment[graph.participant_list[giver].display_name] = graph.participant_list[target].display_name
+    return assignment, []
+
+def find_assignment(participant_list, rng=None, exclusions=None):
+    """Finds a random valid assignment for a list of participants
+        :param participant_list:
+            The participants in an event
+        :param rng:
+            An optional random.Random instance, mostly useful for repeatable runs
+        :param exclusions:
+            An optional dictionary of display name to the display names that participant
+            cannot give to, on top of their previous_target
+        :returns:
+            A dictionary of display name to target display name, or None if no valid assignment exists
+    """
+    if rng is None:
+        rng = random.Random()
+    return _solve(participant_list, rng, exclusions)[0]
+
+def find_blocking_participants(participant_list, exclusions=None):
+    """Checks whether a list of participants can be assigned at all
+        :param participant_list:
+            The participants in an event. Only display_name, family and previous_target are used
+        :param exclusions:
+            The same optional dictionary of extra exclusions that find_assignment takes
+        :returns:
+            An empty list if a valid assignment exists. Otherwise a list of participants who between
+            them have fewer people left to give to than there are of them
+    """
+    return _solve(participant_list, random.Random(), exclusions)[1]
@@ -16,37 +16,63 @@
 #
 
 #Natively provided by python libraries
+import collections
 import datetime
+import hashlib
+import json
 import os
+import threading
 import time
-import re
 
 #Natively provided by app engine
 import google.appengine.ext.ndb as ndb
 import google.appengine.api.users as google_authentication
+import google.appengine.api.memcache as memcache
+import google.appengine.datastore.datastore_query as datastore_query
 
 #Includes specified by the app.yaml
 import webapp2
-import jinja2
 import webapp2_extras.auth
-import webapp2_extras.sessions
 import webapp2_extras.appengine.auth.models
 import webapp2_extras.security
 
-#Included third party libraries distributed with the project
-import bleach
+#App specific includes
+import linkify
+
+#jinja2, bleach and webapp2 sessions are slow to import, so they are imported on first use rather than when
+#the handler modules load. The warmup request gets them all loaded before an instance serves real traffic
 
 
 #constants
 MESSAGE_TYPE_TO_TARGET = 1
 MESSAGE_TYPE_TO_GIVER = 2
+DEFAULT_PAGE_SIZE = 200
 DEFAULT_GIFT_EXCHANGE_NAME = 'playground'
-_urlfinderregex = re.compile(r'http([^\.\s]+\.[^\.\s]*)+[^\.\s]{2,}')
+MAX_HISTORY_ENTRIES = 20
+SANITIZER_VERSION = 1 #bump whenever free_text_to_safe_html_markup changes, then run the matching backfill migration
+IDEA_MAX_LINK_LENGTH = 60
+MESSAGE_MAX_LINK_LENGTH = 100
+_MAX_IN_FILTER_VALUES = 30 #the datastore limit for values in a single IN filter
+_MEMBER_CACHE_SIZE = 1000
+_MEMBER_CACHE_TIME = 60 * 60 * 24
+_TEMPLATE_CACHE_TIME = 60 * 60 * 24
+
+_WARMUP_TEXT = 'Warming up <b>the sanitizer</b> with a link to http://www.example.com/warmup.html\nand a second line'
+_jinja_environment = None
+_jinja_environment_lock = threading.Lock()
 
-_JINJA_ENVIRONMENT = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(os.path.join(os.path.dirname(__file__),'templates')),
-    extensions=['jinja2.ext.autoescape'],
-    autoescape=True)
+def get_jinja_environment():
+    """Returns the jinja environment, creating it on first use. Templates that weren't precompiled
+        are compiled once and shared with other instances through memcache"""
+    global _jinja_environment
+    if _jinja_environment is None:
+        with _jinja_environment_lock:
+            if _jinja_environment is None:
+                import jinja2
+                import templating
+                _jinja_environment = templating.create_environment(
+                    bytecode_cache=jinja2.MemcachedBytecodeCache(memcache, prefix='jinja2/bytecode/', timeout=_TEMPLATE_CACHE_TIME))
+    return _jinja_environment
 
 def member_required(handler):
     """
@@ -60,8 +86,161 @@ def member_required(handler):
             return handler(self, *args, **kwargs)
     return check_login
 
+def _time_to_cursor(time_value):
+    """Encodes a time as an opaque cursor string"""
+    delta = time_value - datetime.datetime(1970, 1, 1)
+    return str((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+def _cursor_to_time(cursor_string):
+    """Decodes a cursor string made by _time_to_cursor. Raises ValueError if the cursor is invalid"""
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(microseconds=int(cursor_string))
+
+class LruCache(object):
+    """A small thread safe, bounded cache that evicts the least recently used entries"""
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Returns the cached value, or None if there isn't one"""
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is not None:
+                self._items[key] = value
+            return value
+    
+    def set(self, key, value):
+        """Caches a value, evicting the oldest entry if the cache is full"""
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+    
+    def delete(self, key):
+        """Removes a value from the cache"""
+        with self._lock:
+            self._items.pop(key, None)
+
+#Maps user ids and google ids to member keys. The in-process cache sits in front of memcache, and since other
+#instances can't be invalidated directly, every hit is checked against the member before it is used
+_MEMBER_KEY_CACHE = LruCache(_MEMBER_CACHE_SIZE)
+_DELETED_MEMBER_CACHE_KEYS = {} #member key to its cache keys, from the pre delete hook to the post delete hook
+
+def _get_member_cache_key(id_type, id_value):
+    """Returns the cache key for looking up a member by a particular type of id"""
+    return 'GiftExchangeMember:' + id_type + ':' + unicode(id_value)
+
+def _get_cached_member_key(cache_key):
+    """Gets a member key from the in-process cache, falling back to memcache. Returns None on a miss"""
+    urlsafe = _MEMBER_KEY_CACHE.get(cache_key)
+    if urlsafe is None:
+        urlsafe = memcache.get(cache_key)
+        if urlsafe is None:
+            return None
+        _MEMBER_KEY_CACHE.set(cache_key, urlsafe)
+    return ndb.Key(urlsafe=urlsafe)
+
+def _set_cached_member_key(cache_key, member_key):
+    """Writes a member key to both cache tiers"""
+    urlsafe = member_key.urlsafe()
+    _MEMBER_KEY_CACHE.set(cache_key, urlsafe)
+    memcache.set(cache_key, urlsafe, time=_MEMBER_CACHE_TIME)
+
+def _invalidate_member_cache(cache_key_list):
+    """Removes member keys from both cache tiers"""
+    for cache_key in cache_key_list:
+        _MEMBER_KEY_CACHE.delete(cache_key)
+    memcache.delete_multi(cache_key_list)
+
+def fetch_page(query, page_size=DEFAULT_PAGE_SIZE, cursor_string=None, **query_options):
+    """Fetches one page of results from a query
+        :param query:
+            An ndb query, typically from one of the get_*_query helpers
+        :param page_size:
+            The maximum number of results to return
+        :param cursor_string:
+            An opaque cursor returned by a previous call, or None to start at the beginning
+        :param query_options:
+            Any other ndb query options, such as keys_only
+        :returns:
+            A tuple of the list of results and the cursor for the next page, which is None on the last page
+    """
+    start_cursor = None
+    if cursor_string:
+        start_cursor = datastore_query.Cursor(urlsafe=cursor_string)
+    results, next_cursor, more = query.fetch_page(page_size, start_cursor=start_cursor, **query_options)
+    if more and next_cursor:
+        return results, next_cursor.urlsafe()
+    return results, None
+
+def iterate_pages(query, page_size=DEFAULT_PAGE_SIZE, **query_options):
+    """Walks through every result of a query with cursors, yielding one list of results per page"""
+    cursor_string = None
+    while True:
+        results, cursor_string = fetch_page(query, page_size, cursor_string, **query_options)
+        if results:
+            yield results
+        if cursor_string is None:
+            return
+
+def fetch_all(query, page_size=DEFAULT_PAGE_SIZE):
+    """Fetches every result of a query a page at a time, rather than stopping at a fixed limit"""
+    results = []
+    for page in iterate_pages(query, page_size):
+        results.extend(page)
+    return results
+
+def _get_referenced_keys(entity, property_name):
+    """Returns the keys a KeyProperty of an entity holds, as a list whether or not the property is repeated"""
+    value = getattr(entity, property_name, None)
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [key for key in value if key is not None]
+    return [value]
+
+def prefetch(entity_list, *paths):
+    """Loads the entities that a list of entities refer to through KeyProperty fields, so that following the references
+        afterwards, such as participant.get_member() in a template, is served from the context cache. The keys at each
+        depth of every path are fetched together in one get_multi, so a list costs one batch per level whatever its size
+        :param entity_list:
+            The entities to start from. None entries are skipped
+        :param paths:
+            The properties to follow, with a dot between hops, such as 'event_key' or 'giver_key.member_key'
+        :returns:
+            A dictionary of every key that was followed to its entity, which is None if it doesn't exist
+    """
+    hop_lists = [path.split('.') for path in paths]
+    source_lists = [list(entity_list) for hop_list in hop_lists]
+    entity_index = {}
+    depth = 0
+    while any([depth < len(hop_list) for hop_list in hop_lists]):
+        level_keys = []
+        for hop_list, source_list in zip(hop_lists, source_lists):
+            if depth < len(hop_list):
+                for entity in source_list:
+                    level_keys.extend(_get_referenced_keys(entity, hop_list[depth]))
+        level_keys = list(set([key for key in level_keys if key not in entity_index]))
+        entity_index.update(zip(level_keys, ndb.get_multi(level_keys)))
+        for index, hop_list in enumerate(hop_lists):
+            if depth < len(hop_list):
+                source_lists[index] = [entity_index[key] for entity in source_lists[index] if entity is not None
+                                       for key in _get_referenced_keys(entity, hop_list[depth])]
+        depth = depth + 1
+    return entity_index
+
 def get_gift_exchange_key(gift_exchange_name):
-    """Returns the default key that all data is stored under"""
+    """Returns the key that identifies a gift exchange.
+        Data used to be stored under this key, which made the whole site a single entity group. Now members and
+        events are root entities that point back to it with a gift_exchange_key property, participants are stored
+        under their event and messages under their conversation, so writes only contend within an event.
+        Lookups by key and queries inside an event or conversation are strongly consistent. Queries across an
+        exchange (members by email or login, the event list, a member's participants) are eventually consistent,
+        so anything that needs to read its own writes goes through a key: members found by login are kept in the
+        member cache, members found by email for an event go through their email pointers, and participants are
+        found by name with a query inside their event"""
     return ndb.Key('GiftExchange', gift_exchange_name)
 
 def free_text_to_safe_html_markup(text, max_link_length):
@@ -73,38 +252,45 @@ def free_text_to_safe_html_markup(text, max_link_length):
         :returns:
             A string of HTML
         """
-    def replace_with_link(matchobj):
-        url = matchobj.group(0)
-        text = unicode(url)
-        if text.startswith('http://'):
-            text = text.replace('http://', '', 1)
-        elif text.startswith('https://'):
-            text = text.replace('https://', '', 1)
-
-        if text.startswith('www.'):
-            text = text.replace('www.', '', 1)
-
-        if len(text) > max_link_length:
-            half_length = max_link_length / 2
-            text = text[0:half_length] + '...' + text[len(text) - half_length:]
-
-        return '<a class="comurl" href="' + url + '" target="_blank" rel="nofollow">' + text + '<img class="imglink" src="/media/images/linkout.png"></a>'
-
     if text != None and text != '':
-        text = bleach.clean(text)
-        text = _urlfinderregex.sub(replace_with_link, text)
+        text = clean_text(text)
+        text = linkify.linkify(text, max_link_length)
         return text.replace('\n', '<br />')
     return ''
 
+def clean_text(text):
+    """Escapes any markup in a string of user entered text other than the few tags bleach allows"""
+    import bleach
+    return bleach.clean(text)
+
+def warm_up(app):
+    """Does the slow parts of a new instance's first requests ahead of time. Imports the deferred libraries,
+        loads every template, runs the sanitizer once, and sets up the auth store, which loads the user model.
+        The member key cache fills from memcache as members log in, since memcache is shared with other instances
+        :param app:
+            The WSGI application the warmup request came in on
+    """
+    import templating
+    import webapp2_extras.sessions
+    jinja_environment = get_jinja_environment()
+    for template_name in templating.get_template_names():
+        jinja_environment.get_template(template_name)
+    free_text_to_safe_html_markup(_WARMUP_TEXT, MESSAGE_MAX_LINK_LENGTH)
+    #the store only imports the user model named in the config when it is first asked for it
+    webapp2_extras.auth.get_store(app=app).user_model
+
 class BaseHandler(webapp2.RequestHandler):
     """A wrapper about webapp2.RequestHandler with customized methods"""
     def __init__(self, *args, **kwargs):
         super(BaseHandler, self).__init__(*args, **kwargs)
+        self._request_cache = {}
         self._my_templates = {}
         self._my_templates['page_title'] =  'Gift Exchange Central' #set default page title
-        self._my_templates['is_admin_user'] = google_authentication.is_current_user_admin()
         self._my_templates['logout_url'] = '/logout'
-        self._my_templates['logged_in_member'] = self.get_gift_exchange_member()
+        #values that need a lookup are only resolved when a template is rendered, so JSON requests skip them
+        self._lazy_templates = {}
+        self._lazy_templates['is_admin_user'] = google_authentication.is_current_user_admin
+        self._lazy_templates['logged_in_member'] = self.get_gift_exchange_member
     
     def add_template_values(self, template_values):
         """Adds a list of templates to the array"""
@@ -114,7 +300,10 @@ class BaseHandler(webapp2.RequestHandler):
     
     def render_template(self, template):
         """Renders a remplate with the built up list of values"""
-        self.response.write(_JINJA_ENVIRONMENT.get_template(template).render(self._my_templates))
+        for key in self._lazy_templates:
+            if key not in self._my_templates:
+                self._my_templates[key] = self._lazy_templates[key]()
+        self.response.write(get_jinja_environment().get_template(template).render(self._my_templates))
         
     @webapp2.cached_property
     def auth(self):
@@ -162,6 +351,7 @@ class BaseHandler(webapp2.RequestHandler):
     # this is needed for webapp2 sessions to work
     def dispatch(self):
         # Get a session store for this request.
+        import webapp2_extras.sessions
         self.session_store = webapp2_extras.sessions.get_store(request=self.request)
 
         try:
@@ -171,17 +361,93 @@ class BaseHandler(webapp2.RequestHandler):
             # Save all sessions.
             self.session_store.save_sessions(self.response)
 
+    def fetch_requested_page(self, query):
+        """Fetches the page of a query named by the cursor and page_size request parameters, answering with 400 if
+            they aren't valid
+            :returns:
+                A tuple of the results and the cursor for the next page, which is None on the last page
+        """
+        try:
+            page_size = min(int(self.request.get('page_size', DEFAULT_PAGE_SIZE)), DEFAULT_PAGE_SIZE)
+            results, cursor_string = fetch_page(query, page_size, self.request.get('cursor') or None)
+        except:
+            results = None
+        if results is None:
+            self.abort(400)
+        return results, cursor_string
+
+    def write_page(self, query, to_dictionary, *prefetch_paths):
+        """Writes one page of a query as JSON, using the cursor and page_size request parameters.
+            The response has the list of items and the cursor for the next page, which is null on the last page.
+            :param query:
+                The query to page through
+            :param to_dictionary:
+                A function that turns one result into a JSON serializable dictionary
+            :param prefetch_paths:
+                Any references that to_dictionary follows, loaded for the whole page with prefetch first
+        """
+        results, cursor_string = self.fetch_requested_page(query)
+        if prefetch_paths:
+            prefetch(results, *prefetch_paths)
+        self.response.content_type = 'application/json'
+        self.response.out.write(json.dumps(({'items': [to_dictionary(result) for result in results], 'cursor': cursor_string})))
+
+    def respond_if_not_modified(self, stamps):
+        """Sets the validators for a page built from a list of change stamps, and answers with 304 Not Modified
+            if the client's copy is still current. The app version, the logged in member and whether they are an
+            admin are always included, since every page shows them. Only the ETag is checked. Deleting something
+            doesn't make any of the remaining times newer, so If-Modified-Since would keep a stale copy current
+            :param stamps:
+                Values that change whenever anything shown on the page does, such as keys and time_updated.
+                The newest of the datetimes is sent as Last-Modified, for information only
+            :returns:
+                True if the 304 was sent, in which case the handler should stop
+        """
+        member = self.get_gift_exchange_member()
+        stamps = [os.environ.get('CURRENT_VERSION_ID'), google_authentication.is_current_user_admin(),
+                  member and member.key, member and member.time_updated] + list(stamps)
+        etag = hashlib.sha1(repr(stamps)).hexdigest()
+        times = [stamp for stamp in stamps if isinstance(stamp, datetime.datetime)]
+        last_modified = None
+        if times:
+            last_modified = max(times).replace(microsecond=0)
+        #the pages are per member, so only the browser may keep a copy, and it has to check it every time
+        self.response.cache_control = 'private, no-cache'
+        self.response.etag = etag
+        if last_modified is not None:
+            self.response.last_modified = last_modified
+        #clients that only send If-Modified-Since always get the full page
+        is_current = 'If-None-Match' in self.request.headers and etag in self.request.if_none_match
+        if is_current:
+            self.response.status = 304
+        return is_current
+
+    def get_request_cached(self, cache_key, loader):
+        """Returns a value that only needs to be looked up once per request, such as the logged in member
+            :param cache_key:
+                A hashable key identifying the value
+            :param loader:
+                A function taking no arguments that looks up the value the first time it is needed
+            :returns:
+                The value from the loader, which may be None
+        """
+        if cache_key not in self._request_cache:
+            self._request_cache[cache_key] = loader()
+        return self._request_cache[cache_key]
+
     def get_gift_exchange_member(self):
-        """Gets the member object associated with a particular session"""
+        """Gets the member object associated with a particular session.
+            The member is resolved once per request and shared by the decorators and handlers"""
+        return self.get_request_cached('gift_exchange_member', self._load_gift_exchange_member)
+
+    def _load_gift_exchange_member(self):
+        """Looks up the member object associated with a particular session"""
         gift_exchange_member = None
         gift_exchange_key = get_gift_exchange_key(DEFAULT_GIFT_EXCHANGE_NAME)
         #first see if the user is in the DB
-        auth = self.auth
-        session_user = auth.get_user_by_session()
-        if session_user:
+        if self.user_info:
             try:
-                user_object = User.get_by_id(session_user['user_id'])
-                gift_exchange_member = GiftExchangeMember.get_member_by_user_key(gift_exchange_key, user_object.key)
+                gift_exchange_member = GiftExchangeMember.get_member_by_user_key(gift_exchange_key, self.user.key)
             except:
                 pass
         if gift_exchange_member is None:
@@ -236,9 +502,26 @@ class UserUnique(ndb.Model):
         unique_object = UserUnique(key=key_string, property_type=value_type, property_value=value)
         unique_object.put()
         return unique_object
+    
+    def _post_put_hook(self, future):
+        """ndb hook that keeps the member cache in sync when a unique value is created"""
+        UserUnique._invalidate_member_cache(self.key)
+    
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        """ndb hook that keeps the member cache in sync when a unique value is deleted"""
+        UserUnique._invalidate_member_cache(key)
+    
+    @staticmethod
+    def _invalidate_member_cache(key):
+        """Google accounts are looked up through the member cache, so linking or unlinking one invalidates it"""
+        value_type, _, value = key.id().partition(':')
+        if value_type == 'google':
+            _invalidate_member_cache([_get_member_cache_key('google', value)])
 
 class GiftExchangeMember(ndb.Model):
     """A person that could be used in anonymous giving sessions"""
+    gift_exchange_key = ndb.KeyProperty(indexed=True)
     google_user_key = ndb.KeyProperty(indexed=True, kind=UserUnique)
     google_user_id = ndb.StringProperty(indexed=True)
     first_name = ndb.StringProperty(indexed=False)
@@ -253,6 +536,7 @@ class GiftExchangeMember(ndb.Model):
     pending_email_key = ndb.KeyProperty(indexed=True, kind=UserUnique)
     subscribed_to_updates = ndb.BooleanProperty(indexed=False, default=True)
     verified_email = ndb.BooleanProperty(indexed=False, default=False)
+    time_updated = ndb.DateTimeProperty(indexed=False, auto_now=True) #change stamp for conditional requests
     
     def get_email_address(self):
         """Returns the member's email address"""
@@ -269,6 +553,7 @@ class GiftExchangeMember(ndb.Model):
             self.email_address = self.email_key.get().property_value
             self.verified_email = True
             self.put()
+            self.save_email_pointer()
         return
     
     def link_google_user(self, google_user_object):
@@ -287,30 +572,92 @@ class GiftExchangeMember(ndb.Model):
         self.google_user_id = None
         self.put()
     
+    def _get_cache_key_list(self):
+        """Returns the member cache keys that can point at this member"""
+        cache_key_list = []
+        if self.user_key:
+            cache_key_list.append(_get_member_cache_key('user', self.user_key.id()))
+        if self.google_user_id:
+            cache_key_list.append(_get_member_cache_key('google', self.google_user_id))
+        return cache_key_list
+    
+    def save_email_pointer(self):
+        """Points the member's email address at them for get_members_by_email. Called where the address is set, after
+            the member has been saved, so saves that don't change the address don't write it"""
+        if self.email_address and self.gift_exchange_key:
+            GiftExchangeMemberEmail.create_email_pointer(self).put()
+    
+    def _post_put_hook(self, future):
+        """ndb hook that invalidates the cached lookups for a member whenever it is saved"""
+        cache_key_list = self._get_cache_key_list()
+        if cache_key_list:
+            _invalidate_member_cache(cache_key_list)
+    
+    @classmethod
+    def _pre_delete_hook(cls, key):
+        """ndb hook that remembers which cached lookups point at a member before it is deleted, since only the key
+            is left afterwards. The member was usually just loaded, so this is normally served by the context cache"""
+        member = key.get()
+        if member is not None:
+            _DELETED_MEMBER_CACHE_KEYS[key] = member._get_cache_key_list()
+    
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        """ndb hook that invalidates the cached lookups for a member once it is deleted, so no cache points at it"""
+        cache_key_list = _DELETED_MEMBER_CACHE_KEYS.pop(key, None)
+        if cache_key_list:
+            _invalidate_member_cache(cache_key_list)
+    
+    @staticmethod
+    def _get_cached_member(gift_exchange_key, cache_key, is_match):
+        """Gets a member through the member cache, returning None on a miss or if the cached entry is stale"""
+        member_key = _get_cached_member_key(cache_key)
+        if member_key is None:
+            return None
+        member = member_key.get()
+        if member is None or member.gift_exchange_key != gift_exchange_key or not is_match(member):
+            return None
+        return member
+    
     @staticmethod
     def get_member_by_user_key(gift_exchange_key, user_key):
         """Gets a member by their user record"""   
-        query = GiftExchangeMember.query(GiftExchangeMember.user_key==user_key, ancestor=gift_exchange_key)
-        return query.get()
+        cache_key = _get_member_cache_key('user', user_key.id())
+        member = GiftExchangeMember._get_cached_member(gift_exchange_key, cache_key, lambda member: member.user_key == user_key)
+        if member is None:
+            query = GiftExchangeMember.query(GiftExchangeMember.user_key==user_key, GiftExchangeMember.gift_exchange_key==gift_exchange_key)
+            member = query.get()
+            if member is not None:
+                _set_cached_member_key(cache_key, member.key)
+        return member
     
     @staticmethod
     def get_member_by_google_id(gift_exchange_key, google_user_id):
         """Returns a user by their google user id. Will return none if the user doesn't exist"""
-        query = GiftExchangeMember.query(GiftExchangeMember.google_user_id==google_user_id, ancestor=gift_exchange_key)
-        return query.get()
+        cache_key = _get_member_cache_key('google', google_user_id)
+        member = GiftExchangeMember._get_cached_member(gift_exchange_key, cache_key, lambda member: member.google_user_id == google_user_id)
+        if member is None:
+            query = GiftExchangeMember.query(GiftExchangeMember.google_user_id==google_user_id, GiftExchangeMember.gift_exchange_key==gift_exchange_key)
+            member = query.get()
+            if member is not None:
+                _set_cached_member_key(cache_key, member.key)
+        return member
     
     @staticmethod
     def create_member_by_native_user(gift_exchange_key, user, email_object, first_name, last_name):
         """Create a member based off a native user account"""
         member = GiftExchangeMember.get_member_by_user_key(gift_exchange_key, user.key)
         if member is None:
-            member = GiftExchangeMember(parent=gift_exchange_key, 
+            member = GiftExchangeMember(gift_exchange_key=gift_exchange_key, 
                                         user_key=user.key,
                                         first_name=first_name,
                                         last_name=last_name, 
                                         pending_email_key=email_object.key,
                                         email_address = email_object.property_value)
             member.put()
+            member.save_email_pointer()
+            #the login query is eventually consistent, so make sure the next request finds the new member
+            _set_cached_member_key(_get_member_cache_key('user', user.key.id()), member.key)
         return member
     
     @staticmethod
@@ -319,7 +666,7 @@ class GiftExchangeMember(ndb.Model):
         member = GiftExchangeMember.get_member_by_google_id(gift_exchange_key, google_user_object.property_value)
         #Consider validating google_user and google_user_object aren't null
         if member is None:
-            member = GiftExchangeMember(parent=gift_exchange_key, 
+            member = GiftExchangeMember(gift_exchange_key=gift_exchange_key, 
                                         google_user_id=google_user_object.property_value,
                                         google_user_key=google_user_object.key,
                                         first_name=first_name,
@@ -327,6 +674,8 @@ class GiftExchangeMember(ndb.Model):
                                         email_address=email,
                                         verified_email=True)
             member.put()
+            member.save_email_pointer()
+            _set_cached_member_key(_get_member_cache_key('google', member.google_user_id), member.key)
         return member
     
     @staticmethod
@@ -339,35 +688,100 @@ class GiftExchangeMember(ndb.Model):
                 if member.email_address != google_user.email():
                     member.email_address = google_user.email()
                     member.put()
+                    member.save_email_pointer()
         return member
     
     @staticmethod
     def get_member_by_email(gift_exchange_key, email):
         """Gets a member by their email address. References to emails shouldn't be stored, but are
             useful for display in UIs, so it should only be for using as a public facing intermediary"""
-        query = GiftExchangeMember.query(GiftExchangeMember.email_address==email, ancestor=gift_exchange_key)
+        query = GiftExchangeMember.query(GiftExchangeMember.email_address==email, GiftExchangeMember.gift_exchange_key==gift_exchange_key)
         return query.get()
     
+    @staticmethod
+    def get_members_by_email(gift_exchange_key, email_list):
+        """Gets the members for a list of email addresses with two batch gets, one for the email pointers and one for
+            the members they point at. Addresses without a pointer, such as those of members that haven't been saved
+            since pointers were added, fall back to queries, and the pointers found that way are saved for next time
+            :returns:
+                A dictionary of email address to member. Addresses without a member are left out
+        """
+        email_list = list(set(email_list))
+        pointer_list = ndb.get_multi([GiftExchangeMemberEmail.get_email_key(gift_exchange_key, email) for email in email_list])
+        member_list = ndb.get_multi([pointer.member_key for pointer in pointer_list if pointer is not None])
+        member_index = {}
+        for member in member_list:
+            #a pointer is left behind when a member's address changes, so only trust it if the member still has the address
+            if member is not None and member.gift_exchange_key == gift_exchange_key and member.email_address in email_list:
+                member_index.setdefault(member.email_address, member)
+        missing_email_list = [email for email in email_list if email not in member_index]
+        if missing_email_list:
+            #an IN filter runs one query per value, so these run in parallel
+            futures = []
+            for index in range(0, len(missing_email_list), _MAX_IN_FILTER_VALUES):
+                query = GiftExchangeMember.query(GiftExchangeMember.email_address.IN(missing_email_list[index:index + _MAX_IN_FILTER_VALUES]),
+                                                 GiftExchangeMember.gift_exchange_key==gift_exchange_key)
+                futures.append(query.fetch_async())
+            found_member_list = []
+            for future in futures:
+                for member in future.get_result():
+                    if member.email_address not in member_index:
+                        member_index[member.email_address] = member
+                        found_member_list.append(member)
+            ndb.put_multi([GiftExchangeMemberEmail.create_email_pointer(member) for member in found_member_list])
+        return member_index
+    
     @staticmethod
     def get_all_members_query(gift_exchange_key):
         """Returns a query for getting all possible members of the system"""
-        return GiftExchangeMember.query(ancestor=gift_exchange_key)
+        return GiftExchangeMember.query(GiftExchangeMember.gift_exchange_key==gift_exchange_key)
+
+class GiftExchangeMemberEmail(ndb.Model):
+    """Points an email address at the member that has it, so members can be found by email with a batch get instead
+        of a query per address. Written where a member's address is set, and by get_members_by_email for members whose
+        address was set before pointers existed. A pointer isn't removed when the address changes,
+        so the member it points at has to be checked"""
+    member_key = ndb.KeyProperty(indexed=False, kind=GiftExchangeMember)
+    
+    @staticmethod
+    def get_email_key(gift_exchange_key, email):
+        """Returns the key of the pointer for an email address"""
+        return ndb.Key(GiftExchangeMemberEmail, gift_exchange_key.id() + ':' + email)
+    
+    @staticmethod
+    def create_email_pointer(member):
+        """Returns a pointer from a member's email address to the member, ready to be saved"""
+        return GiftExchangeMemberEmail(key=GiftExchangeMemberEmail.get_email_key(member.gift_exchange_key, member.email_address),
+                                       member_key=member.key)
 
 class GiftExchangeEvent(ndb.Model):
-    """An event for anonymous giving"""
+    """An event for anonymous giving. Each event is the root of its own entity group, holding its participants"""
+    gift_exchange_key = ndb.KeyProperty(indexed=True)
     display_name = ndb.StringProperty(indexed=True)
     has_started = ndb.BooleanProperty(indexed=False, default=False)
     has_ended = ndb.BooleanProperty(indexed=False, default=False)
     money_limit = ndb.StringProperty(indexed=False, default='$50')
+    exclusion_events = ndb.IntegerProperty('exclusion_years', indexed=False, default=1) #how many past events before somebody can give to the same person again, stored under its old name
+    time_updated = ndb.DateTimeProperty(indexed=False, auto_now=True) #change stamp for conditional requests
     
     def is_active(self):
         """Returns whether an event is active"""
         return (self.has_started and not self.has_ended)
     
+    def update_participant_status(self, participant_list):
+        """Copies whether the event is active onto its participants, with a single batch put of the ones that changed"""
+        is_active = self.is_active()
+        changed_participants = []
+        for participant in participant_list:
+            if participant.is_event_active != is_active:
+                participant.is_event_active = is_active
+                changed_participants.append(participant)
+        ndb.put_multi(changed_participants)
+    
     @staticmethod
     def get_all_events_query(gift_exchange_key):
         """Returns a query that will return all events"""
-        return GiftExchangeEvent.query(ancestor=gift_exchange_key)
+        return GiftExchangeEvent.query(GiftExchangeEvent.gift_exchange_key==gift_exchange_key)
 
 class GiftExchangeParticipant(ndb.Model):
     """A particular instantiation of a member in a giving event"""
@@ -377,8 +791,34 @@ class GiftExchangeParticipant(ndb.Model):
     idea_list = ndb.TextProperty(repeated=True)
     event_key = ndb.KeyProperty(indexed=True, kind=GiftExchangeEvent)
     target = ndb.StringProperty(indexed=True) #represents display_name of member in same event
+    target_key = ndb.KeyProperty(indexed=False, kind='GiftExchangeParticipant') #the participant named by target, set when the event starts
+    giver_key = ndb.KeyProperty(indexed=False, kind='GiftExchangeParticipant') #the participant whose target this is, set when the event starts
     is_target_known = ndb.BooleanProperty(indexed=False)
     previous_target = ndb.StringProperty(indexed=False) #represents the display name of the member from last year's event
+    is_event_active = ndb.BooleanProperty(indexed=True, default=False) #copy of the event's status, kept in sync when the event starts or stops
+    idea_html_list = ndb.TextProperty(repeated=True) #idea_list rendered by free_text_to_safe_html_markup when it was saved
+    html_version = ndb.IntegerProperty(indexed=False, default=0) #the SANITIZER_VERSION that idea_html_list was rendered with
+    time_updated = ndb.DateTimeProperty(indexed=False, auto_now=True) #change stamp for conditional requests
+    
+    def set_idea_list(self, idea_list):
+        """Sets the ideas, rendering the HTML for them once here rather than on every page view"""
+        self.idea_list = idea_list
+        self.render_html()
+    
+    def render_html(self):
+        """Renders the stored HTML for the ideas with the current sanitizer"""
+        self.idea_html_list = [free_text_to_safe_html_markup(idea, IDEA_MAX_LINK_LENGTH) for idea in self.idea_list]
+        self.html_version = SANITIZER_VERSION
+    
+    def is_html_current(self):
+        """Returns whether the stored HTML was rendered with the current sanitizer"""
+        return self.html_version == SANITIZER_VERSION
+    
+    def get_idea_html_list(self):
+        """Gets the escaped and minimally linkified ideas, falling back to rendering them if the stored HTML is out of date"""
+        if self.is_html_current() and len(self.idea_html_list) == len(self.idea_list):
+            return self.idea_html_list
+        return [free_text_to_safe_html_markup(idea, IDEA_MAX_LINK_LENGTH) for idea in self.idea_list]
     
     def get_event(self):
         """Returns the event object that a member is in"""
@@ -390,47 +830,265 @@ class GiftExchangeParticipant(ndb.Model):
     
     def is_valid_for_member(self, gift_exchange_member):
         """Determines where a participant matches a particular member"""
-        participant_member = self.member_key.get()
-        return (participant_member.key == gift_exchange_member.key)
+        if gift_exchange_member is None:
+            return False
+        return (self.member_key == gift_exchange_member.key)
     
     def get_giver(self, allow_unknown=False):
         """Gets the participant name who is giving to this participant, if that person knows"""
-        query = GiftExchangeParticipant.query(GiftExchangeParticipant.target==self.display_name, GiftExchangeParticipant.event_key==self.event_key)
-        giver = query.get()
-        if giver.is_target_known or allow_unknown:
-            return giver
-        return None
+        return self.get_giver_async(allow_unknown).get_result()
+    
+    @ndb.tasklet
+    def get_giver_async(self, allow_unknown=False):
+        """Asynchronous version of get_giver, returning a future. Events started before giver_key existed
+            fall back to finding the giver by name"""
+        if self.giver_key is not None:
+            giver = yield self.giver_key.get_async()
+        else:
+            query = GiftExchangeParticipant.query(GiftExchangeParticipant.target==self.display_name, ancestor=self.event_key)
+            giver = yield query.get_async()
+        if giver is not None and (giver.is_target_known or allow_unknown):
+            raise ndb.Return(giver)
+        raise ndb.Return(None)
+    
+    def get_target(self):
+        """Gets the participant this participant is giving to, or None if they haven't been assigned"""
+        return self.get_target_async().get_result()
+    
+    @ndb.tasklet
+    def get_target_async(self):
+        """Asynchronous version of get_target, returning a future. Events started before target_key existed
+            fall back to finding the target by name"""
+        if self.target_key is not None:
+            target_participant = yield self.target_key.get_async()
+        elif self.target:
+            target_participant = yield GiftExchangeParticipant.get_participant_by_name_async(None, self.target, self.event_key)
+        else:
+            target_participant = None
+        raise ndb.Return(target_participant)
     
     @staticmethod
     def get_participant_by_name(gift_exchange_key, display_name, event_key):
         """Gets a participant in a gift exchange by their display name"""
-        query = GiftExchangeParticipant.query(GiftExchangeParticipant.display_name==display_name, GiftExchangeParticipant.event_key==event_key, ancestor=gift_exchange_key)
-        return query.get()
-        
-    @staticmethod
-    def create_participant_by_name(gift_exchange_key, display_name, event_key):
-        """Creates a participant by their display name. If the participant already exists, it will simply return the participant"""
-        participant = GiftExchangeParticipant.get_participant_by_name(gift_exchange_key, display_name, event_key)
-        if participant is None:
-            participant = GiftExchangeParticipant(parent=gift_exchange_key, display_name=display_name, event_key=event_key)
-            participant.put()
-        return participant
+        return GiftExchangeParticipant.get_participant_by_name_async(gift_exchange_key, display_name, event_key).get_result()
     
+    @staticmethod
+    def get_participant_by_name_async(gift_exchange_key, display_name, event_key):
+        """Asynchronous version of get_participant_by_name, returning a future"""
+        query = GiftExchangeParticipant.query(GiftExchangeParticipant.display_name==display_name, ancestor=event_key)
+        return query.get_async()
+        
     @staticmethod
     def get_participants_in_event_query(gift_exchange_key, event_key):
         """Returns a query for gathering all participants in an event"""
-        return GiftExchangeParticipant.query(GiftExchangeParticipant.event_key==event_key, ancestor=gift_exchange_key)
+        return GiftExchangeParticipant.query(ancestor=event_key)
     
     @staticmethod
-    def get_participants_by_member_query(gift_exchange_key, member_key):
-        """Gets the list of participants for a particular member"""
-        #Ideally this would query the event's status. Computed properties don't seem to be a perfect fit since
-        #they are updated upon put, and not all the participants are updated upon the starting/ending of events
-        return GiftExchangeParticipant.query(GiftExchangeParticipant.member_key==member_key, ancestor=gift_exchange_key)
+    def get_active_participants_by_member_query(gift_exchange_key, member_key):
+        """Gets the list of participants for a particular member in events that are in progress.
+            Relies on is_event_active, which is updated for every participant when an event starts or stops"""
+        return GiftExchangeParticipant.query(GiftExchangeParticipant.member_key==member_key,
+                                             GiftExchangeParticipant.is_event_active==True)
         
 
+class GiftExchangeHistoryEntry(ndb.Model):
+    """A record of a member giving to another member in an event that has ended"""
+    event_key = ndb.KeyProperty(indexed=False, kind=GiftExchangeEvent)
+    recipient_key = ndb.KeyProperty(indexed=False, kind=GiftExchangeMember)
+    time_ended = ndb.DateTimeProperty(indexed=False)
+
+class GiftExchangeMemberHistory(ndb.Model):
+    """Everybody a member has given to in past events. There is one per member, stored under the member,
+        so the history for everybody in an event can be loaded with a single batch get instead of walking
+        back through the previous events"""
+    entries = ndb.StructuredProperty(GiftExchangeHistoryEntry, repeated=True)
+    
+    @staticmethod
+    def get_history_key(member_key):
+        """Returns the key of the history for a member"""
+        return ndb.Key(GiftExchangeMemberHistory, 'history', parent=member_key)
+    
+    @staticmethod
+    def _get_entry_sort_key(entry):
+        """Orders entries by when their event ended. Entries backfilled from events with no change stamp have no time,
+            and come first in the order they were recorded"""
+        return (entry.time_ended is not None, entry.time_ended)
+    
+    @staticmethod
+    def record_event(event_key, participant_list, time_ended=None, is_backfill=False):
+        """Adds who gave to whom in an event that has ended to the history of its members
+            :param time_ended:
+                When the event ended, which defaults to now
+            :param is_backfill:
+                Whether the event ended before history was kept, in which case time_ended is left empty if it isn't known
+        """
+        member_index = {}
+        for participant in participant_list:
+            member_index[participant.display_name] = participant.member_key
+        recipient_index = {}
+        for participant in participant_list:
+            recipient_key = member_index.get(participant.target)
+            if participant.member_key and recipient_key:
+                recipient_index.setdefault(participant.member_key, []).append(recipient_key)
+        member_keys = list(recipient_index.keys())
+        history_keys = [GiftExchangeMemberHistory.get_history_key(member_key) for member_key in member_keys]
+        history_list = ndb.get_multi(history_keys)
+        if time_ended is None and not is_backfill:
+            time_ended = datetime.datetime.now()
+        changed_history_list = []
+        for member_key, history_key, history in zip(member_keys, history_keys, history_list):
+            if history is None:
+                history = GiftExchangeMemberHistory(key=history_key)
+            if any(entry.event_key == event_key for entry in history.entries):
+                continue #already recorded, e.g. the event was stopped twice
+            for recipient_key in recipient_index[member_key]:
+                history.entries.append(GiftExchangeHistoryEntry(event_key=event_key, recipient_key=recipient_key, time_ended=time_ended))
+            #a backfill can record an older event after a newer one, so sort before dropping the oldest
+            history.entries = sorted(history.entries, key=GiftExchangeMemberHistory._get_entry_sort_key)[-MAX_HISTORY_ENTRIES:]
+            changed_history_list.append(history)
+        ndb.put_multi(changed_history_list)
+    
+    @staticmethod
+    def get_recent_recipients(member_keys, event_count):
+        """Gets who each member has given to in the last events they took part in that have ended.
+            This counts events rather than days, so last year's event still counts when this year's ends a little later
+            :param member_keys:
+                The keys of the members to look up
+            :param event_count:
+                How many of each member's most recent events to look at
+            :returns:
+                A dictionary of member key to a set of recipient member keys
+        """
+        member_keys = list(set(member_keys))
+        history_list = ndb.get_multi([GiftExchangeMemberHistory.get_history_key(member_key) for member_key in member_keys])
+        recent_recipients = {}
+        for member_key, history in zip(member_keys, history_list):
+            recipients = set()
+            if history is not None:
+                recent_event_keys = []
+                for entry in sorted(history.entries, key=GiftExchangeMemberHistory._get_entry_sort_key, reverse=True):
+                    if entry.event_key not in recent_event_keys:
+                        if len(recent_event_keys) >= event_count:
+                            continue
+                        recent_event_keys.append(entry.event_key)
+                    recipients.add(entry.recipient_key)
+            recent_recipients[member_key] = recipients
+        return recent_recipients
+
+class GiftExchangeDeleteJob(ndb.Model):
+    """Tracks deleting an event in the background. Progress is saved after every batch, so a failed task
+        picks up where the last one left off, and the admin page can show how far along it is"""
+    gift_exchange_key = ndb.KeyProperty(indexed=True)
+    event_key = ndb.KeyProperty(indexed=False, kind=GiftExchangeEvent)
+    display_name = ndb.StringProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False) #position in the event's participants
+    deleted_participants = ndb.IntegerProperty(indexed=False, default=0)
+    deleted_messages = ndb.IntegerProperty(indexed=False, default=0)
+    last_error = ndb.StringProperty(indexed=False)
+    generation = ndb.IntegerProperty(indexed=False, default=0) #which run of the job is current, so tasks from an older run stop
+    time_updated = ndb.DateTimeProperty(indexed=False, auto_now=True)
+    
+    @staticmethod
+    def get_job_key(event_key):
+        """Returns the key of the delete job for an event, which is stored in the event's entity group"""
+        return ndb.Key(GiftExchangeDeleteJob, 'delete', parent=event_key)
+    
+    @staticmethod
+    def get_all_jobs_query(gift_exchange_key):
+        """Returns a query for all the deletions that haven't finished"""
+        return GiftExchangeDeleteJob.query(GiftExchangeDeleteJob.gift_exchange_key==gift_exchange_key)
+    
+    @staticmethod
+    @ndb.transactional
+    def start_run(event):
+        """Creates the delete job for an event, or picks up the existing one if the event is already being deleted,
+            and starts a new run of it. Tasks from an earlier run stop before their next batch
+            :returns:
+                The job, whose generation identifies the new run
+        """
+        job_key = GiftExchangeDeleteJob.get_job_key(event.key)
+        job = job_key.get()
+        if job is None:
+            job = GiftExchangeDeleteJob(key=job_key, gift_exchange_key=event.gift_exchange_key, event_key=event.key, display_name=event.display_name)
+        job.generation = job.generation + 1
+        job.put()
+        return job
+    
+    def run_batch(self, gift_exchange_key, batch_size):
+        """Deletes the next batch of the event's participants along with their messages, using keys only queries.
+            Deletes the event and the job itself once there are no participants left.
+            :returns:
+                Whether this run should go on to the next batch
+        """
+        query = GiftExchangeParticipant.get_participants_in_event_query(gift_exchange_key, self.event_key)
+        participant_keys, cursor_string = fetch_page(query, batch_size, self.cursor, keys_only=True)
+        deleted_messages = 0
+        for participant_key in participant_keys:
+            message_query = GiftExchangeMessage.query(ancestor=GiftExchangeMessage.get_conversation_key(participant_key))
+            for message_keys in iterate_pages(message_query, batch_size, keys_only=True):
+                ndb.delete_multi(message_keys)
+                deleted_messages = deleted_messages + len(message_keys)
+        ndb.delete_multi(participant_keys)
+        return self._record_batch(self.cursor, cursor_string, len(participant_keys), deleted_messages)
+    
+    @ndb.transactional
+    def _record_batch(self, start_cursor, next_cursor, deleted_participants, deleted_messages):
+        """Saves the progress of a batch, unless a newer run has started or another task has already recorded the
+            batch, so overlapping tasks never count a batch twice. Deleting is safe to repeat, counting is not
+            :returns:
+                Whether this run should go on to the next batch
+        """
+        job = self.key.get()
+        if job is None or job.generation != self.generation or job.cursor != start_cursor:
+            return False
+        if next_cursor is None:
+            ndb.delete_multi([self.event_key, self.key])
+            return False
+        job.cursor = next_cursor
+        job.deleted_participants = job.deleted_participants + deleted_participants
+        job.deleted_messages = job.deleted_messages + deleted_messages
+        job.last_error = None
+        job.put()
+        return True
+    
+    @ndb.transactional
+    def record_error(self, error):
+        """Saves why a batch failed, so the admin page can show it while the task is retried"""
+        job = self.key.get()
+        if job is not None and job.generation == self.generation:
+            job.last_error = error
+            job.put()
+
+class GiftExchangeMovedKey(ndb.Model):
+    """Where an entity from the single entity group layout was moved to by the entity group migration, keyed by
+        its old key. Links with the old keys went out in emails and bookmarks, and keep working through these"""
+    new_key = ndb.KeyProperty(indexed=False)
+    
+    @staticmethod
+    def get_moved_key(old_key):
+        """Returns the key of the record for an old key. Ids were unique within a kind in the old entity group"""
+        return ndb.Key(GiftExchangeMovedKey, '%s:%s' % (old_key.kind(), old_key.id()))
+    
+    @staticmethod
+    def create_moved_key(old_key, new_key):
+        """Creates the record of where an entity moved to without saving it"""
+        return GiftExchangeMovedKey(key=GiftExchangeMovedKey.get_moved_key(old_key), new_key=new_key)
+
+def get_current_key(key):
+    """Returns where an entity linked to by its key is now. Keys under a gift exchange key are from the single entity
+        group layout, and are looked up in the records left by the entity group migration. Any other key, or an old
+        key that hasn't been migrated yet, is returned unchanged"""
+    parent = key.parent()
+    if parent is None or parent.kind() != 'GiftExchange':
+        return key
+    moved = GiftExchangeMovedKey.get_moved_key(key).get()
+    if moved is None:
+        return key
+    return moved.new_key
+
 class GiftExchangeMessage(ndb.Model):
-    """A message between two participants"""
+    """A message between two participants. Messages are stored under the key of their conversation, which is
+        named after the giver, so each giver and target pair is its own entity group"""
     sender_key = ndb.KeyProperty(indexed=True, kind=GiftExchangeParticipant)
     """An ndb key representing the sender of the message as a GiftExchangeParticipant"""
     time_sent = ndb.DateTimeProperty(indexed=True, auto_now_add=True)
@@ -442,40 +1100,118 @@ class GiftExchangeMessage(ndb.Model):
     #consider adding a subject field
     content = ndb.TextProperty(default='')
     """The actual content of the message"""
+    content_html = ndb.TextProperty()
+    """The content rendered by free_text_to_safe_html_markup when the message was created"""
+    html_version = ndb.IntegerProperty(indexed=False, default=0)
+    """The SANITIZER_VERSION that content_html was rendered with"""
+    conversation_id = ndb.StringProperty(indexed=True)
+    """The giver, target and event the message is between, from get_conversation_id, so a thread is one index range"""
     
     def get_formatted_time_sent(self):
         """Returns a nicely formatted time sent"""
         central_time = self.time_sent + datetime.timedelta(hours=-6)
         return central_time.strftime('%B %d, %Y %I:%M %p')
     
+    def render_html(self):
+        """Renders the stored HTML for the content with the current sanitizer"""
+        self.content_html = free_text_to_safe_html_markup(self.content, MESSAGE_MAX_LINK_LENGTH)
+        self.html_version = SANITIZER_VERSION
+    
+    def is_html_current(self):
+        """Returns whether the stored HTML was rendered with the current sanitizer"""
+        return self.html_version == SANITIZER_VERSION and self.content_html is not None
+    
     def get_escaped_content(self):
-        """Gets an escaped and minimally linkified version of the content"""
-        return free_text_to_safe_html_markup(self.content, 100)
+        """Gets an escaped and minimally linkified version of the content, rendering it if the stored HTML is out of date"""
+        if self.is_html_current():
+            return self.content_html
+        return free_text_to_safe_html_markup(self.content, MESSAGE_MAX_LINK_LENGTH)
         
     @staticmethod
-    def create_message(gift_exchange_key, sender_key, message_type, content):
-        """Creates a message and saves it to the database"""
-        message = GiftExchangeMessage(parent=gift_exchange_key, sender_key=sender_key, message_type=message_type, content=content)
+    def get_conversation_key(giver_key):
+        """Returns the key that the messages between a giver and their target are stored under.
+            There is no entity for the conversation itself"""
+        return ndb.Key('GiftExchangeConversation', '%s:%s' % (giver_key.parent().id(), giver_key.id()))
+    
+    @staticmethod
+    def get_conversation_id(giver_key, target_key):
+        """Returns the identifier of the thread between a giver and a target in their event. The ids are written as JSON,
+            so the string ids left by the entity group migration never match a numeric id"""
+        return ':'.join([json.dumps(key_id) for key_id in [giver_key.parent().id(), giver_key.id(), target_key.id()]])
+    
+    @staticmethod
+    def build_message(giver_key, target_key, sender_key, message_type, content):
+        """Creates a message between a giver and their target without saving it"""
+        message = GiftExchangeMessage(parent=GiftExchangeMessage.get_conversation_key(giver_key),
+                                      conversation_id=GiftExchangeMessage.get_conversation_id(giver_key, target_key),
+                                      sender_key=sender_key, message_type=message_type, content=content)
+        message.render_html()
+        return message
+    
+    @staticmethod
+    def create_message(giver_key, target_key, sender_key, message_type, content):
+        """Creates a message between a giver and their target and saves it to the database"""
+        message = GiftExchangeMessage.build_message(giver_key, target_key, sender_key, message_type, content)
         message.put()
         return message
     
     @staticmethod
-    def get_messages_from_participant_query(gift_exchange_key, gift_exchange_participant):
-        return GiftExchangeMessage.query(GiftExchangeMessage.sender_key==gift_exchange_participant.key, ancestor=gift_exchange_key)
-    
-    @staticmethod
-    def get_message_exchange_query(gift_exchange_key, giving_participant, target_participant):
-        """Returns a query that returns an ordered list of messages"""
-        return GiftExchangeMessage.query(
-                            ndb.OR(
-                                ndb.AND(
-                                    GiftExchangeMessage.sender_key==giving_participant.key,
-                                    GiftExchangeMessage.message_type==MESSAGE_TYPE_TO_TARGET
-                                    ), 
-                                ndb.AND(
-                                    GiftExchangeMessage.sender_key==target_participant.key, 
-                                    GiftExchangeMessage.message_type==MESSAGE_TYPE_TO_GIVER
-                                    )
-                                ),
-                            ancestor=gift_exchange_key).order(-GiftExchangeMessage.time_sent)
+    def fetch_message_exchange_page(gift_exchange_key, giving_participant, target_participant, page_size=DEFAULT_PAGE_SIZE, cursor_string=None):
+        """Fetches a page of the messages between two participants, newest first.
+            The opaque cursor is the time of the last message returned
+            :returns:
+                A tuple of the list of messages and the cursor for the next (older) page, which is None on the last page
+        """
+        query = GiftExchangeMessage.get_message_exchange_query(gift_exchange_key, giving_participant, target_participant)
+        if cursor_string:
+            query = query.filter(GiftExchangeMessage.time_sent < _cursor_to_time(cursor_string))
+        message_list = query.fetch(page_size + 1)
+        if len(message_list) > page_size:
+            message_list = message_list[:page_size]
+            return message_list, GiftExchangeMessage.get_exchange_cursor(message_list[-1])
+        return message_list, None
+    
+    @staticmethod
+    def fetch_newer_messages(gift_exchange_key, giving_participant, target_participant, since_cursor=None, page_size=DEFAULT_PAGE_SIZE):
+        """Fetches the messages between two participants sent after a cursor, oldest first, so a page that is
+            already showing a conversation can add new messages without loading it all again
+            :param since_cursor:
+                The cursor from get_exchange_cursor for the newest message already shown, or None for every message
+            :returns:
+                A tuple of the list of messages, the cursor for the newest message so far and whether there are more new messages
+        """
+        query = GiftExchangeMessage.get_message_exchange_query(gift_exchange_key, giving_participant, target_participant, newest_first=False)
+        if since_cursor:
+            query = query.filter(GiftExchangeMessage.time_sent > _cursor_to_time(since_cursor))
+        message_list = query.fetch(page_size + 1)
+        has_more = len(message_list) > page_size
+        message_list = message_list[:page_size]
+        if message_list:
+            since_cursor = GiftExchangeMessage.get_exchange_cursor(message_list[-1])
+        return message_list, since_cursor, has_more
+    
+    @staticmethod
+    @ndb.tasklet
+    def get_newest_time_async(giving_participant, target_participant):
+        """Returns a future for when the newest message between a giver and their target was sent, or None if there
+            are none. Projects the time from the index, so it doesn't load the message"""
+        query = GiftExchangeMessage.get_message_exchange_query(None, giving_participant, target_participant)
+        message = yield query.get_async(projection=[GiftExchangeMessage.time_sent])
+        if message is None:
+            raise ndb.Return(None)
+        raise ndb.Return(message.time_sent)
+    
+    @staticmethod
+    def get_exchange_cursor(message):
+        """Returns the cursor for the page of an exchange that comes after a particular message"""
+        return _time_to_cursor(message.time_sent)
+    
+    @staticmethod
+    def get_message_exchange_query(gift_exchange_key, giving_participant, target_participant, newest_first=True):
+        """Returns a query that returns an ordered list of the messages between a giver and their target.
+            Reads one range of the conversation_id index, in time order"""
+        order = -GiftExchangeMessage.time_sent if newest_first else GiftExchangeMessage.time_sent
+        conversation_id = GiftExchangeMessage.get_conversation_id(giving_participant.key, target_participant.key)
+        return GiftExchangeMessage.query(GiftExchangeMessage.conversation_id==conversation_id,
+                                         ancestor=GiftExchangeMessage.get_conversation_key(giving_participant.key)).order(order)
         
\ No newline at end of file
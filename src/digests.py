@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Digests of idea updates for givers.
+
+Rather than emailing the giver every time a participant changes their ideas, the first
+update opens a window for that giver and participant, and any more updates before it
+closes are merged into it. A cron job sends one email per closed window, with the ideas
+as they are at that point. Times come from tasks.now, so a tasks.LocalScheduler can run
+the whole cycle without waiting.
+"""
+
+#Natively provided by python libraries
+import datetime
+
+#Natively provided by app engine
+import google.appengine.ext.ndb as ndb
+
+#App specific includes
+import datamodel
+import outbox
+import tasks
+
+
+DIGEST_TASK_URL = '/admin/tasks/digests'
+_DIGEST_WINDOW = 30 * 60 #seconds between the first update and the digest being sent
+
+class GiftExchangeIdeaDigest(ndb.Model):
+    """The idea updates waiting to be sent to a giver. Stored in the giver's conversation, so there is one per pair"""
+    participant_key = ndb.KeyProperty(indexed=False)
+    giver_key = ndb.KeyProperty(indexed=False)
+    unsubscribe_link = ndb.StringProperty(indexed=False)
+    update_count = ndb.IntegerProperty(indexed=False, default=0)
+    send_after = ndb.DateTimeProperty(indexed=True)
+
+    @staticmethod
+    def get_digest_key(giver_key):
+        """Returns the key of the digest for a giver and their target"""
+        return ndb.Key(GiftExchangeIdeaDigest, 'ideas', parent=datamodel.GiftExchangeMessage.get_conversation_key(giver_key))
+
+    @staticmethod
+    def get_due_digests_query(now):
+        """Returns a query for the digests whose window has closed"""
+        return GiftExchangeIdeaDigest.query(GiftExchangeIdeaDigest.send_after<=now)
+
+@ndb.transactional
+def record_update(giver_key, participant_key, unsubscribe_link):
+    """Adds an idea update to the digest for a giver, opening a new window if there isn't one"""
+    digest_key = GiftExchangeIdeaDigest.get_digest_key(giver_key)
+    digest = digest_key.get()
+    if digest is None:
+        digest = GiftExchangeIdeaDigest(key=digest_key, participant_key=participant_key, giver_key=giver_key,
+                                        send_after=tasks.now() + datetime.timedelta(seconds=_DIGEST_WINDOW))
+    digest.unsubscribe_link = unsubscribe_link
+    digest.update_count = digest.update_count + 1
+    digest.put()
+
+def _build_digest_email(digest):
+    """Builds the email for a digest from the participant's current ideas. Returns None if it shouldn't be sent,
+        because the giver has unsubscribed or is no longer giving to the participant"""
+    participant, giver = ndb.get_multi([digest.participant_key, digest.giver_key])
+    if participant is None or giver is None:
+        return None
+    #compared by key, so renaming the participant doesn't lose the digest. Events started before target_key existed only have the name
+    if giver.target_key is not None:
+        is_still_giving = giver.target_key == participant.key
+    else:
+        is_still_giving = giver.target == participant.display_name
+    if not is_still_giving:
+        return None
+    member = giver.get_member()
+    if not (member.get_email_address() and member.subscribed_to_updates):
+        return None
+    event = participant.get_event()
+    body = participant.display_name + ' has updated their profile with new ideas for '
+    body = body + event.display_name
+    body = body + '\n\n'
+    for idea in participant.idea_list:
+        body = body + idea + '\n'
+    email_subject = event.display_name + ' Gift Idea Update'
+    return outbox.build_email(giver.display_name, member.get_email_address(), email_subject, body, digest.unsubscribe_link)
+
+@ndb.transactional(xg=True)
+def _hand_off(digest_key, update_count, email):
+    """Swaps a digest for its email in the outbox in one transaction, so it is sent exactly once.
+        Does nothing if another update came in after the email was built, so the next run picks it up"""
+    digest = digest_key.get()
+    if digest is None or digest.update_count != update_count:
+        return False
+    digest_key.delete()
+    if email is not None:
+        email.put()
+    return email is not None
+
+def send_due_digests(batch_size):
+    """Moves a batch of digests whose window has closed to the outbox
+        :returns:
+            Whether there may be more digests that are due
+    """
+    digest_list = GiftExchangeIdeaDigest.get_due_digests_query(tasks.now()).fetch(batch_size)
+    #building each email reads the participant, their event, the giver and the giver's member, so load them for the whole batch
+    datamodel.prefetch(digest_list, 'participant_key.event_key', 'giver_key.member_key')
+    queued_email = False
+    for digest in digest_list:
+        if _hand_off(digest.key, digest.update_count, _build_digest_email(digest)):
+            queued_email = True
+    if queued_email:
+        outbox.schedule_drain()
+    return len(digest_list) == batch_size
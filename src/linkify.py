@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Finds urls in user entered text and turns them into links.
+
+This replaces the regular expression http([^\.\s]+\.[^\.\s]*)+[^\.\s]{2,}, and finds
+exactly the same urls. The expression has nested quantifiers, so every failed 'http'
+backtracks through the rest of its token, which takes quadratic time on a long token
+full of 'http' or dots. A url never contains whitespace, so each run of non whitespace
+containing 'http' is handled on its own. Splitting a run at its dots, the expression
+matches 'http', a non-empty first segment, then as many dots as it can, where every
+segment between two dots is non-empty, ending at the end of a segment at least two
+characters long. Whether a url can end after a particular dot only depends on what follows it, so
+one backwards pass over the dots answers it for every 'http' in the run, and the whole
+text is handled in linear time.
+"""
+
+#Natively provided by python libraries
+import re
+
+
+_WHITESPACE_REGEX = re.compile(r'[ \t\n\r\f\v]') #the characters \s matches, without the unicode flag
+
+def _find_urls_in_run(text, start, end):
+    """Yields the start and end of each url in a run of text without whitespace"""
+    dots = []
+    index = text.find('.', start, end)
+    while index != -1:
+        dots.append(index)
+        index = text.find('.', index + 1, end)
+    if not dots:
+        return
+    #url_end[index] is where a url that has got as far as dots[index] ends, or None if it can't end from there
+    url_end = [None] * len(dots)
+    for index in range(len(dots) - 1, -1, -1):
+        is_last = (index == len(dots) - 1)
+        segment_end = end if is_last else dots[index + 1]
+        segment_length = segment_end - dots[index] - 1
+        if segment_length >= 1 and not is_last and url_end[index + 1] is not None:
+            url_end[index] = url_end[index + 1]
+        elif segment_length >= 2:
+            url_end[index] = segment_end
+    position = start
+    dot_index = 0
+    while True:
+        url_start = text.find('http', position, end)
+        if url_start == -1:
+            return
+        while dot_index < len(dots) and dots[dot_index] < url_start + 4:
+            dot_index = dot_index + 1
+        #the segment between 'http' and the first dot can't be empty
+        if dot_index < len(dots) and dots[dot_index] > url_start + 4 and url_end[dot_index] is not None:
+            yield url_start, url_end[dot_index]
+            position = url_end[dot_index]
+        else:
+            position = url_start + 1
+
+def find_urls(text):
+    """Yields the start and end of each url in a string, in order"""
+    position = 0
+    while True:
+        #anything in a run before its first 'http' can't be part of a url
+        run_start = text.find('http', position)
+        if run_start == -1:
+            return
+        match = _WHITESPACE_REGEX.search(text, run_start)
+        run_end = match.start() if match else len(text)
+        for url in _find_urls_in_run(text, run_start, run_end):
+            yield url
+        position = run_end
+
+def get_link_markup(url, max_link_length):
+    """Returns the markup for a link to a url, showing it without the scheme or www and truncated in the middle"""
+    text = url
+    if text.startswith('http://'):
+        text = text.replace('http://', '', 1)
+    elif text.startswith('https://'):
+        text = text.replace('https://', '', 1)
+
+    if text.startswith('www.'):
+        text = text.replace('www.', '', 1)
+
+    if len(text) > max_link_length:
+        half_length = max_link_length // 2
+        text = text[0:half_length] + '...' + text[len(text) - half_length:]
+
+    return '<a class="comurl" href="' + url + '" target="_blank" rel="nofollow">' + text + '<img class="imglink" src="/media/images/linkout.png"></a>'
+
+def linkify(text, max_link_length):
+    """Replaces every url in a string with a link
+        :param text:
+            The string, which should already be sanitized
+        :param max_link_length:
+            The maximum length of a url. If longer, it will be truncated
+        :returns:
+            The string with links
+    """
+    pieces = []
+    position = 0
+    for url_start, url_end in find_urls(text):
+        pieces.append(text[position:url_start])
+        pieces.append(get_link_markup(text[url_start:url_end], max_link_length))
+        position = url_end
+    if position == 0:
+        return text
+    pieces.append(text[position:])
+    return ''.join(pieces)
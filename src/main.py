@@ -22,28 +22,28 @@ import logging
 #Natively provided by app engine
 import google.appengine.ext.ndb as ndb
 import google.appengine.api.users as google_authentication
-import google.appengine.api.mail
 
 #Includes specified by the app.yaml
 import webapp2
 import webapp2_extras.auth
 
-#Included third party libraries distributed with the project
-import bleach
-
 #App specific includes
 import datamodel
 import constants
+import outbox
+import digests
 
 
-_DEFAULT_MAX_RESULTS = 200
+_DEFAULT_PAGE_SIZE = datamodel.DEFAULT_PAGE_SIZE
 _DEFAULT_GIFT_EXCHANGE_NAME = datamodel.DEFAULT_GIFT_EXCHANGE_NAME
 _MESSAGE_TYPE_TO_TARGET = datamodel.MESSAGE_TYPE_TO_TARGET
 _MESSAGE_TYPE_TO_GIVER = datamodel.MESSAGE_TYPE_TO_GIVER
 
 member_required = datamodel.member_required
 free_text_to_safe_html_markup = datamodel.free_text_to_safe_html_markup
+clean_text = datamodel.clean_text
 get_gift_exchange_key = datamodel.get_gift_exchange_key
+build_email = outbox.build_email
 
 def participant_required(handler):
     """
@@ -61,36 +61,63 @@ def participant_required(handler):
     return check_participant
 
 def send_email_helper(recipient_name, recipient_email, subject, plain_text_content, unsubscribe_link):
-    """"Function that will sent an HTML email to a particular recipient with standard headers and footers"""
-    plain_text = 'Hello ' + recipient_name + ',\n\n' + plain_text_content
-    plain_text = plain_text + '\n\n\n-------------------------------------------------------------------------'
-    plain_text = plain_text + '\nThis is an auto-generated email from Gift Exchange Central. Please do not reply to this email.'
-    body = free_text_to_safe_html_markup(plain_text, 9999)
-    if unsubscribe_link:
-        body = body + '<br /><a href="' + unsubscribe_link + '">Unsubscribe from automated updates</a>'
-        plain_text = plain_text + '\nUnsubscribe: ' + unsubscribe_link
-    
-    message = google.appengine.api.mail.EmailMessage(
-                sender='anonymous@gift-exchange-central.appspotmail.com',
-                subject=subject)
-    message.to = recipient_email
-    message.body = plain_text
-    message.html = '<html><head></head><body>' + body + '</body></html>'
-    message.send()
+    """"Function that will queue an HTML email to a particular recipient with standard headers and footers"""
+    outbox.queue_emails([build_email(recipient_name, recipient_email, subject, plain_text_content, unsubscribe_link)])
+
 
+def get_message_summary(message, gift_exchange_participant, other_name):
+    """Returns the escaped values that the message tables on the main page show for a message
+        :param message:
+            The message to summarize
+        :param gift_exchange_participant:
+            The participant viewing the message
+        :param other_name:
+            What to call the other side of the conversation
+    """
+    sender = gift_exchange_participant.display_name
+    recipient = other_name
+    message_type = 'Sent'
+    if message.sender_key != gift_exchange_participant.key:
+        sender, recipient = recipient, sender
+        message_type = 'Received'
+    return {
+            'message_key': message.key.urlsafe(),
+            'message_full': message.get_escaped_content(),
+            'sender': clean_text(sender),
+            'recipient': clean_text(recipient),
+            'message_type': message_type,
+            'time': clean_text(message.get_formatted_time_sent()),
+            'message_truncated': clean_text(message.content)[0:80],
+        }
 
 class MainWebAppHandler(datamodel.BaseHandler):
     """A wrapper about webapp2.RequestHandler with customized methods"""
     def get_participant(self, *args, **kwargs):
-        """Gets a participant from the get string gift_exchange_participant"""
-        gift_exchange_participant = None
-        try:
-            participant_string = kwargs['participant']
-            participant_key = ndb.Key(urlsafe=participant_string)
-            gift_exchange_participant = participant_key.get()
-        except:
-            pass
-        return gift_exchange_participant
+        """Gets a participant from the get string gift_exchange_participant. Only looked up once per request"""
+        participant_string = kwargs.get('participant')
+        def _load_participant():
+            gift_exchange_participant = None
+            try:
+                participant_key = datamodel.get_current_key(ndb.Key(urlsafe=participant_string))
+                gift_exchange_participant = participant_key.get()
+            except:
+                pass
+            return gift_exchange_participant
+        return self.get_request_cached(('participant', participant_string), _load_participant)
+    
+    def get_conversation(self, gift_exchange_participant, conversation):
+        """Finds the two sides of one of a participant's conversations
+            :param conversation:
+                target for the conversation with who the participant gives to, or giver for the one with their Santa
+            :returns:
+                A tuple of the giver, the target and the name to show for the other side.
+                The giver and target are None if the conversation doesn't exist
+        """
+        if conversation == 'target' and gift_exchange_participant.is_target_known:
+            return gift_exchange_participant, gift_exchange_participant.get_target(), gift_exchange_participant.target
+        elif conversation == 'giver':
+            return gift_exchange_participant.get_giver(True), gift_exchange_participant, 'Santa'
+        return None, None, ''
                            
 class LoginHandler(MainWebAppHandler):
     """Class for handling logins"""
@@ -139,6 +166,14 @@ class GoogleLoginHandler(MainWebAppHandler):
         self.add_template_values({'failure_message': failure_message, 'google_logout': google_authentication.create_logout_url(self.uri_for('login'))})
         self.render_template('login.html')
 
+class WarmupHandler(webapp2.RequestHandler):
+    """Handles the warmup request app engine sends a new instance before giving it traffic"""
+    def get(self):
+        """Loads what the first real requests would otherwise have to, including the admin app"""
+        import admin
+        datamodel.warm_up(self.app)
+        self.response.out.write('')
+
 class LogoutHandler(MainWebAppHandler):
     """Handles get requests for logging out"""
     def get(self):
@@ -367,18 +402,22 @@ class HomeHandler(MainWebAppHandler):
         """The handler for get requests to the home page"""
         gift_exchange_key = get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME)
         member = self.get_gift_exchange_member()
-        all_participants = []
-        if member is not None:
-            query = datamodel.GiftExchangeParticipant.get_participants_by_member_query(gift_exchange_key, member.key)
-            all_participants = query.fetch(_DEFAULT_MAX_RESULTS)
         participant_list = []
-        for participant in all_participants:
-            if participant.get_event().is_active():
-                participant_list.append(participant)
+        if member is not None:
+            query = datamodel.GiftExchangeParticipant.get_active_participants_by_member_query(gift_exchange_key, member.key)
+            participant_list = datamodel.fetch_all(query)
         if len(participant_list)==1:
             participant = participant_list[0]
             self.redirect(self.uri_for('main', participant=participant.key.urlsafe()))
         else:
+            #the template shows each event's name, so load them all in one batch into the context cache
+            event_index = datamodel.prefetch(participant_list, 'event_key')
+            stamps = []
+            for participant in participant_list:
+                event = event_index.get(participant.event_key)
+                stamps.extend([participant.key, participant.time_updated, event and event.time_updated])
+            if self.respond_if_not_modified(stamps):
+                return
             self.add_template_values({'participant_list': participant_list })
             self.render_template('home.html')
         return
@@ -389,32 +428,78 @@ class MainHandler(MainWebAppHandler):
     @participant_required
     def get(self, *args, **kwargs):
         """Handles get requests for the main page of a given event."""
+        @ndb.tasklet
+        def _load_target_async(gift_exchange_participant):
+            """Loads the target and when the newest message with them was sent, returning a future for the tuple"""
+            target_participant = yield gift_exchange_participant.get_target_async()
+            newest_time = None
+            if target_participant is not None:
+                newest_time = yield datamodel.GiftExchangeMessage.get_newest_time_async(gift_exchange_participant, target_participant)
+            raise ndb.Return((target_participant, newest_time))
+        
+        @ndb.tasklet
+        def _load_giver_async(gift_exchange_participant):
+            """Loads the giver and when the newest message with them was sent, returning a future for the tuple"""
+            giver = yield gift_exchange_participant.get_giver_async(True)
+            newest_time = None
+            if giver:
+                newest_time = yield datamodel.GiftExchangeMessage.get_newest_time_async(giver, gift_exchange_participant)
+            raise ndb.Return((giver, newest_time))
+        
+        @ndb.tasklet
+        def _fetch_first_page_async(gift_exchange_key, giving_participant, target_participant):
+            """Fetches the newest page of a message exchange, with the cursor for loading older messages"""
+            if giving_participant is None or target_participant is None:
+                raise ndb.Return(([], None))
+            query = datamodel.GiftExchangeMessage.get_message_exchange_query(gift_exchange_key, giving_participant, target_participant)
+            message_list = yield query.fetch_async(_DEFAULT_PAGE_SIZE + 1)
+            cursor_string = None
+            if len(message_list) > _DEFAULT_PAGE_SIZE:
+                message_list = message_list[:_DEFAULT_PAGE_SIZE]
+                cursor_string = datamodel.GiftExchangeMessage.get_exchange_cursor(message_list[-1])
+            raise ndb.Return((message_list, cursor_string))
+        
         gift_exchange_participant = self.get_participant(*args, **kwargs)
         gift_exchange_key = get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME)
-        target_participant = datamodel.GiftExchangeParticipant.get_participant_by_name(
-                                                                            gift_exchange_key, 
-                                                                            gift_exchange_participant.target,
-                                                                            gift_exchange_participant.event_key)
+        #the target and giver chains don't depend on each other, so run them (and the event lookup) in parallel.
+        #Their first steps are key gets, which ndb sends to the datastore as one batch
+        target_future = _load_target_async(gift_exchange_participant)
+        giver_future = _load_giver_async(gift_exchange_participant)
+        event_future = gift_exchange_participant.event_key.get_async()
+        target_participant, target_newest_time = target_future.get_result()
+        giver, giver_newest_time = giver_future.get_result()
+        event = event_future.get_result()
+        #everything on the page changes along with one of these, so an unchanged page is answered before loading any messages
+        if self.respond_if_not_modified([gift_exchange_participant.key, gift_exchange_participant.time_updated, event.time_updated,
+                                         target_participant and target_participant.key, target_participant and target_participant.time_updated,
+                                         giver and giver.key, target_newest_time, giver_newest_time]):
+            return
+        target_page_future = _fetch_first_page_async(gift_exchange_key, gift_exchange_participant, target_participant)
+        giver_page_future = _fetch_first_page_async(gift_exchange_key, giver, gift_exchange_participant)
+        target_messages, target_cursor = target_page_future.get_result()
+        giver_messages, giver_cursor = giver_page_future.get_result()
+        #the page asks for messages newer than the newest one it shows, or every message if it shows none
+        target_since = ''
+        if target_messages:
+            target_since = datamodel.GiftExchangeMessage.get_exchange_cursor(target_messages[0])
+        giver_since = ''
+        if giver_messages:
+            giver_since = datamodel.GiftExchangeMessage.get_exchange_cursor(giver_messages[0])
         target_idea_list = []
-        target_messages = []
-        giver_messages = []
         if target_participant is not None:
-            query = datamodel.GiftExchangeMessage.get_message_exchange_query(gift_exchange_key, gift_exchange_participant, target_participant)
-            target_messages = query.fetch(_DEFAULT_MAX_RESULTS)
-            for idea in target_participant.idea_list:
-                target_idea_list.append(free_text_to_safe_html_markup(idea, 60))           
-        giver = gift_exchange_participant.get_giver(True)
-        if giver:
-            query = datamodel.GiftExchangeMessage.get_message_exchange_query(gift_exchange_key, giver, gift_exchange_participant)
-            giver_messages = query.fetch(_DEFAULT_MAX_RESULTS)
+            target_idea_list = target_participant.get_idea_html_list()
         template_values = {
-                'page_title': gift_exchange_participant.get_event().display_name + ' Homepage',
+                'page_title': event.display_name + ' Homepage',
                 'gift_exchange_participant': gift_exchange_participant,
                 'target_participant': target_participant,
                 'target_idea_list': target_idea_list,
                 'target_messages': target_messages,
+                'target_cursor': target_cursor,
+                'target_since': target_since,
                 'giver_messages': giver_messages,
-                'money_limit': gift_exchange_participant.get_event().money_limit,
+                'giver_cursor': giver_cursor,
+                'giver_since': giver_since,
+                'money_limit': event.money_limit,
             }
         self.add_template_values(template_values)
         self.render_template('main.html')
@@ -430,19 +515,10 @@ class UpdateHandler(MainWebAppHandler):
         gift_exchange_participant = self.get_participant(*args, **kwargs)
         if gift_exchange_participant is not None:
             idea_list = data['idea_list'] 
-            gift_exchange_participant.idea_list = idea_list
+            gift_exchange_participant.set_idea_list(idea_list)
             gift_exchange_participant.put()
             message = 'Ideas successfully updated'
-            giver = gift_exchange_participant.get_giver()
-            if giver is not None:
-                member = giver.get_member()
-                if member.get_email_address() and member.subscribed_to_updates:
-                    body = gift_exchange_participant.display_name + ' has updated their profile with new ideas for '
-                    body = body + gift_exchange_participant.get_event().display_name
-                    body = body + '\n\n'
-                    for idea in idea_list:
-                        body = body + idea + '\n'
-                    #Given that ideas are updated on every save, would only want to send message on navigating away from page
+            #the giver is told about new ideas by BroadcastHandler, when the participant leaves the page
         self.response.out.write(json.dumps(({'message': message})))
         
 class AssignmentHandler(MainWebAppHandler):
@@ -480,6 +556,7 @@ class PreferencesHandler(MainWebAppHandler):
         refresh = ''
         data = json.loads(self.request.body)
         member_is_dirty = False
+        email_list = []
         member = self.get_gift_exchange_member()
         first_name = data['name']
         last_name = data['lastname']
@@ -547,10 +624,10 @@ class PreferencesHandler(MainWebAppHandler):
         
             message_content = 'You have updated your email at Gift Exchange Central: ' + self.uri_for('root')
             message_content = message_content + 'Verify your email address at ' + verification_url
-            send_email_helper(member.first_name, email, 'Email Verification for Gift Exchange Central', message_content, None)
+            email_list.append(build_email(member.first_name, email, 'Email Verification for Gift Exchange Central', message_content, None))
             
         if member_is_dirty:
-            member.put()
+            outbox.queue_emails(email_list, [member])
         self.response.out.write(json.dumps(({'message': '', 'refresh': refresh})))
 
 class GoogleLinkHandler(MainWebAppHandler):
@@ -596,7 +673,7 @@ class UnsubscribeHandler(MainWebAppHandler):
         #  be easy to reproduce
         member = None
         try:
-            member_key = ndb.Key(urlsafe=self.request.get('gift_exchange_member'))
+            member_key = datamodel.get_current_key(ndb.Key(urlsafe=self.request.get('gift_exchange_member')))
             member = member_key.get()
         except:
             pass
@@ -619,65 +696,110 @@ class MessageHandler(MainWebAppHandler):
         display_message = 'Could not send message'
         gift_exchange_participant = self.get_participant(*args, **kwargs)
         participant_key = gift_exchange_participant.key.urlsafe()
-        gift_exchange_key = get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME)
         message_type = data['message_type']
         email_body = data['email_body']
         message = None
+        email_list = []
         if not email_body:
             display_message = 'Nothing to send'
         else:
             if message_type == 'target':
-                target_participant = datamodel.GiftExchangeParticipant.get_participant_by_name(
-                                                                                gift_exchange_key, 
-                                                                                gift_exchange_participant.target,
-                                                                                gift_exchange_participant.event_key)
-                if target_participant.get_member().get_email_address() and target_participant.get_member().verified_email:
-                    send_email_helper(target_participant.display_name, target_participant.get_member().get_email_address(), 'Your Secret Santa Has Sent You A Message', email_body, None)
-                display_message = ''
-                message = datamodel.GiftExchangeMessage.create_message(gift_exchange_key, gift_exchange_participant.key, _MESSAGE_TYPE_TO_TARGET, email_body)
+                #there's nobody to send it to until the event has started
+                target_participant = gift_exchange_participant.get_target()
+                if target_participant is not None:
+                    target_member = target_participant.get_member()
+                    if target_member.get_email_address() and target_member.verified_email:
+                        email_list.append(build_email(target_participant.display_name, target_member.get_email_address(), 'Your Secret Santa Has Sent You A Message', email_body, None))
+                    display_message = ''
+                    message = datamodel.GiftExchangeMessage.build_message(gift_exchange_participant.key, target_participant.key, gift_exchange_participant.key, _MESSAGE_TYPE_TO_TARGET, email_body)
             elif message_type == 'giver':
-                giver = gift_exchange_participant.get_giver()
-                display_message = ''
-                if giver is not None:
-                    if giver.get_member().get_email_address() and giver.get_member().verified_email:
-                        send_email_helper(giver.display_name, giver.get_member().get_email_address(), gift_exchange_participant.display_name + ' Has Sent You A Message', email_body, None)
-                message = datamodel.GiftExchangeMessage.create_message(gift_exchange_key, gift_exchange_participant.key, _MESSAGE_TYPE_TO_GIVER, email_body)
+                #the message is stored in the giver's conversation even if they don't know their target yet
+                giver = gift_exchange_participant.get_giver(True)
+                if giver is None:
+                    #messages are stored in the giver's conversation, so there is nowhere to keep one until targets are assigned
+                    display_message = 'No one is giving to you yet'
+                else:
+                    display_message = ''
+                    giver_member = giver.get_member()
+                    #a giver who hasn't revealed their target yet would find out who it is from the email
+                    if giver.is_target_known and giver_member.get_email_address() and giver_member.verified_email:
+                        email_list.append(build_email(giver.display_name, giver_member.get_email_address(), gift_exchange_participant.display_name + ' Has Sent You A Message', email_body, None))
+                    message = datamodel.GiftExchangeMessage.build_message(giver.key, gift_exchange_participant.key, gift_exchange_participant.key, _MESSAGE_TYPE_TO_GIVER, email_body)
+        if message is not None:
+            #the message and its notification are saved in one transaction, so a notification is never lost or sent for a message that wasn't saved
+            outbox.queue_emails(email_list, [message])
         return_value = {'message': display_message, 'gift_exchange_participant_key': participant_key}
         if message is not None:
-            return_value['message_key'] = message.key.urlsafe()
-            return_value['message_full'] = message.get_escaped_content()
-            return_value['sender'] = bleach.clean(gift_exchange_participant.display_name)
             if message_type == 'target':
-                return_value['recipient'] = bleach.clean(target_participant.display_name)
+                return_value.update(get_message_summary(message, gift_exchange_participant, target_participant.display_name))
             elif message_type == 'giver':
-                return_value['recipient'] = 'Santa'
-            return_value['message_type'] = 'Sent'
-            return_value['time'] = bleach.clean(message.get_formatted_time_sent())
-            return_value['message_truncated'] = bleach.clean(message.content)[0:80]
+                return_value.update(get_message_summary(message, gift_exchange_participant, 'Santa'))
         self.response.out.write(json.dumps((return_value)))
 
+class MessagePageHandler(MainWebAppHandler):
+    """Handler for paging through the older messages in a conversation"""
+    @member_required
+    @participant_required
+    def get(self, *args, **kwargs):
+        """Returns one page of messages as JSON, newest first. Takes a conversation parameter of target or giver,
+            and the cursor from the previous page"""
+        gift_exchange_participant = self.get_participant(*args, **kwargs)
+        gift_exchange_key = get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME)
+        giver, target_participant, other_name = self.get_conversation(gift_exchange_participant, self.request.get('conversation'))
+        message_list = []
+        cursor_string = None
+        if giver is not None and target_participant is not None:
+            try:
+                message_list, cursor_string = datamodel.GiftExchangeMessage.fetch_message_exchange_page(
+                                                            gift_exchange_key, giver, target_participant,
+                                                            _DEFAULT_PAGE_SIZE, self.request.get('cursor') or None)
+            except ValueError:
+                self.abort(400)
+        items = [get_message_summary(message, gift_exchange_participant, other_name) for message in message_list]
+        self.response.content_type = 'application/json'
+        self.response.out.write(json.dumps(({'items': items, 'cursor': cursor_string})))
+
+class NewMessagesHandler(MainWebAppHandler):
+    """Handler for picking up the messages sent since a page was loaded"""
+    @member_required
+    @participant_required
+    def get(self, *args, **kwargs):
+        """Returns the messages newer than the since parameter as JSON, oldest first. Takes a conversation parameter
+            of target or giver, and the since value from the page or the previous response, which is empty for every message.
+            has_more is set if there were too many for one response, and the next one should use the returned since"""
+        gift_exchange_participant = self.get_participant(*args, **kwargs)
+        gift_exchange_key = get_gift_exchange_key(_DEFAULT_GIFT_EXCHANGE_NAME)
+        giver, target_participant, other_name = self.get_conversation(gift_exchange_participant, self.request.get('conversation'))
+        since_cursor = self.request.get('since') or None
+        message_list = []
+        has_more = False
+        if giver is not None and target_participant is not None:
+            try:
+                message_list, since_cursor, has_more = datamodel.GiftExchangeMessage.fetch_newer_messages(
+                                                            gift_exchange_key, giver, target_participant,
+                                                            since_cursor, _DEFAULT_PAGE_SIZE)
+            except ValueError:
+                self.abort(400)
+        items = [get_message_summary(message, gift_exchange_participant, other_name) for message in message_list]
+        self.response.content_type = 'application/json'
+        self.response.out.write(json.dumps(({'items': items, 'since': since_cursor, 'has_more': has_more})))
+
 class BroadcastHandler(MainWebAppHandler):
     """Class that handles updates to the participant's ideas"""
     @member_required
     @participant_required
     def post(self, *args, **kwargs):
-        """This handles post requests. Requires a JSON object"""
+        """This handles post requests. Requires a JSON object.
+            Updates are collected into a digest for the giver, which is emailed once its window closes"""
         message = '' #always consider this a success
         gift_exchange_participant = self.get_participant(*args, **kwargs)
         if gift_exchange_participant is not None:
-            idea_list = gift_exchange_participant.idea_list
             giver = gift_exchange_participant.get_giver()
             if giver is not None:
                 member = giver.get_member()
                 if member.get_email_address() and member.subscribed_to_updates:
-                    body = gift_exchange_participant.display_name + ' has updated their profile with new ideas for '
-                    body = body + gift_exchange_participant.get_event().display_name
-                    body = body + '\n\n'
-                    for idea in idea_list:
-                        body = body + idea + '\n'
-                    email_subject = gift_exchange_participant.get_event().display_name + ' Gift Idea Update'
                     unsubscribe_link = self.uri_for('unsubscribe') + '?gift_exchange_member=' + member.key.urlsafe()
-                    send_email_helper(giver.display_name, member.get_email_address(), email_subject, body, unsubscribe_link)
+                    digests.record_update(giver.key, gift_exchange_participant.key, unsubscribe_link)
         self.response.out.write(json.dumps(({'message': message})))
 
 config = {
@@ -705,10 +827,13 @@ app = webapp2.WSGIApplication([
     webapp2.Route('/home', handler=HomeHandler, name='home'),
     webapp2.Route('/preferences', handler=PreferencesHandler, name='preferences'),
     webapp2.Route('/message/<participant:.+>', handler=MessageHandler),
+    webapp2.Route('/messages/<participant:.+>', handler=MessagePageHandler),
+    webapp2.Route('/newmessages/<participant:.+>', handler=NewMessagesHandler),
     webapp2.Route('/update/<participant:.+>', handler=UpdateHandler),
     webapp2.Route('/broadcast/<participant:.+>', handler=BroadcastHandler),
     webapp2.Route('/unsubscribe', handler=UnsubscribeHandler, name="unsubscribe"),
-    webapp2.Route('/assign/<participant:.+>', handler=AssignmentHandler)
+    webapp2.Route('/assign/<participant:.+>', handler=AssignmentHandler),
+    webapp2.Route('/_ah/warmup', handler=WarmupHandler)
 ], debug=False, config=config)
 
 logging.getLogger().setLevel(logging.DEBUG)
\ No newline at end of file
@@ -2,18 +2,68 @@ function confirm_deletion(event_key)
 {
 	if (confirm("Are you sure you want to delete the event?"))
 	{
-		$.ajax({
-	          type: "POST",
-	          url: "/admin/delete/" + event_key,
-	          dataType: "json",
-	          data: JSON.stringify(
-	        	{ 
-	        	  //"event": event_key
-	          })
-	        })
-	        .done(function( data ) {
-	        	window.location.replace("/admin/");
-	        });
-		
+		resume_deletion(event_key);
 	}
+}
+
+function resume_deletion(event_key)
+{
+	//deletion runs in the background, so the admin page just shows the progress so far
+	$.ajax({
+          type: "POST",
+          url: "/admin/delete/" + event_key,
+          dataType: "json",
+          data: JSON.stringify(
+        	{ 
+        	  //"event": event_key
+          })
+        })
+        .done(function( data ) {
+        	window.location.replace("/admin/");
+        });
+}
+
+function add_event_row(event_item)
+{
+	var section = "not_started_events";
+	if (event_item["has_ended"])
+	{
+		section = "ended_events";
+	}
+	else if (event_item["has_started"])
+	{
+		section = "in_progress_events";
+	}
+	var event_string = event_item["event_string"];
+	var row = $("<tr></tr>");
+	row.append($("<td></td>").text(event_item["display_name"]));
+	row.append($("<td></td>").append($("<a>Edit</a>").attr("href", "/admin/event/" + event_string)));
+	row.append($("<td></td>").append($("<a>Report</a>").attr("href", "/admin/report/" + event_string)));
+	row.append($("<td></td>").append($("<a href='#'>Delete</a>").click(function() { confirm_deletion(event_string); })));
+	$("#tbl_" + section + " tbody").append(row);
+	$("#div_" + section).show();
+}
+
+function load_more_events()
+{
+	//the page only has the first page of events, so this fetches the next one from where the last left off
+	$.ajax({
+          type: "GET",
+          url: "/admin/api/events",
+          dataType: "json",
+          data: { "cursor": $("#txt_event_cursor").val() }
+        })
+        .done(function( data ) {
+        	$.each(data["items"], function(index, event_item) {
+        		if (!event_item["is_being_deleted"])
+        		{
+        			add_event_row(event_item);
+        		}
+        	});
+        	$("#txt_event_cursor").val(data["cursor"] || "");
+        	if (!data["cursor"])
+        	{
+        		$("#btn_more_events").hide();
+        	}
+        });
 }
\ No newline at end of file
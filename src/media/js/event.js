@@ -18,6 +18,7 @@ function save_row()
 {
 	var par = $(this).parent().parent(); //tr
 	save_row_helper(par);
+	check_feasibility();
 }
 
 function edit_row()
@@ -51,6 +52,7 @@ function delete_row()
 {
 	var par = $(this).parent().parent(); //tr
 	par.remove();
+	check_feasibility();
 }
 
 
@@ -88,19 +90,121 @@ function save_all(tbody)
 	}	
 }
 
-function save_to_database()
+function get_participant_list()
 {
-	save_all($("#tbl_participants tbody"));
-	
 	var participant_list = [];
 	$("#tbl_participants tbody tr").each(
 			function(index, value) {
+				if ($(this).find('input').length > 0) //skip rows still being edited
+				{
+					return;
+				}
 				var row_object = {};
 				row_object["display_name"] = $(this).find('td').eq(0).text();
 				row_object["email"] = $(this).find('td').eq(1).text();
 				row_object["family"] = $(this).find('td').eq(2).text();
 				participant_list.push(row_object); 
 			});
+	return participant_list;
+}
+
+var participants_loading = false;
+
+function load_participants(cursor)
+{
+	//the page only has the first page of participants, and saving needs them all, so the rest are loaded straight away
+	if (!cursor)
+	{
+		participants_loading = false;
+		clear_message("#span_status_message");
+		check_feasibility();
+		return;
+	}
+	participants_loading = true;
+	$("#span_status_message").text("Loading participants...");
+	$.ajax({
+          type: "GET",
+          url: "/admin/api/participants/" + $("#txt_event").val(),
+          dataType: "json",
+          data: { "cursor": cursor }
+        })
+        .done(function( data ) {
+        	var is_editable = ($("#btn_add_participant").length > 0);
+        	$.each(data["items"], function(index, participant) {
+        		var row = $("<tr></tr>");
+        		row.append($("<td></td>").text(participant["display_name"]));
+        		row.append($("<td></td>").text(participant["email"] || ""));
+        		row.append($("<td></td>").text(participant["family"] || ""));
+        		if (is_editable)
+        		{
+        			row.append("<td><img src='/media/images/edit.png' class='btn_edit_row'/><img src='/media/images/delete.png' class='btn_delete_row'/></td>");
+        			row.find(".btn_edit_row").bind("click", edit_row);
+        			row.find(".btn_delete_row").bind("click", delete_row);
+        		}
+        		$("#tbl_participants tbody").append(row);
+        	});
+        	load_participants(data["cursor"]);
+        })
+        .fail(function() {
+        	$("#span_status_message").text("Not every participant could be loaded. Reload the page before saving.");
+        });
+}
+
+function load_members(cursor)
+{
+	//the email choices start with the first page of members, and the rest are added as they load
+	if (!cursor)
+	{
+		return;
+	}
+	$.ajax({
+          type: "GET",
+          url: "/admin/api/members",
+          dataType: "json",
+          data: { "cursor": cursor }
+        })
+        .done(function( data ) {
+        	$.each(data["items"], function(index, member) {
+        		$("#span_email_options select").append($("<option></option>").val(member["email"]).text(member["email"]));
+        	});
+        	load_members(data["cursor"]);
+        });
+}
+
+function check_feasibility()
+{
+	if ($("#btn_add_participant").length == 0) //event has started, so the participants are fixed
+	{
+		return;
+	}
+	if (participants_loading) //checked once they have all loaded
+	{
+		return;
+	}
+	$.ajax({
+          type: "POST",
+          url: "/admin/feasibility/" + $("#txt_event").val(),
+          dataType: "json",
+          data: JSON.stringify(
+        	{ 
+        	  "participant_list": get_participant_list()
+          })
+        })
+        .done(function( data ) {
+        	$("#span_feasibility_message").text(data["message"]);
+        });
+}
+
+function save_to_database()
+{
+	if (participants_loading) //participants missing from the list would be removed from the event
+	{
+		set_temporary_message("#span_status_message", "Still loading participants, try again in a moment");
+		return;
+	}
+	save_all($("#tbl_participants tbody"));
+	
+	var participant_list = get_participant_list();
 	$("#span_status_message").text("Saving...");
 	$.ajax({
           type: "POST",
@@ -111,6 +215,7 @@ function save_to_database()
         	  //"event": $("#txt_event").val(),
         	  "event_display_name": $("#txt_event_display_name").val(),
         	  "money_limit": $("#txt_money_limit").val(),
+        	  "exclusion_events": $("#txt_exclusion_events").val(),
         	  "participant_list": participant_list
           })
         })
@@ -139,6 +244,11 @@ function start_event()
         })
       })
       .done(function( data ) {
+  		if (!data["success"])
+  		{
+  			$("#span_status_message").text(data["message"]);
+  			return;
+  		}
   		window.location.replace("/admin/event/" + data["event_string"]);
   		/* 
   		 * TODO: Update this to manipulate the DOM.
@@ -174,4 +284,6 @@ $(function()
 	$(".btn_edit_row").bind("click", edit_row);
 	$(".btn_delete_row").bind("click", delete_row);
 	$("#btn_add_participant").bind("click", add_row);
+	load_members($("#txt_member_cursor").val());
+	load_participants($("#txt_participant_cursor").val());
 });
\ No newline at end of file
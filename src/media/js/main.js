@@ -199,31 +199,105 @@ function send_message(message_body, type)
     	  else
     	  {
     		  set_temporary_message("#span_status_message", "Message successfully sent.");
-	    	  var table_selector = "#tbl_target_messages tbody";
-	    	  var header_selector = "#hdr_target_no_messages";
-	    	  if (type === "giver")
-	    	  {
-	    		  table_selector = "#tbl_giver_messages tbody";  
-	    		  header_selector = "#hdr_giver_no_messages";
-	    	  }
-	    	  $(header_selector).hide();
-	    	  $(table_selector.split(" ")[0]).show();
-	    	  var new_row = "<tr class=\"tr_link\">" +
-				"<td style=\"display:none;\">" + data["message_key"] + "</td>" +
-				"<td style=\"display:none;\">" + data["message_full"] + "</td>" +
-				"<td style=\"display:none;\">" + data["sender"] + "</td>" +
-				"<td style=\"display:none;\">" + data["recipient"] + "</td>" +
-				"<td width=\"75px\">" + data["message_type"] + "</td>" +
-				"<td width=\"240px\">" + data["time"] + "</td>" +
-				"<td>" + data["message_truncated"] + "</td>" +
-				"</tr>"
-	    	  $(table_selector).prepend(new_row);
-	    	  $("#tbl_target_messages tr, #tbl_giver_messages tr").click(show_message);
-	    				
+    		  //picks up the sent message along with anything that came in since the last check, in order
+    		  load_newer_messages(type);
     	  }
       });
 }
 
+function build_message_row(data)
+{
+	return "<tr class=\"tr_link\">" +
+		"<td style=\"display:none;\">" + data["message_key"] + "</td>" +
+		"<td style=\"display:none;\">" + data["message_full"] + "</td>" +
+		"<td style=\"display:none;\">" + data["sender"] + "</td>" +
+		"<td style=\"display:none;\">" + data["recipient"] + "</td>" +
+		"<td width=\"75px\">" + data["message_type"] + "</td>" +
+		"<td width=\"240px\">" + data["time"] + "</td>" +
+		"<td>" + data["message_truncated"] + "</td>" +
+		"</tr>";
+}
+
+function has_message_row(table_selector, message_key)
+{
+	var found = false;
+	$(table_selector + " tr").each(
+			function(index, value) {
+				if ($(this).children("td").eq(0).text() === message_key)
+				{
+					found = true;
+				}
+			});
+	return found;
+}
+
+function load_newer_messages(type)
+{
+	var since_selector = "#txt_" + type + "_since";
+	if ($(since_selector).length === 0)
+	{
+		return;
+	}
+	$.ajax({
+        type: "GET",
+        url: "/newmessages/" + $("#txt_gift_exchange_participant").val(),
+        dataType: "json",
+        data: {
+          "conversation": type,
+          "since": $(since_selector).val()
+        }
+      })
+      .done(function( data ) {
+    	  var table_selector = "#tbl_" + type + "_messages tbody";
+    	  //items come oldest first, so prepending each one leaves the newest at the top
+    	  for (var i = 0; i < data["items"].length; i++)
+    	  {
+    		  if (!has_message_row(table_selector, data["items"][i]["message_key"]))
+    		  {
+    			  $(table_selector).prepend(build_message_row(data["items"][i]));
+    		  }
+    	  }
+    	  $(since_selector).val(data["since"] || "");
+    	  if (data["items"].length > 0)
+    	  {
+    		  $("#hdr_" + type + "_no_messages").hide();
+    		  $(table_selector.split(" ")[0]).show();
+    		  $(table_selector + " tr").unbind("click").click(show_message);
+    	  }
+    	  if (data["has_more"])
+    	  {
+    		  load_newer_messages(type);
+    	  }
+      });
+}
+
+function load_older_messages(type)
+{
+	var cursor_selector = "#txt_" + type + "_cursor";
+	$.ajax({
+        type: "GET",
+        url: "/messages/" + $("#txt_gift_exchange_participant").val(),
+        dataType: "json",
+        data: {
+          "conversation": type,
+          "cursor": $(cursor_selector).val()
+        }
+      })
+      .done(function( data ) {
+    	  var table_selector = "#tbl_" + type + "_messages tbody";
+    	  for (var i = 0; i < data["items"].length; i++)
+    	  {
+    		  $(table_selector).append(build_message_row(data["items"][i]));
+    	  }
+    	  $(cursor_selector).val(data["cursor"] || "");
+    	  if (!data["cursor"])
+    	  {
+    		  $("#lnk_" + type + "_older").hide();
+    	  }
+    	  $(table_selector + " tr").unbind("click").click(show_message);
+      });
+}
+
 function show_message()
 {
 	td_list = $(this).closest('tr').children('td');
@@ -297,5 +371,9 @@ $(function()
 	$("#tbl_target_messages tr, #tbl_giver_messages tr").click(show_message);
     $("#div_modal_background, #btn_message_close").click(hide_background);
     toggle_target(); //show target by default
+    $(window).focus(function() {
+    	load_newer_messages("target");
+    	load_newer_messages("giver");
+    });
     window.onbeforeunload = send_notification_email;
 });
\ No newline at end of file
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Data migrations that run in the background a batch at a time.
+
+Each migration is a function that takes its GiftExchangeMigration record and a batch
+size, does one batch of work, saves its position on the record and returns whether
+there is more to do. The admin task handler calls run_batch and queues itself again
+until the migration is done. Progress is only saved once a batch has been written, and
+every batch is safe to repeat, so a failed task is simply retried from the last saved
+position.
+"""
+
+#Natively provided by app engine
+import google.appengine.ext.ndb as ndb
+
+#App specific includes
+import datamodel
+
+
+_GIFT_EXCHANGE_KEY = datamodel.get_gift_exchange_key(datamodel.DEFAULT_GIFT_EXCHANGE_NAME)
+
+class GiftExchangeMigration(ndb.Model):
+    """The progress of a migration, keyed by the migration name"""
+    phase = ndb.StringProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    migrated_count = ndb.IntegerProperty(indexed=False, default=0)
+    skipped_count = ndb.IntegerProperty(indexed=False, default=0)
+    is_done = ndb.BooleanProperty(indexed=False, default=False)
+    last_error = ndb.StringProperty(indexed=False)
+    time_updated = ndb.DateTimeProperty(indexed=False, auto_now=True)
+
+    def to_dictionary(self):
+        """Returns the progress as a dictionary for JSON responses"""
+        return {
+                'name': self.key.id(),
+                'phase': self.phase,
+                'migrated_count': self.migrated_count,
+                'skipped_count': self.skipped_count,
+                'is_done': self.is_done,
+                'last_error': self.last_error,
+            }
+
+def _get_new_key(old_key, parent=None):
+    """Returns where an entity from the single entity group layout moves to. The ids become strings,
+        so they can never collide with ids allocated under the new parents. Keys that have already
+        moved are returned unchanged"""
+    if old_key is None or old_key.parent() != _GIFT_EXCHANGE_KEY:
+        return old_key
+    return ndb.Key(old_key.kind(), str(old_key.id()), parent=parent)
+
+def _copy_entity(entity, new_key, **changes):
+    """Copies an entity to a new key, with some properties replaced"""
+    values = entity.to_dict()
+    values.update(changes)
+    return type(entity)(key=new_key, **values)
+
+def _migrate_members(migration, batch_size):
+    """Moves a batch of members and their history out from under the gift exchange key.
+        Members are deleted from the old layout once copied, so the next batch is always the first page"""
+    old_member_list = datamodel.GiftExchangeMember.query(ancestor=_GIFT_EXCHANGE_KEY).fetch(batch_size)
+    if not old_member_list:
+        migration.phase = 'participants'
+        return
+    old_history_keys = [datamodel.GiftExchangeMemberHistory.get_history_key(member.key) for member in old_member_list]
+    old_history_list = ndb.get_multi(old_history_keys)
+    new_entity_list = []
+    for member, history in zip(old_member_list, old_history_list):
+        new_member = _copy_entity(member, _get_new_key(member.key), gift_exchange_key=_GIFT_EXCHANGE_KEY)
+        new_entity_list.append(new_member)
+        new_entity_list.append(datamodel.GiftExchangeMovedKey.create_moved_key(member.key, new_member.key))
+        if history is not None:
+            new_history = datamodel.GiftExchangeMemberHistory(key=datamodel.GiftExchangeMemberHistory.get_history_key(new_member.key))
+            for entry in history.entries:
+                new_history.entries.append(datamodel.GiftExchangeHistoryEntry(event_key=_get_new_key(entry.event_key),
+                                                                              recipient_key=_get_new_key(entry.recipient_key),
+                                                                              time_ended=entry.time_ended))
+            new_entity_list.append(new_history)
+    ndb.put_multi(new_entity_list)
+    ndb.delete_multi([member.key for member in old_member_list] + old_history_keys)
+    migration.migrated_count = migration.migrated_count + len(old_member_list)
+
+def _find_old_participant_key(old_event_key, display_name):
+    """Finds the key of a participant in an event that is still in the old layout by their display name"""
+    query = datamodel.GiftExchangeParticipant.query(datamodel.GiftExchangeParticipant.display_name==display_name,
+                                                    datamodel.GiftExchangeParticipant.event_key==old_event_key,
+                                                    ancestor=_GIFT_EXCHANGE_KEY)
+    return query.get(keys_only=True)
+
+def _migrate_participant_messages(migration, old_event_key, participant, new_participant_key, batch_size):
+    """Moves the messages a participant sent into the conversations they belong to, and sets their conversation_id
+        so the threads show them as soon as they have moved. A message to a target goes in the thread with the
+        participant's current target, which is where the old query showed it"""
+    old_giver_key = None
+    target_key = None
+    is_target_looked_up = False
+    new_event_key = _get_new_key(old_event_key)
+    query = datamodel.GiftExchangeMessage.query(datamodel.GiftExchangeMessage.sender_key==participant.key, ancestor=_GIFT_EXCHANGE_KEY)
+    for old_message_list in datamodel.iterate_pages(query, batch_size):
+        new_message_list = []
+        for message in old_message_list:
+            conversation_id = None
+            if message.message_type == datamodel.MESSAGE_TYPE_TO_TARGET:
+                giver_key = new_participant_key
+                if not is_target_looked_up and participant.target:
+                    target_key = _get_new_key(_find_old_participant_key(old_event_key, participant.target), new_event_key)
+                    is_target_looked_up = True
+                if target_key is not None:
+                    conversation_id = datamodel.GiftExchangeMessage.get_conversation_id(giver_key, target_key)
+            else:
+                if old_giver_key is None:
+                    giver_query = datamodel.GiftExchangeParticipant.query(datamodel.GiftExchangeParticipant.target==participant.display_name,
+                                                                          datamodel.GiftExchangeParticipant.event_key==old_event_key,
+                                                                          ancestor=_GIFT_EXCHANGE_KEY)
+                    old_giver_key = giver_query.get(keys_only=True)
+                    if old_giver_key is None:
+                        #nobody ever gave to this participant, so the message was never shown to anybody
+                        migration.skipped_count = migration.skipped_count + 1
+                        continue
+                giver_key = _get_new_key(old_giver_key, new_event_key)
+                conversation_id = datamodel.GiftExchangeMessage.get_conversation_id(giver_key, new_participant_key)
+            new_key = ndb.Key(datamodel.GiftExchangeMessage, str(message.key.id()),
+                              parent=datamodel.GiftExchangeMessage.get_conversation_key(giver_key))
+            new_message_list.append(_copy_entity(message, new_key, sender_key=new_participant_key, conversation_id=conversation_id))
+        ndb.put_multi(new_message_list)
+        ndb.delete_multi([message.key for message in old_message_list])
+
+def _migrate_participants(migration, batch_size):
+    """Moves the next batch of participants in the first event left in the old layout, along with their messages.
+        The old participants are kept until the whole event is copied, since finding who gave to somebody
+        still needs them"""
+    old_event = datamodel.GiftExchangeEvent.query(ancestor=_GIFT_EXCHANGE_KEY).get()
+    if old_event is None:
+        migration.is_done = True
+        return
+    new_event_key = _get_new_key(old_event.key)
+    if migration.cursor is None:
+        ndb.put_multi([_copy_entity(old_event, new_event_key, gift_exchange_key=_GIFT_EXCHANGE_KEY),
+                       datamodel.GiftExchangeMovedKey.create_moved_key(old_event.key, new_event_key)])
+    query = datamodel.GiftExchangeParticipant.query(datamodel.GiftExchangeParticipant.event_key==old_event.key, ancestor=_GIFT_EXCHANGE_KEY)
+    old_participant_list, cursor_string = datamodel.fetch_page(query, batch_size, migration.cursor)
+    new_participant_list = []
+    for participant in old_participant_list:
+        new_participant_key = _get_new_key(participant.key, new_event_key)
+        _migrate_participant_messages(migration, old_event.key, participant, new_participant_key, batch_size)
+        new_participant_list.append(_copy_entity(participant, new_participant_key,
+                                                 member_key=_get_new_key(participant.member_key),
+                                                 event_key=new_event_key))
+        new_participant_list.append(datamodel.GiftExchangeMovedKey.create_moved_key(participant.key, new_participant_key))
+    ndb.put_multi(new_participant_list)
+    migration.migrated_count = migration.migrated_count + len(old_participant_list)
+    migration.cursor = cursor_string
+    if cursor_string is None:
+        migration.phase = 'cleanup'
+
+def _cleanup_event(migration, batch_size):
+    """Deletes a batch of the old participants of an event that has been copied, then the old event itself"""
+    old_event_key = datamodel.GiftExchangeEvent.query(ancestor=_GIFT_EXCHANGE_KEY).get(keys_only=True)
+    if old_event_key is None:
+        migration.phase = 'participants'
+        return
+    query = datamodel.GiftExchangeParticipant.query(datamodel.GiftExchangeParticipant.event_key==old_event_key, ancestor=_GIFT_EXCHANGE_KEY)
+    old_participant_keys = query.fetch(batch_size, keys_only=True)
+    if old_participant_keys:
+        ndb.delete_multi(old_participant_keys)
+        return
+    old_event_key.delete()
+    migration.phase = 'participants'
+
+def migrate_entity_groups(migration, batch_size):
+    """Moves data out of the single gift exchange entity group. Members become root entities, events become
+        the roots of their own groups holding their participants, and messages move under their conversations.
+        Every member, event and participant that moves leaves a GiftExchangeMovedKey, so links with old urlsafe
+        keys, such as bookmarked participant pages and unsubscribe links, keep working through get_current_key.
+        The site only reads the new layout, so old data doesn't show up until it has moved. Deploying this is a
+        downtime step: stop sending people to the site, deploy, run this migration to the end, and only then open
+        the site again.
+        Deletions that are still running should be finished first, since their jobs point at the old keys"""
+    if migration.phase is None:
+        migration.phase = 'members'
+    if migration.phase == 'members':
+        _migrate_members(migration, batch_size)
+    elif migration.phase == 'participants':
+        _migrate_participants(migration, batch_size)
+    elif migration.phase == 'cleanup':
+        _cleanup_event(migration, batch_size)
+    return not migration.is_done
+
+@ndb.transactional_tasklet
+def _render_html_async(entity_key):
+    """Re-renders the stored HTML of one entity in a transaction, so an edit saved in the meantime isn't overwritten"""
+    entity = yield entity_key.get_async()
+    if entity is None or entity.is_html_current():
+        raise ndb.Return(False)
+    entity.render_html()
+    yield entity.put_async()
+    raise ndb.Return(True)
+
+def _backfill_kind(migration, model_class, batch_size):
+    """Re-renders the stored HTML for a page of one kind of entity. Returns whether the kind is finished"""
+    entity_list, cursor_string = datamodel.fetch_page(model_class.query(), batch_size, migration.cursor)
+    futures = [_render_html_async(entity.key) for entity in entity_list if not entity.is_html_current()]
+    rendered_count = len([future for future in futures if future.get_result()])
+    migration.migrated_count = migration.migrated_count + rendered_count
+    migration.skipped_count = migration.skipped_count + len(entity_list) - rendered_count
+    migration.cursor = cursor_string
+    return cursor_string is None
+
+def backfill_sanitized_html(migration, batch_size):
+    """Renders the stored HTML of messages and ideas that were saved before it existed, or with an older
+        sanitizer. Entities without the property aren't in any index, so this walks every message and
+        participant with a cursor rather than querying for the stale ones"""
+    if migration.phase is None:
+        migration.phase = 'messages'
+    if migration.phase == 'messages':
+        if _backfill_kind(migration, datamodel.GiftExchangeMessage, batch_size):
+            migration.phase = 'participants'
+    elif migration.phase == 'participants':
+        if _backfill_kind(migration, datamodel.GiftExchangeParticipant, batch_size):
+            migration.is_done = True
+    return not migration.is_done
+
+def _get_giver_key_candidates(message):
+    """Returns the keys the giver of a message's conversation could have. The conversation key only has the giver's id
+        as text, and participants moved by the entity group migration have string ids, so a numeric id could be either"""
+    giver_id = message.key.parent().id().split(':', 1)[1]
+    event_key = message.sender_key.parent()
+    candidate_keys = [ndb.Key(datamodel.GiftExchangeParticipant, giver_id, parent=event_key)]
+    if giver_id.isdigit():
+        candidate_keys.append(ndb.Key(datamodel.GiftExchangeParticipant, int(giver_id), parent=event_key))
+    return candidate_keys
+
+def _find_conversation_ids(message_list):
+    """Works out the conversation_id of each message from the conversation it is stored in and who sent it.
+        A message to a giver was sent by the target. A message to a target goes in the thread with the giver's
+        current target, which is where the query this replaced showed it
+        :returns:
+            A dictionary of message key to conversation_id, leaving out messages whose giver or target can't be found
+    """
+    participant_keys = set()
+    for message in message_list:
+        participant_keys.add(message.sender_key)
+        if message.message_type == datamodel.MESSAGE_TYPE_TO_GIVER:
+            participant_keys.update(_get_giver_key_candidates(message))
+    participant_keys = list(participant_keys)
+    participants = dict([(participant.key, participant) for participant in ndb.get_multi(participant_keys) if participant is not None])
+    target_futures = {}
+    for message in message_list:
+        giver = participants.get(message.sender_key)
+        if message.message_type == datamodel.MESSAGE_TYPE_TO_TARGET and giver is not None and giver.target and giver.key not in target_futures:
+            query = datamodel.GiftExchangeParticipant.query(datamodel.GiftExchangeParticipant.display_name==giver.target, ancestor=giver.key.parent())
+            target_futures[giver.key] = query.get_async(keys_only=True)
+    conversation_ids = {}
+    for message in message_list:
+        giver_key = None
+        target_key = None
+        if message.message_type == datamodel.MESSAGE_TYPE_TO_TARGET:
+            if message.sender_key in target_futures:
+                giver_key = message.sender_key
+                target_key = target_futures[message.sender_key].get_result()
+        else:
+            target_key = message.sender_key
+            giver_keys = [key for key in _get_giver_key_candidates(message) if key in participants]
+            if giver_keys:
+                giver_key = giver_keys[0]
+        if giver_key is not None and target_key is not None:
+            conversation_ids[message.key] = datamodel.GiftExchangeMessage.get_conversation_id(giver_key, target_key)
+    return conversation_ids
+
+@ndb.transactional_tasklet
+def _set_conversation_ids_async(conversation_ids):
+    """Sets conversation_id on messages in one conversation in a single transaction, so an edit saved in the meantime
+        isn't overwritten. Returns how many were set"""
+    message_list = yield ndb.get_multi_async(conversation_ids.keys())
+    message_list = [message for message in message_list if message is not None and message.conversation_id is None]
+    for message in message_list:
+        message.conversation_id = conversation_ids[message.key]
+    yield ndb.put_multi_async(message_list)
+    raise ndb.Return(len(message_list))
+
+def backfill_conversation_ids(migration, batch_size):
+    """Sets conversation_id on the messages saved before it existed. Messages without it aren't in its index, so this
+        walks every message with a cursor. The entity_groups migration sets it on the messages it moves, so this is
+        only needed for messages moved before it did. Run it after entity_groups, in the same downtime, since messages
+        still in the old layout aren't in a conversation yet and are skipped"""
+    message_list, cursor_string = datamodel.fetch_page(datamodel.GiftExchangeMessage.query(), batch_size, migration.cursor)
+    message_list = [message for message in message_list if message.conversation_id is None]
+    conversation_ids = _find_conversation_ids([message for message in message_list
+                                               if message.key.parent() is not None and message.key.parent().kind() == 'GiftExchangeConversation'])
+    #one transaction per conversation, since transactions on the same entity group in parallel would collide
+    conversations = {}
+    for message_key, conversation_id in conversation_ids.items():
+        conversations.setdefault(message_key.parent(), {})[message_key] = conversation_id
+    futures = [_set_conversation_ids_async(conversation) for conversation in conversations.values()]
+    updated_count = sum([future.get_result() for future in futures])
+    migration.migrated_count = migration.migrated_count + updated_count
+    migration.skipped_count = migration.skipped_count + len(message_list) - updated_count
+    migration.cursor = cursor_string
+    if cursor_string is None:
+        migration.is_done = True
+    return not migration.is_done
+
+def backfill_event_status(migration, batch_size):
+    """Copies each event's status onto its participants, for participants saved before they tracked it. Until it has
+        run, the home page doesn't list events that were already in progress. Updating an event is safe to repeat,
+        since only participants whose status is out of date are saved"""
+    #every event loads all of its participants, so take fewer events than entities per batch
+    query = datamodel.GiftExchangeEvent.get_all_events_query(_GIFT_EXCHANGE_KEY)
+    event_list, cursor_string = datamodel.fetch_page(query, max(1, batch_size // 10), migration.cursor)
+    for event in event_list:
+        participant_query = datamodel.GiftExchangeParticipant.get_participants_in_event_query(_GIFT_EXCHANGE_KEY, event.key)
+        event.update_participant_status(datamodel.fetch_all(participant_query))
+        migration.migrated_count = migration.migrated_count + 1
+    migration.cursor = cursor_string
+    if cursor_string is None:
+        migration.is_done = True
+    return not migration.is_done
+
+def backfill_member_history(migration, batch_size):
+    """Records the events that ended before member history was kept, so multi-year exclusions cover them from the start.
+        Recording an event is safe to repeat, since members that already have it are skipped. Old events have no record
+        of when they ended, so the time they were last saved stands in for it. Run it after entity_groups, since it
+        walks the events in the new layout"""
+    #every event loads all of its participants, so take fewer events than entities per batch
+    query = datamodel.GiftExchangeEvent.get_all_events_query(_GIFT_EXCHANGE_KEY)
+    event_list, cursor_string = datamodel.fetch_page(query, max(1, batch_size // 10), migration.cursor)
+    for event in event_list:
+        if not event.has_ended:
+            migration.skipped_count = migration.skipped_count + 1
+            continue
+        participant_query = datamodel.GiftExchangeParticipant.get_participants_in_event_query(_GIFT_EXCHANGE_KEY, event.key)
+        datamodel.GiftExchangeMemberHistory.record_event(event.key, datamodel.fetch_all(participant_query),
+                                                         time_ended=event.time_updated, is_backfill=True)
+        migration.migrated_count = migration.migrated_count + 1
+    migration.cursor = cursor_string
+    if cursor_string is None:
+        migration.is_done = True
+    return not migration.is_done
+
+#the backfill is named after the sanitizer version, so bumping the version gives a fresh migration to run
+MIGRATIONS = {
+    'entity_groups': migrate_entity_groups,
+    'conversation_ids': backfill_conversation_ids,
+    'event_status': backfill_event_status,
+    'member_history': backfill_member_history,
+    'sanitized_html_%d' % datamodel.SANITIZER_VERSION: backfill_sanitized_html,
+}
+
+def get_migration(name):
+    """Gets the progress of a migration, creating it if it hasn't been started"""
+    return GiftExchangeMigration.get_or_insert(name)
+
+def run_batch(name, batch_size):
+    """Runs the next batch of a migration and saves its progress. Errors are saved on the migration before being raised
+        :returns:
+            Whether there is more to do
+    """
+    migration = get_migration(name)
+    if migration.is_done:
+        return False
+    try:
+        has_more = MIGRATIONS[name](migration, batch_size)
+    except Exception as e:
+        #the failed batch may have changed the record, so reload the last saved position before recording the error
+        migration = migration.key.get(use_cache=False, use_memcache=False)
+        migration.last_error = str(e)
+        migration.put()
+        raise
+    migration.last_error = None
+    migration.put()
+    return has_more
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Outbox for outgoing email.
+
+Handlers don't call the mail API themselves. They save emails to the outbox with
+queue_emails, in the same transaction as whatever else the request saves, and a task
+drains the outbox in batches. Each email is claimed with a short lease before it is
+sent, so overlapping drain tasks never send the same email at the same time. A failed
+send is retried with exponential backoff, and gives up after _MAX_ATTEMPTS. A cron job
+sweeps the outbox every minute to pick up the retries. Delivery is at least once: an
+email whose send worked but whose removal from the outbox failed is sent again after
+its lease runs out.
+
+For testing throughput and failure handling offline, use_mail_sink replaces the mail
+API with a MailSink, which records emails instead of sending them and can be set to
+fail some of the time.
+"""
+
+#Natively provided by python libraries
+import datetime
+import random
+
+#Natively provided by app engine
+import google.appengine.ext.ndb as ndb
+import google.appengine.api.mail as mail
+
+#App specific includes
+import datamodel
+import tasks
+
+
+SENDER = 'anonymous@gift-exchange-central.appspotmail.com'
+DRAIN_TASK_URL = '/admin/tasks/outbox'
+_STATUS_PENDING = 'pending'
+_STATUS_FAILED = 'failed'
+_MAX_ATTEMPTS = 8
+_RETRY_DELAY = 30 #seconds before the first retry, doubled for every attempt after that
+_MAX_RETRY_DELAY = 60 * 60
+_LEASE_TIME = 5 * 60 #seconds a drain task has to send an email it has claimed
+_mail_sink = None
+
+class GiftExchangeOutboxEmail(ndb.Model):
+    """An email waiting to be sent. Sent emails are deleted, and ones that ran out of attempts are kept as failed"""
+    recipient_email = ndb.StringProperty(indexed=False)
+    subject = ndb.StringProperty(indexed=False)
+    body = ndb.TextProperty()
+    html = ndb.TextProperty()
+    status = ndb.StringProperty(indexed=True, default=_STATUS_PENDING)
+    next_attempt = ndb.DateTimeProperty(indexed=True)
+    attempts = ndb.IntegerProperty(indexed=False, default=0)
+    last_error = ndb.StringProperty(indexed=False)
+    time_created = ndb.DateTimeProperty(indexed=False, auto_now_add=True)
+
+    @staticmethod
+    def get_ready_query(now):
+        """Returns a query for the pending emails that are due to be sent, oldest first"""
+        return GiftExchangeOutboxEmail.query(GiftExchangeOutboxEmail.status==_STATUS_PENDING,
+                                             GiftExchangeOutboxEmail.next_attempt<=now).order(GiftExchangeOutboxEmail.next_attempt)
+
+class MailSinkError(Exception):
+    """The failure a MailSink raises when it is set to fail"""
+    pass
+
+class MailSink(object):
+    """Stand-in for the mail API that records emails instead of sending them"""
+    def __init__(self, failure_rate=0.0, rng=None):
+        self.failure_rate = failure_rate
+        self.rng = rng or random.Random()
+        self.sent = []
+        self.failed_count = 0
+
+    def send(self, email):
+        """Records an email as sent, or raises MailSinkError for the configured share of sends"""
+        if self.rng.random() < self.failure_rate:
+            self.failed_count = self.failed_count + 1
+            raise MailSinkError('Simulated failure sending to ' + email.recipient_email)
+        self.sent.append(email)
+
+def use_mail_sink(sink):
+    """Sends email to a MailSink instead of the mail API. Passing None switches back"""
+    global _mail_sink
+    _mail_sink = sink
+
+def create_email(recipient_email, subject, body, html):
+    """Creates an outbox email that is ready to send. It isn't saved, so it can be written along with other entities"""
+    return GiftExchangeOutboxEmail(recipient_email=recipient_email, subject=subject, body=body, html=html,
+                                   next_attempt=tasks.now())
+
+def build_email(recipient_name, recipient_email, subject, plain_text_content, unsubscribe_link):
+    """Builds an HTML email to a particular recipient with standard headers and footers, as an outbox email.
+        It isn't saved, so callers can pass it to queue_emails along with their other writes"""
+    plain_text = 'Hello ' + recipient_name + ',\n\n' + plain_text_content
+    plain_text = plain_text + '\n\n\n-------------------------------------------------------------------------'
+    plain_text = plain_text + '\nThis is an auto-generated email from Gift Exchange Central. Please do not reply to this email.'
+    body = datamodel.free_text_to_safe_html_markup(plain_text, 9999)
+    if unsubscribe_link:
+        body = body + '<br /><a href="' + unsubscribe_link + '">Unsubscribe from automated updates</a>'
+        plain_text = plain_text + '\nUnsubscribe: ' + unsubscribe_link
+    
+    return create_email(recipient_email, subject, plain_text, '<html><head></head><body>' + body + '</body></html>')
+
+def schedule_drain(transactional=False):
+    """Starts a task to send the emails in the outbox. A transactional task is only started if the current
+        transaction commits"""
+    tasks.enqueue(DRAIN_TASK_URL, transactional=transactional)
+
+def queue_emails(email_list, entity_list=None):
+    """Saves emails to the outbox along with any other entities in one cross group transaction, which also starts
+        the drain task, so the emails only go out if everything was saved. Every email is its own entity group and a
+        transaction can span 25 groups, so this is for the handful of entities a request saves"""
+    put_list = list(entity_list or []) + list(email_list)
+    def _save():
+        ndb.put_multi(put_list)
+        if email_list:
+            schedule_drain(transactional=True)
+    ndb.transaction(_save, xg=True)
+
+def get_retry_delay(attempts):
+    """Returns how many seconds to wait before retrying an email that has failed a number of times"""
+    return min(_RETRY_DELAY * 2 ** (attempts - 1), _MAX_RETRY_DELAY)
+
+def _send(email):
+    """Sends one outbox email through the mail API, or the mail sink if there is one"""
+    if _mail_sink is not None:
+        _mail_sink.send(email)
+        return
+    message = mail.EmailMessage(sender=SENDER, subject=email.subject)
+    message.to = email.recipient_email
+    message.body = email.body
+    message.html = email.html
+    message.send()
+
+@ndb.transactional_tasklet
+def _claim_async(email_key, now):
+    """Leases an email to this drain task. Returns None if it was sent or claimed by another task in the meantime"""
+    email = yield email_key.get_async()
+    if email is None or email.status != _STATUS_PENDING or email.next_attempt > now:
+        raise ndb.Return(None)
+    email.next_attempt = now + datetime.timedelta(seconds=_LEASE_TIME)
+    yield email.put_async()
+    raise ndb.Return(email)
+
+def drain_batch(batch_size):
+    """Sends a batch of the emails that are due, claiming them all in parallel first
+        :returns:
+            Whether there may be more emails that are due
+    """
+    now = tasks.now()
+    email_keys = GiftExchangeOutboxEmail.get_ready_query(now).fetch(batch_size, keys_only=True)
+    futures = [_claim_async(email_key, now) for email_key in email_keys]
+    sent_keys = []
+    failed_emails = []
+    for future in futures:
+        email = future.get_result()
+        if email is None:
+            continue
+        try:
+            _send(email)
+        except Exception as e:
+            email.attempts = email.attempts + 1
+            email.last_error = str(e)
+            if email.attempts >= _MAX_ATTEMPTS:
+                email.status = _STATUS_FAILED
+            else:
+                email.next_attempt = now + datetime.timedelta(seconds=get_retry_delay(email.attempts))
+            failed_emails.append(email)
+            continue
+        sent_keys.append(email.key)
+    futures = ndb.put_multi_async(failed_emails) + ndb.delete_multi_async(sent_keys)
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()
+    return len(email_keys) == batch_size
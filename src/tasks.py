@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Helpers for running work in the background on the push task queue.
+
+Handlers add tasks with enqueue. Task handlers are ordinary routes protected by
+task_required, and should record their progress in the datastore so a failed task
+can simply be retried by the queue. For running background jobs without the task
+queue service, use_local_queue swaps in a LocalTaskQueue, which keeps the tasks in
+memory and runs them by calling the application directly.
+
+Work that is scheduled by time should read the time from now, and its handlers are
+run by cron. use_local_scheduler swaps in a LocalScheduler, which stands in for both
+cron and the clock, so scheduled work can be run without waiting for it.
+"""
+
+#Natively provided by python libraries
+import datetime
+
+#Natively provided by app engine
+import google.appengine.api.taskqueue as taskqueue
+import google.appengine.ext.ndb as ndb
+
+#Includes specified by the app.yaml
+import webapp2
+
+
+_QUEUE_NAME_HEADER = 'X-AppEngine-QueueName'
+_CRON_HEADER = 'X-AppEngine-Cron'
+_LOCAL_QUEUE_NAME = 'local'
+_local_queue = None
+_local_scheduler = None
+
+def task_required(handler):
+    """
+        Decorator that checks a request came from the task queue or cron. App engine removes these
+        headers from outside requests, so they can only be present on real tasks.
+    """
+    def check_task(self, *args, **kwargs):
+        if not (self.request.headers.get(_QUEUE_NAME_HEADER) or self.request.headers.get(_CRON_HEADER)):
+            self.abort(403)
+        else:
+            return handler(self, *args, **kwargs)
+    return check_task
+
+class LocalTaskQueue(object):
+    """In-memory stand-in for the push task queue"""
+    def __init__(self):
+        self.tasks = []
+        self.failed_runs = 0
+
+    def add(self, url, params=None, countdown=0, transactional=False):
+        """Queues a task. The countdown is kept so callers can inspect it, but tasks always run in order.
+            Like the real queue, a transactional task is only queued once the current transaction commits"""
+        task = (url, params or {}, countdown)
+        if transactional:
+            ndb.get_context().call_on_commit(lambda: self.tasks.append(task))
+        else:
+            self.tasks.append(task)
+
+    def run_all(self, app, max_runs=1000):
+        """Runs queued tasks against a WSGI application, including any tasks they add, until the queue is empty.
+            Like the real queue, a task that fails is put back on the queue to be retried.
+            :returns:
+                The number of task runs, including failed ones
+        """
+        runs = 0
+        while self.tasks and runs < max_runs:
+            url, params, countdown = self.tasks.pop(0)
+            request = webapp2.Request.blank(url, POST=params)
+            request.headers[_QUEUE_NAME_HEADER] = _LOCAL_QUEUE_NAME
+            response = request.get_response(app)
+            if response.status_int >= 400:
+                self.failed_runs = self.failed_runs + 1
+                self.tasks.append((url, params, countdown))
+            runs = runs + 1
+        return runs
+
+def use_local_queue(queue):
+    """Sends tasks to a LocalTaskQueue instead of the task queue service. Passing None switches back"""
+    global _local_queue
+    _local_queue = queue
+
+def enqueue(url, params=None, countdown=0, transactional=False):
+    """Adds a task to the default push queue
+        :param url:
+            The route of the task handler, which gets the task as a POST
+        :param params:
+            A dictionary of POST parameters
+        :param countdown:
+            How many seconds to wait before running the task
+        :param transactional:
+            Whether to add the task as part of the current datastore transaction, so it is only queued if the
+            transaction commits
+    """
+    if _local_queue is not None:
+        _local_queue.add(url, params, countdown, transactional)
+        return
+    taskqueue.add(url=url, params=params or {}, countdown=countdown, transactional=transactional)
+
+class LocalScheduler(object):
+    """Stand-in for cron, with a clock that only moves when it is told to"""
+    def __init__(self, start_time=None):
+        self.time = start_time or datetime.datetime.now()
+        self.jobs = []
+
+    def add_job(self, url, interval_seconds):
+        """Schedules a cron url to run every interval, starting now"""
+        self.jobs.append([url, datetime.timedelta(seconds=interval_seconds), self.time])
+
+    def advance(self, app, seconds):
+        """Moves the clock forward, running each job against a WSGI application every time it comes due.
+            The clock is set to each run's scheduled time while it runs
+            :returns:
+                The number of job runs
+        """
+        end_time = self.time + datetime.timedelta(seconds=seconds)
+        runs = 0
+        while True:
+            due_jobs = [job for job in self.jobs if job[2] <= end_time]
+            if not due_jobs:
+                break
+            job = min(due_jobs, key=lambda job: job[2])
+            self.time = job[2]
+            request = webapp2.Request.blank(job[0])
+            request.headers[_CRON_HEADER] = 'true'
+            request.get_response(app)
+            job[2] = job[2] + job[1]
+            runs = runs + 1
+        self.time = end_time
+        return runs
+
+def use_local_scheduler(scheduler):
+    """Uses a LocalScheduler's clock for now. Passing None switches back to the real time"""
+    global _local_scheduler
+    _local_scheduler = scheduler
+
+def now():
+    """Returns the current time, as seen by scheduled work"""
+    if _local_scheduler is not None:
+        return _local_scheduler.time
+    return datetime.datetime.now()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""The jinja environment the handlers render templates with.
+
+A fresh instance would otherwise parse and compile every template on first use. Before
+deploying, run tools/compile_templates.py to write each template out as a python module
+in templates_compiled, which the environment then imports instead. The compiled modules
+are only used if they were built from the current templates by the same version of
+jinja, so a stale build falls back to the templates themselves. Templates that are
+compiled at runtime can also go through a bytecode cache shared between instances.
+
+This module doesn't depend on app engine, so the compile step and the benchmarks can use it.
+"""
+
+#Natively provided by python libraries
+import hashlib
+import json
+import os
+
+#Includes specified by the app.yaml
+import jinja2
+
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+COMPILED_TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates_compiled')
+_MANIFEST_NAME = 'manifest.json'
+_ENVIRONMENT_OPTIONS = {
+    'extensions': ['jinja2.ext.autoescape'],
+    'autoescape': True,
+}
+
+def get_template_names(template_path=TEMPLATE_PATH):
+    """Returns the names of every template"""
+    return sorted(os.listdir(template_path))
+
+def get_template_checksum(template_path=TEMPLATE_PATH):
+    """Returns a checksum of the names and contents of every template"""
+    checksum = hashlib.sha1()
+    for name in get_template_names(template_path):
+        with open(os.path.join(template_path, name), 'rb') as template_file:
+            checksum.update(name.encode('utf-8'))
+            checksum.update(template_file.read())
+    return checksum.hexdigest()
+
+def _get_manifest(template_path):
+    """Returns the manifest a compiled build is checked against"""
+    return {'jinja2_version': jinja2.__version__, 'template_checksum': get_template_checksum(template_path)}
+
+def is_compiled_current(compiled_path=COMPILED_TEMPLATE_PATH, template_path=TEMPLATE_PATH):
+    """Returns whether there is a compiled build of the current templates for this version of jinja"""
+    try:
+        with open(os.path.join(compiled_path, _MANIFEST_NAME), 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (IOError, ValueError):
+        return False
+    return manifest == _get_manifest(template_path)
+
+def create_environment(compiled_path=COMPILED_TEMPLATE_PATH, bytecode_cache=None, template_path=TEMPLATE_PATH, **options):
+    """Creates the jinja environment
+        :param compiled_path:
+            The directory of compiled templates to use if it is current, or None to always compile at runtime
+        :param bytecode_cache:
+            The jinja bytecode cache for templates compiled at runtime, if any
+        :param options:
+            Any other jinja environment options, such as a different undefined
+        :returns:
+            The environment
+    """
+    #the build covers every template, so it doesn't need to fall back to the templates themselves
+    if compiled_path is not None and is_compiled_current(compiled_path, template_path):
+        loader = jinja2.ModuleLoader(compiled_path)
+    else:
+        loader = jinja2.FileSystemLoader(template_path)
+    environment_options = dict(_ENVIRONMENT_OPTIONS)
+    environment_options.update(options)
+    return jinja2.Environment(loader=loader, bytecode_cache=bytecode_cache, **environment_options)
+
+def compile_templates(compiled_path=COMPILED_TEMPLATE_PATH, template_path=TEMPLATE_PATH, log_function=None):
+    """Compiles every template to a python module in a directory, along with the manifest create_environment checks.
+        The modules are plain .py files, since app engine doesn't upload .pyc files
+        :returns:
+            The names of the templates compiled
+    """
+    if not os.path.isdir(compiled_path):
+        os.makedirs(compiled_path)
+    for name in os.listdir(compiled_path):
+        if name.startswith('tmpl_') or name == _MANIFEST_NAME:
+            os.remove(os.path.join(compiled_path, name))
+    environment = create_environment(compiled_path=None, template_path=template_path)
+    environment.compile_templates(compiled_path, zip=None, log_function=log_function, ignore_errors=False)
+    with open(os.path.join(compiled_path, _MANIFEST_NAME), 'w') as manifest_file:
+        json.dump(_get_manifest(template_path), manifest_file, indent=4, sort_keys=True)
+    return environment.list_templates()
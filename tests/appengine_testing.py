@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""Shared set up for the tests.
+
+Every test gets fresh datastore, memcache, mail and user stubs from the SDK's testbed,
+with a datastore that is always consistent so tests don't depend on timing. Tasks go to
+a LocalTaskQueue, which a test can run against the application, and an RpcCounter
+records every API call so tests can check what a request costs.
+"""
+
+#Natively provided by python libraries
+import collections
+import unittest
+
+#Natively provided by app engine
+import google.appengine.ext.ndb as ndb
+import google.appengine.ext.testbed as testbed
+import google.appengine.api.apiproxy_stub_map as apiproxy_stub_map
+import google.appengine.datastore.datastore_stub_util as datastore_stub_util
+
+#Includes specified by the app.yaml
+import webapp2
+
+#App specific includes
+import datamodel
+import outbox
+import tasks
+
+
+GIFT_EXCHANGE_KEY = datamodel.get_gift_exchange_key(datamodel.DEFAULT_GIFT_EXCHANGE_NAME)
+
+class RpcCounter(object):
+    """Records the API calls made while it is installed, by service and method"""
+    def __init__(self):
+        self.calls = []
+
+    def install(self):
+        """Starts recording. The hook belongs to the testbed's stubs, so it goes away when the testbed is deactivated"""
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('rpc_counter', self._record)
+
+    def _record(self, service, call, request, response):
+        self.calls.append((service, call, request))
+
+    def reset(self):
+        """Forgets the calls recorded so far"""
+        self.calls = []
+
+    def count(self, service, call=None):
+        """Returns how many calls were made to a service, or to one method of it"""
+        return len([1 for call_service, call_method, request in self.calls
+                    if call_service == service and (call is None or call_method == call)])
+
+    def count_lookups(self, key):
+        """Returns how many times an entity was asked for, from the datastore or from the copy ndb keeps in memcache"""
+        lookups = 0
+        urlsafe = key.urlsafe()
+        for service, call, request in self.calls:
+            if service == 'datastore_v3' and call == 'Get':
+                lookups = lookups + len([reference for reference in request.key_list() if ndb.Key(reference=reference) == key])
+            elif service == 'memcache' and call == 'Get':
+                lookups = lookups + len([memcache_key for memcache_key in request.key_list() if memcache_key.endswith(urlsafe)])
+        return lookups
+
+    def count_queries(self, kind):
+        """Returns how many queries were run for a kind"""
+        return len([1 for service, call, request in self.calls
+                    if service == 'datastore_v3' and call == 'RunQuery' and request.kind() == kind])
+
+    def describe(self):
+        """Returns a summary of the calls, for failure messages"""
+        counts = collections.Counter([service + '.' + call for service, call, request in self.calls])
+        return ', '.join(['%s x%d' % (name, counts[name]) for name in sorted(counts)])
+
+class AppEngineTestCase(unittest.TestCase):
+    """Runs each test against fresh service stubs, with tasks going to a LocalTaskQueue and nobody logged in"""
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_mail_stub()
+        self.testbed.init_user_stub()
+        self.testbed.init_app_identity_stub()
+        ndb.get_context().clear_cache()
+        #the in-process member cache outlives the stubs, so every test starts with an empty one
+        datamodel._MEMBER_KEY_CACHE = datamodel.LruCache(datamodel._MEMBER_CACHE_SIZE)
+        self.task_queue = tasks.LocalTaskQueue()
+        tasks.use_local_queue(self.task_queue)
+        self.rpc_counter = RpcCounter()
+        self.rpc_counter.install()
+
+    def tearDown(self):
+        tasks.use_local_queue(None)
+        outbox.use_mail_sink(None)
+        self.testbed.deactivate()
+
+    def log_in(self, member, is_admin=False):
+        """Logs a member in through their google account"""
+        self.testbed.setup_env(USER_EMAIL=member.email_address, USER_ID=member.google_user_id,
+                               USER_IS_ADMIN='1' if is_admin else '0', overwrite=True)
+
+    def send_request(self, app, path, method='GET', body=None, headers=None):
+        """Sends a request to a WSGI application. The context cache is cleared first, as it is for a new request"""
+        ndb.get_context().clear_cache()
+        request = webapp2.Request.blank(path, headers=headers)
+        request.method = method
+        if body is not None:
+            request.body = body
+        return request.get_response(app)
+
+def create_member(google_user_id, email_address, first_name):
+    """Creates a member who logs in with a google account"""
+    member = datamodel.GiftExchangeMember(gift_exchange_key=GIFT_EXCHANGE_KEY, google_user_id=google_user_id,
+                                          email_address=email_address, first_name=first_name, last_name='Tester',
+                                          verified_email=True)
+    member.put()
+    return member
+
+def create_started_event(member_list, display_name='Test Exchange'):
+    """Creates an event that has started, with a participant for each member, each giving to the next and the last
+        to the first. Everybody knows their target
+        :returns:
+            A tuple of the event and the list of participants, in the order of the members
+    """
+    event = datamodel.GiftExchangeEvent(gift_exchange_key=GIFT_EXCHANGE_KEY, display_name=display_name, has_started=True)
+    event.put()
+    participant_list = []
+    for member in member_list:
+        participant = datamodel.GiftExchangeParticipant(parent=event.key, member_key=member.key, event_key=event.key,
+                                                        display_name=member.first_name, family=member.first_name,
+                                                        is_target_known=True, is_event_active=True)
+        participant.put()
+        participant_list.append(participant)
+    for index, participant in enumerate(participant_list):
+        target = participant_list[(index + 1) % len(participant_list)]
+        participant.target = target.display_name
+        participant.target_key = target.key
+        target.giver_key = participant.key
+    ndb.put_multi(participant_list)
+    return event, participant_list
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""Runs the tests against the app engine SDK's service stubs.
+
+The tests need the SDK, the vendored libraries in src/lib and the constants module on
+the path, the same as dev_appserver. --sdk sets the SDK up the way dev_appserver does,
+and defaults to the APPENGINE_SDK environment variable. Name test modules, classes or
+methods to run only those.
+
+Usage:
+    python tests/run_tests.py --sdk ~/google-cloud-sdk/platform/google_appengine
+    python tests/run_tests.py --sdk ~/google_appengine test_outbox
+    python tests/run_tests.py test_member_cache.MemberCacheTest.test_lru_eviction
+"""
+
+#Natively provided by python libraries
+import argparse
+import os
+import sys
+import unittest
+
+_TESTS_PATH = os.path.dirname(os.path.abspath(__file__))
+_SRC_PATH = os.path.abspath(os.path.join(_TESTS_PATH, '..', 'src'))
+_APP_ID = 'testbed-test'
+
+def set_up_paths(sdk_path):
+    """Puts the SDK, the app and its vendored libraries on the path, as dev_appserver would"""
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, _SRC_PATH)
+    sys.path.insert(0, _TESTS_PATH)
+    #keys built when a module is imported, like the gift exchange key, take the app id from the environment, so it has
+    #to be the one the testbed sets before anything is imported
+    os.environ['APPLICATION_ID'] = _APP_ID
+    #appengine_config adds the vendored libraries relative to the app directory
+    os.chdir(_SRC_PATH)
+    import appengine_config
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the tests against the app engine service stubs')
+    parser.add_argument('names', nargs='*', help='test modules, classes or methods to run, rather than every test')
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'), help='path to the app engine SDK')
+    args = parser.parse_args(argv)
+    if not args.sdk:
+        parser.error('the path to the app engine SDK is needed, as --sdk or APPENGINE_SDK')
+
+    set_up_paths(os.path.expanduser(args.sdk))
+    loader = unittest.TestLoader()
+    if args.names:
+        suite = loader.loadTestsFromNames(args.names)
+    else:
+        suite = loader.discover(_TESTS_PATH, pattern='test_*.py', top_level_dir=_TESTS_PATH)
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    return 0 if result.wasSuccessful() else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
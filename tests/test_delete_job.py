@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+"""Tests that deleting an event in the background removes everything once, even when a task fails and is retried
+or the deletion is started again while it is running.
+
+The batch size is shrunk so a handful of participants takes several tasks, and the tasks are run through the
+LocalTaskQueue one at a time where the test needs to look at the job between them.
+"""
+
+#Natively provided by app engine
+import google.appengine.ext.ndb as ndb
+
+#App specific includes
+import admin
+import appengine_testing
+import datamodel
+
+
+_BATCH_SIZE = 2
+
+class DeleteJobTest(appengine_testing.AppEngineTestCase):
+    def setUp(self):
+        super(DeleteJobTest, self).setUp()
+        self.original_batch_size = admin._DELETE_BATCH_SIZE
+        admin._DELETE_BATCH_SIZE = _BATCH_SIZE
+        self.original_run_batch = datamodel.GiftExchangeDeleteJob.run_batch
+        member_list = [appengine_testing.create_member(str(2000 + index), 'member%d@example.com' % index, 'Member%d' % index)
+                       for index in range(5)]
+        self.event, self.participant_list = appengine_testing.create_started_event(member_list)
+        for participant in self.participant_list:
+            datamodel.GiftExchangeMessage.create_message(participant.key, participant.target_key, participant.key, 1, 'Hello')
+        self.job_key = datamodel.GiftExchangeDeleteJob.get_job_key(self.event.key)
+        self.log_in(member_list[0], is_admin=True)
+
+    def tearDown(self):
+        admin._DELETE_BATCH_SIZE = self.original_batch_size
+        datamodel.GiftExchangeDeleteJob.run_batch = self.original_run_batch
+        super(DeleteJobTest, self).tearDown()
+
+    def _start_deletion(self):
+        response = self.send_request(admin.app, '/admin/delete/' + self.event.key.urlsafe(), 'POST', '{}')
+        self.assertEqual(response.status_int, 200)
+
+    def _get_job(self):
+        ndb.get_context().clear_cache()
+        return self.job_key.get()
+
+    def _assert_everything_deleted(self):
+        ndb.get_context().clear_cache()
+        self.assertIsNone(self.event.key.get())
+        self.assertIsNone(self._get_job())
+        self.assertEqual(datamodel.GiftExchangeParticipant.query(ancestor=self.event.key).count(), 0)
+        self.assertEqual(datamodel.GiftExchangeMessage.query().count(), 0)
+
+    def test_deletes_in_batches(self):
+        self._start_deletion()
+        self.assertEqual(self.task_queue.run_all(admin.app), 3)
+        self.assertEqual(self.task_queue.failed_runs, 0)
+        self._assert_everything_deleted()
+
+    def test_failed_batch_is_retried(self):
+        failures = []
+        def _fail_once(job, gift_exchange_key, batch_size):
+            if not failures:
+                failures.append(job.key)
+                raise ValueError('datastore unavailable')
+            return self.original_run_batch(job, gift_exchange_key, batch_size)
+        datamodel.GiftExchangeDeleteJob.run_batch = _fail_once
+        self._start_deletion()
+        self.task_queue.run_all(admin.app, max_runs=1)
+        self.assertEqual(self.task_queue.failed_runs, 1)
+        job = self._get_job()
+        self.assertEqual(job.last_error, 'datastore unavailable')
+        self.assertEqual(job.deleted_participants, 0)
+        self.task_queue.run_all(admin.app, max_runs=1)
+        job = self._get_job()
+        self.assertIsNone(job.last_error)
+        self.assertEqual(job.deleted_participants, _BATCH_SIZE)
+        self.assertEqual(job.deleted_messages, _BATCH_SIZE)
+        self.task_queue.run_all(admin.app)
+        self.assertEqual(self.task_queue.failed_runs, 1)
+        self._assert_everything_deleted()
+
+    def test_resuming_does_not_double_count(self):
+        self._start_deletion()
+        self.task_queue.run_all(admin.app, max_runs=1)
+        #resumed while the first run still has a task queued, so two chains are queued at once
+        self._start_deletion()
+        self.assertEqual(len(self.task_queue.tasks), 2)
+        self.task_queue.run_all(admin.app, max_runs=2)
+        job = self._get_job()
+        self.assertEqual(job.generation, 2)
+        self.assertEqual(job.deleted_participants, 2 * _BATCH_SIZE)
+        self.assertEqual(job.deleted_messages, 2 * _BATCH_SIZE)
+        self.assertEqual(len(self.task_queue.tasks), 1)
+        self.task_queue.run_all(admin.app)
+        self._assert_everything_deleted()
+
+    def test_duplicate_task_keeps_counts(self):
+        self._start_deletion()
+        #the queue may deliver a task twice, which leaves two chains of the same run
+        self.task_queue.tasks.append(self.task_queue.tasks[0])
+        self.task_queue.run_all(admin.app, max_runs=2)
+        job = self._get_job()
+        self.assertEqual(job.deleted_participants, 2 * _BATCH_SIZE)
+        self.task_queue.run_all(admin.app)
+        self.assertEqual(self.task_queue.failed_runs, 0)
+        self._assert_everything_deleted()
+
+    def test_overlapping_batches_are_recorded_once(self):
+        self._start_deletion()
+        #two tasks that read the job before either saved its batch
+        first_copy = self._get_job()
+        second_copy = self._get_job()
+        self.assertTrue(first_copy.run_batch(appengine_testing.GIFT_EXCHANGE_KEY, _BATCH_SIZE))
+        self.assertFalse(second_copy.run_batch(appengine_testing.GIFT_EXCHANGE_KEY, _BATCH_SIZE))
+        job = self._get_job()
+        self.assertEqual(job.deleted_participants, _BATCH_SIZE)
+        self.assertIsNotNone(job.cursor)
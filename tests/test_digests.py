@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+"""Tests that idea updates are collected into one digest per giver and participant, sent once the window closes,
+and dropped for givers who have unsubscribed or no longer give to the participant.
+
+Time comes from a LocalScheduler, which also stands in for the cron job that sends the digests whose window has
+closed. Emails go to a MailSink once the outbox is drained.
+"""
+
+#Natively provided by python libraries
+import datetime
+
+#Natively provided by app engine
+import google.appengine.ext.ndb as ndb
+
+#App specific includes
+import admin
+import appengine_testing
+import digests
+import outbox
+import tasks
+
+
+_START_TIME = datetime.datetime(2016, 12, 1, 9, 0)
+_CRON_INTERVAL = 60
+_UNSUBSCRIBE_LINK = 'http://localhost/unsubscribe'
+
+class DigestTest(appengine_testing.AppEngineTestCase):
+    def setUp(self):
+        super(DigestTest, self).setUp()
+        self.scheduler = tasks.LocalScheduler(_START_TIME)
+        self.scheduler.add_job(digests.DIGEST_TASK_URL, _CRON_INTERVAL)
+        tasks.use_local_scheduler(self.scheduler)
+        self.sink = outbox.MailSink()
+        outbox.use_mail_sink(self.sink)
+        self.original_build_digest_email = digests._build_digest_email
+        member_list = [appengine_testing.create_member('3001', 'giver@example.com', 'Giver'),
+                       appengine_testing.create_member('3002', 'target@example.com', 'Target'),
+                       appengine_testing.create_member('3003', 'other@example.com', 'Other')]
+        self.giver_member = member_list[0]
+        self.event, (self.giver, self.target, self.other) = appengine_testing.create_started_event(member_list)
+        self.target.idea_list = ['Socks', 'A good book']
+        self.target.put()
+
+    def tearDown(self):
+        digests._build_digest_email = self.original_build_digest_email
+        tasks.use_local_scheduler(None)
+        super(DigestTest, self).tearDown()
+
+    def _record_update(self):
+        digests.record_update(self.giver.key, self.target.key, _UNSUBSCRIBE_LINK)
+
+    def _get_digest(self):
+        ndb.get_context().clear_cache()
+        return digests.GiftExchangeIdeaDigest.get_digest_key(self.giver.key).get()
+
+    def _get_outbox(self):
+        ndb.get_context().clear_cache()
+        return outbox.GiftExchangeOutboxEmail.query().fetch()
+
+    def _close_window(self):
+        """Runs the cron job until just after the window has closed, then drains the outbox"""
+        self.scheduler.advance(admin.app, digests._DIGEST_WINDOW + _CRON_INTERVAL)
+        self.task_queue.run_all(admin.app)
+
+    def test_updates_merge_into_one_email(self):
+        self._record_update()
+        self.scheduler.advance(admin.app, 10 * 60)
+        self._record_update()
+        self._record_update()
+        self.assertEqual(self._get_digest().update_count, 3)
+        self.scheduler.advance(admin.app, digests._DIGEST_WINDOW - 10 * 60 - _CRON_INTERVAL)
+        self.assertEqual(self._get_outbox(), [])
+        self._close_window()
+        self.assertEqual(len(self.sink.sent), 1)
+        email = self.sink.sent[0]
+        self.assertEqual(email.recipient_email, 'giver@example.com')
+        self.assertIn('Socks', email.body)
+        self.assertIn(_UNSUBSCRIBE_LINK, email.body)
+        self.assertIsNone(self._get_digest())
+
+    def test_update_during_hand_off_waits_for_next_run(self):
+        self._record_update()
+        def _build_with_late_update(digest):
+            email = self.original_build_digest_email(digest)
+            #another update comes in after the email was built, so it doesn't have the newest ideas
+            self._record_update()
+            return email
+        digests._build_digest_email = _build_with_late_update
+        self.scheduler.time = _START_TIME + datetime.timedelta(seconds=digests._DIGEST_WINDOW)
+        digests.send_due_digests(10)
+        self.assertEqual(self._get_outbox(), [])
+        self.assertEqual(self._get_digest().update_count, 2)
+        digests._build_digest_email = self.original_build_digest_email
+        digests.send_due_digests(10)
+        self.assertEqual(len(self._get_outbox()), 1)
+        self.assertIsNone(self._get_digest())
+
+    def test_renamed_participant_still_gets_digest(self):
+        self._record_update()
+        self.target.display_name = 'Renamed'
+        self.target.put()
+        self._close_window()
+        self.assertEqual(len(self.sink.sent), 1)
+
+    def test_unsubscribed_giver_is_skipped(self):
+        self._record_update()
+        self.giver_member.subscribed_to_updates = False
+        self.giver_member.put()
+        self._close_window()
+        self.assertEqual(self.sink.sent, [])
+        self.assertEqual(self._get_outbox(), [])
+        self.assertIsNone(self._get_digest())
+
+    def test_reassigned_giver_is_skipped(self):
+        self._record_update()
+        self.giver.target = self.other.display_name
+        self.giver.target_key = self.other.key
+        self.giver.put()
+        self._close_window()
+        self.assertEqual(self.sink.sent, [])
+        self.assertEqual(self._get_outbox(), [])
+        self.assertIsNone(self._get_digest())
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""Tests for the two tier member cache, against the testbed's memcache stub"""
+
+#Natively provided by python libraries
+import unittest
+
+#Natively provided by app engine
+import google.appengine.api.memcache as memcache
+
+#App specific includes
+import appengine_testing
+import datamodel
+
+
+class MemberCacheTest(appengine_testing.AppEngineTestCase):
+    def setUp(self):
+        super(MemberCacheTest, self).setUp()
+        self.member = appengine_testing.create_member('2001', 'cached@example.com', 'Cached')
+        self.cache_key = datamodel._get_member_cache_key('google', '2001')
+
+    def _get_member(self):
+        return datamodel.GiftExchangeMember.get_member_by_google_id(appengine_testing.GIFT_EXCHANGE_KEY, '2001')
+
+    def _assert_not_cached(self):
+        self.assertIsNone(datamodel._MEMBER_KEY_CACHE.get(self.cache_key))
+        self.assertIsNone(memcache.get(self.cache_key))
+
+    def test_miss_queries_and_fills_both_tiers(self):
+        self.assertEqual(self._get_member().key, self.member.key)
+        self.assertEqual(self.rpc_counter.count_queries('GiftExchangeMember'), 1)
+        self.assertEqual(datamodel._MEMBER_KEY_CACHE.get(self.cache_key), self.member.key.urlsafe())
+        self.assertEqual(memcache.get(self.cache_key), self.member.key.urlsafe())
+
+    def test_hit_skips_the_query(self):
+        self._get_member()
+        self.rpc_counter.reset()
+        self.assertEqual(self._get_member().key, self.member.key)
+        self.assertEqual(self.rpc_counter.count_queries('GiftExchangeMember'), 0)
+        self.assertEqual(self.rpc_counter.count('memcache', 'Get'), 0, self.rpc_counter.describe())
+
+    def test_memcache_hit_refills_the_process_cache(self):
+        self._get_member()
+        datamodel._MEMBER_KEY_CACHE = datamodel.LruCache(datamodel._MEMBER_CACHE_SIZE)
+        self.rpc_counter.reset()
+        self.assertEqual(self._get_member().key, self.member.key)
+        self.assertEqual(self.rpc_counter.count_queries('GiftExchangeMember'), 0)
+        self.assertEqual(datamodel._MEMBER_KEY_CACHE.get(self.cache_key), self.member.key.urlsafe())
+
+    def test_put_invalidates(self):
+        self._get_member()
+        self.member.first_name = 'Renamed'
+        self.member.put()
+        self._assert_not_cached()
+        self.assertEqual(self._get_member().first_name, 'Renamed')
+
+    def test_delete_invalidates(self):
+        self._get_member()
+        self.member.key.delete()
+        self._assert_not_cached()
+        self.rpc_counter.reset()
+        self.assertIsNone(self._get_member())
+        self.assertEqual(self.rpc_counter.count_lookups(self.member.key), 0, self.rpc_counter.describe())
+
+    def test_unlinking_google_account_invalidates(self):
+        google_user_object = datamodel.UserUnique.create_unique_value('google', '2001')
+        self.member.link_google_user(google_user_object)
+        self._get_member()
+        self.member.unlink_google_user()
+        self._assert_not_cached()
+        self.assertIsNone(self._get_member())
+
+    def test_stale_entry_is_ignored(self):
+        other_member = appengine_testing.create_member('2002', 'other@example.com', 'Other')
+        datamodel._set_cached_member_key(self.cache_key, other_member.key)
+        self.assertEqual(self._get_member().key, self.member.key)
+        self.assertEqual(datamodel._MEMBER_KEY_CACHE.get(self.cache_key), self.member.key.urlsafe())
+
+class LruCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = datamodel.LruCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_set_refreshes_an_entry(self):
+        cache = datamodel.LruCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('a', 10)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 10)
+
+    def test_delete(self):
+        cache = datamodel.LruCache(2)
+        cache.set('a', 1)
+        cache.delete('a')
+        cache.delete('missing')
+        self.assertIsNone(cache.get('a'))
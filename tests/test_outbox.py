@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+"""Tests that the outbox saves emails atomically with the rest of a request's writes, and that draining it through
+a MailSink that fails some of the time delivers every email once, backing off between retries.
+
+Time comes from a LocalScheduler, which also stands in for the cron sweep that picks up the retries.
+"""
+
+#Natively provided by python libraries
+import datetime
+import random
+
+#Natively provided by app engine
+import google.appengine.ext.ndb as ndb
+
+#App specific includes
+import admin
+import appengine_testing
+import datamodel
+import outbox
+import tasks
+
+
+_START_TIME = datetime.datetime(2016, 12, 1, 9, 0)
+_EMAIL_COUNT = 20
+_CRON_INTERVAL = 60
+
+class _FailingEntity(ndb.Model):
+    """An entity that can never be saved, standing in for a write that fails"""
+    def _pre_put_hook(self):
+        raise ValueError('write failed')
+
+class OutboxTest(appengine_testing.AppEngineTestCase):
+    def setUp(self):
+        super(OutboxTest, self).setUp()
+        self.scheduler = tasks.LocalScheduler(_START_TIME)
+        self.scheduler.add_job(outbox.DRAIN_TASK_URL, _CRON_INTERVAL)
+        tasks.use_local_scheduler(self.scheduler)
+
+    def tearDown(self):
+        tasks.use_local_scheduler(None)
+        super(OutboxTest, self).tearDown()
+
+    def _use_sink(self, failure_rate):
+        sink = outbox.MailSink(failure_rate, rng=random.Random(1225))
+        outbox.use_mail_sink(sink)
+        return sink
+
+    def _queue_emails(self):
+        for index in range(_EMAIL_COUNT):
+            outbox.queue_emails([outbox.create_email('person%d@example.com' % index, 'Subject', 'Body', None)])
+
+    def _get_outbox(self):
+        ndb.get_context().clear_cache()
+        return outbox.GiftExchangeOutboxEmail.query().fetch()
+
+    def test_queue_emails_saves_with_other_entities(self):
+        message = datamodel.GiftExchangeMessage(content='Hello')
+        email = outbox.create_email('person@example.com', 'Subject', 'Body', None)
+        outbox.queue_emails([email], [message])
+        self.assertIsNotNone(message.key.get())
+        self.assertIsNotNone(email.key.get())
+        self.assertEqual([task[0] for task in self.task_queue.tasks], [outbox.DRAIN_TASK_URL])
+
+    def test_failed_write_saves_nothing(self):
+        email = outbox.create_email('person@example.com', 'Subject', 'Body', None)
+        with self.assertRaises(ValueError):
+            outbox.queue_emails([email], [_FailingEntity()])
+        self.assertEqual(self._get_outbox(), [])
+        self.assertEqual(self.task_queue.tasks, [])
+
+    def test_retry_delay_doubles_up_to_the_limit(self):
+        self.assertEqual(outbox.get_retry_delay(1), outbox._RETRY_DELAY)
+        self.assertEqual(outbox.get_retry_delay(2), 2 * outbox._RETRY_DELAY)
+        self.assertEqual(outbox.get_retry_delay(3), 4 * outbox._RETRY_DELAY)
+        self.assertEqual(outbox.get_retry_delay(20), outbox._MAX_RETRY_DELAY)
+
+    def test_drain_retries_failures_with_backoff(self):
+        sink = self._use_sink(0.3)
+        self._queue_emails()
+        self.task_queue.run_all(admin.app)
+        self.assertGreater(sink.failed_count, 0)
+        self.assertEqual(len(sink.sent) + sink.failed_count, _EMAIL_COUNT)
+        for email in self._get_outbox():
+            self.assertEqual(email.attempts, 1)
+            self.assertEqual(email.next_attempt, _START_TIME + datetime.timedelta(seconds=outbox.get_retry_delay(1)))
+        self.scheduler.advance(admin.app, 2 * 60 * 60)
+        self.task_queue.run_all(admin.app)
+        self.assertEqual(self._get_outbox(), [])
+        recipients = sorted([email.recipient_email for email in sink.sent])
+        self.assertEqual(recipients, sorted(['person%d@example.com' % index for index in range(_EMAIL_COUNT)]))
+
+    def test_drain_gives_up_after_max_attempts(self):
+        sink = self._use_sink(1.0)
+        outbox.queue_emails([outbox.create_email('person@example.com', 'Subject', 'Body', None)])
+        self.task_queue.run_all(admin.app)
+        self.scheduler.advance(admin.app, 2 * 60 * 60)
+        email_list = self._get_outbox()
+        self.assertEqual(len(email_list), 1)
+        self.assertEqual(email_list[0].status, outbox._STATUS_FAILED)
+        self.assertEqual(email_list[0].attempts, outbox._MAX_ATTEMPTS)
+        self.assertEqual(sink.failed_count, outbox._MAX_ATTEMPTS)
+        self.assertEqual(sink.sent, [])
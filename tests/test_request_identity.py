@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""Tests that a request resolves the logged in member and its participant once, however many decorators and
+helpers ask for them, and what the message post and the main page cost in RPCs.
+
+Each test sends the request twice to fill the member cache, memcache and the template cache, as earlier requests
+to the instance would have, then counts the RPCs of the same request sent again. The budgets are the counts
+observed against the App Engine SDK, so a change to what either request costs shows up here.
+"""
+
+#Natively provided by python libraries
+import json
+
+#App specific includes
+import appengine_testing
+import main
+
+
+#a send gets the participant, the member, the target and the target's member from memcache, saves the message and its
+#email in one transaction (begin, put, commit) and then clears the message from memcache
+_MESSAGE_POST_DATASTORE_BUDGET = 3
+_MESSAGE_POST_MEMCACHE_BUDGET = 5
+#the main page gets the member, the participant, and the event with the target and giver in one batch from memcache,
+#then runs a query for the newest message time and one for the first page of each conversation
+_MAIN_PAGE_DATASTORE_BUDGET = 4
+_MAIN_PAGE_MEMCACHE_BUDGET = 3
+
+class RequestIdentityTest(appengine_testing.AppEngineTestCase):
+    def setUp(self):
+        super(RequestIdentityTest, self).setUp()
+        self.giver_member = appengine_testing.create_member('1001', 'giver@example.com', 'Giver')
+        self.target_member = appengine_testing.create_member('1002', 'target@example.com', 'Target')
+        self.event, (self.giver, self.target) = appengine_testing.create_started_event([self.giver_member, self.target_member])
+        self.log_in(self.giver_member)
+
+    def _post_message(self):
+        body = json.dumps({'message_type': 'target', 'email_body': 'Hello from your Santa'})
+        return self.send_request(main.app, '/message/' + self.giver.key.urlsafe(), 'POST', body)
+
+    def _get_main_page(self):
+        return self.send_request(main.app, '/main/' + self.giver.key.urlsafe())
+
+    def _warm_up(self, send):
+        #the first request loads the member by a query, which ndb doesn't write to memcache, so it is the second that
+        #leaves the member where the counted request will find it
+        for _ in range(2):
+            self.assertEqual(send().status_int, 200)
+        self.rpc_counter.reset()
+
+    def _assert_identity_resolved_once(self):
+        calls = self.rpc_counter.describe()
+        self.assertLessEqual(self.rpc_counter.count_lookups(self.giver_member.key), 1, calls)
+        self.assertLessEqual(self.rpc_counter.count_lookups(self.giver.key), 1, calls)
+        self.assertEqual(self.rpc_counter.count_queries('GiftExchangeMember'), 0, calls)
+        self.assertEqual(self.rpc_counter.count_queries('User'), 0, calls)
+
+    def test_message_post(self):
+        self._warm_up(self._post_message)
+        response = self._post_message()
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(json.loads(response.body)['message'], '')
+        self._assert_identity_resolved_once()
+        calls = self.rpc_counter.describe()
+        self.assertEqual(self.rpc_counter.count('datastore_v3'), _MESSAGE_POST_DATASTORE_BUDGET, calls)
+        self.assertEqual(self.rpc_counter.count('memcache'), _MESSAGE_POST_MEMCACHE_BUDGET, calls)
+
+    def test_main_page_get(self):
+        self._post_message()
+        self._warm_up(self._get_main_page)
+        response = self._get_main_page()
+        self.assertEqual(response.status_int, 200)
+        self.assertIn('Hello from your Santa', response.body)
+        self._assert_identity_resolved_once()
+        calls = self.rpc_counter.describe()
+        self.assertEqual(self.rpc_counter.count('datastore_v3'), _MAIN_PAGE_DATASTORE_BUDGET, calls)
+        self.assertEqual(self.rpc_counter.count('memcache'), _MAIN_PAGE_MEMCACHE_BUDGET, calls)
+
+    def test_logged_out_request_is_redirected(self):
+        self.testbed.setup_env(USER_EMAIL='', USER_ID='', USER_IS_ADMIN='0', overwrite=True)
+        response = self._post_message()
+        self.assertEqual(response.status_int, 302)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+#
+# Copyright 2016 Greg Eastman
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Compiles the templates to python modules in src/templates_compiled before a deploy.
+
+Run it with the same version of jinja2 as the app.yaml gives the app (2.6 for latest),
+otherwise the app ignores the build and compiles the templates at runtime as before.
+The build is ignored as soon as any template changes, so run it again before every deploy.
+
+Usage:
+    python tools/compile_templates.py
+"""
+
+#Natively provided by python libraries
+from __future__ import print_function
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+#App specific includes
+import templating
+
+
+def main():
+    templating.compile_templates(log_function=print)
+    print('Compiled templates to ' + templating.COMPILED_TEMPLATE_PATH)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())